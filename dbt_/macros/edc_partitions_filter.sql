@@ -0,0 +1,33 @@
+{#
+    Condition à utiliser dans les modèles incrémentaux construits à partir des tables edc.
+    Lors d'un build incrémental, seules les années (de_partition) à mettre à jour sont sélectionnées,
+    leurs lignes sont ensuite remplacées grâce à la stratégie delete+insert sur de_partition :
+        - les années passées dans la variable edc_partitions (ex. --vars '{"edc_partitions": [2024]}'),
+          c'est ce que fait la tâche transform avec les années chargées par build_database ;
+        - sinon, les années dont le fichier source a changé depuis le dernier build : leur
+          de_dataset_datetime dans la relation amont diffère de celui du modèle.
+    Lors d'un build complet (premier build ou --full-refresh), toutes les années sont sélectionnées.
+#}
+{% macro edc_partitions_filter(upstream_relation) %}
+    {% if is_incremental() %}
+        {% set edc_partitions = var('edc_partitions', none) %}
+        {% if edc_partitions is not none %}
+            {% if edc_partitions | length > 0 %}
+                de_partition IN ({{ edc_partitions | join(', ') }})
+            {% else %}
+                FALSE
+            {% endif %}
+        {% else %}
+            de_partition IN (
+                SELECT de_partition
+                FROM (
+                    SELECT DISTINCT de_partition, de_dataset_datetime FROM {{ upstream_relation }}
+                    EXCEPT
+                    SELECT DISTINCT de_partition, de_dataset_datetime FROM {{ this }}
+                )
+            )
+        {% endif %}
+    {% else %}
+        TRUE
+    {% endif %}
+{% endmacro %}
@@ -0,0 +1,47 @@
+{{
+    config(
+        materialized='incremental',
+        incremental_strategy='delete+insert',
+        unique_key='de_partition'
+    )
+}}
+
+WITH prelevements_resultats AS (
+    SELECT *
+    FROM {{ ref('int_edc__prelevements_resultats') }}
+    WHERE {{ edc_partitions_filter(ref('int_edc__prelevements_resultats')) }}
+),
+
+communes_reseaux AS (
+    SELECT *
+    FROM {{ ref('int_edc__communes_reseaux') }}
+    WHERE {{ edc_partitions_filter(ref('int_edc__prelevements_resultats')) }}
+)
+
+SELECT
+    prelevements_resultats.de_partition,
+    MAX(prelevements_resultats.de_dataset_datetime) AS de_dataset_datetime,
+    communes_reseaux.inseecommune,
+    ANY_VALUE(communes_reseaux.nomcommune) AS nomcommune,
+    prelevements_resultats.cdparametresiseeaux,
+    ANY_VALUE(prelevements_resultats.cdparametre) AS cdparametre,
+    ANY_VALUE(prelevements_resultats.libminparametre) AS libminparametre,
+    ANY_VALUE(prelevements_resultats.cdunitereferencesiseeaux) AS cdunitereferencesiseeaux,
+    COUNT(DISTINCT prelevements_resultats.referenceprel) AS nb_prelevements,
+    COUNT(DISTINCT prelevements_resultats.referenceprel) FILTER (
+        WHERE prelevements_resultats.plvconformitebacterio = 'N'
+        OR prelevements_resultats.plvconformitechimique = 'N'
+    ) AS nb_prelevements_non_conformes,
+    COUNT(prelevements_resultats.valtraduite) AS nb_resultats,
+    MIN(prelevements_resultats.valtraduite) AS valtraduite_min,
+    MAX(prelevements_resultats.valtraduite) AS valtraduite_max,
+    AVG(prelevements_resultats.valtraduite) AS valtraduite_moyenne,
+    MAX(prelevements_resultats.dateprel) AS dernier_prelevement
+FROM prelevements_resultats
+INNER JOIN communes_reseaux
+    ON prelevements_resultats.cdreseau = communes_reseaux.cdreseau
+    AND prelevements_resultats.de_partition = communes_reseaux.de_partition
+GROUP BY
+    prelevements_resultats.de_partition,
+    communes_reseaux.inseecommune,
+    prelevements_resultats.cdparametresiseeaux
@@ -0,0 +1,19 @@
+{{
+    config(
+        materialized='incremental',
+        incremental_strategy='delete+insert',
+        unique_key='de_partition'
+    )
+}}
+
+-- Une ligne par commune et par réseau qui l'alimente (les quartiers sont regroupés)
+SELECT
+    de_partition,
+    MAX(de_dataset_datetime) AS de_dataset_datetime,
+    inseecommune,
+    cdreseau,
+    ANY_VALUE(nomcommune) AS nomcommune,
+    ANY_VALUE(nomreseau) AS nomreseau
+FROM {{ ref('stg_edc__communes') }}
+WHERE {{ edc_partitions_filter(ref('stg_edc__communes')) }}
+GROUP BY de_partition, inseecommune, cdreseau
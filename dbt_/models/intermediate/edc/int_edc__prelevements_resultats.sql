@@ -0,0 +1,40 @@
+{{
+    config(
+        materialized='incremental',
+        incremental_strategy='delete+insert',
+        unique_key='de_partition'
+    )
+}}
+
+WITH resultats AS (
+    SELECT *
+    FROM {{ ref('stg_edc__resultats') }}
+    WHERE {{ edc_partitions_filter(ref('stg_edc__resultats')) }}
+),
+
+prelevements AS (
+    SELECT *
+    FROM {{ ref('stg_edc__prevelevements') }}
+    WHERE {{ edc_partitions_filter(ref('stg_edc__resultats')) }}
+)
+
+SELECT
+    resultats.de_partition,
+    resultats.de_dataset_datetime,
+    prelevements.cddept,
+    prelevements.cdreseau,
+    prelevements.referenceprel,
+    prelevements.dateprel,
+    prelevements.conclusionprel,
+    prelevements.plvconformitebacterio,
+    prelevements.plvconformitechimique,
+    resultats.cdparametresiseeaux,
+    resultats.cdparametre,
+    resultats.libminparametre,
+    resultats.cdunitereferencesiseeaux,
+    resultats.limitequal,
+    resultats.valtraduite
+FROM resultats
+INNER JOIN prelevements
+    ON resultats.referenceprel = prelevements.referenceprel
+    AND resultats.de_partition = prelevements.de_partition
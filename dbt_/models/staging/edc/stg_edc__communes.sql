@@ -5,5 +5,6 @@ SELECT
     cdreseau::VARCHAR(9) as cdreseau, 
     nomreseau::VARCHAR as nomreseau, 
     debutalim::VARCHAR as debutalim, 
-    de_partition::SMALLINT as de_partition
+    de_partition::SMALLINT as de_partition,
+    de_dataset_datetime::VARCHAR as de_dataset_datetime
 FROM {{ source('edc', 'edc_communes') }}
\ No newline at end of file
@@ -15,5 +15,7 @@ SELECT
     refqual::VARCHAR as refqual,
     valtraduite::NUMERIC as valtraduite,
     casparam::VARCHAR as casparam,
-    referenceanl::VARCHAR as referenceanl
+    referenceanl::VARCHAR as referenceanl,
+    de_partition::SMALLINT as de_partition,
+    de_dataset_datetime::VARCHAR as de_dataset_datetime
 FROM {{ source('edc', 'edc_resultats') }}
\ No newline at end of file
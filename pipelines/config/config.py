@@ -1,13 +1,22 @@
 import os
 
-from dotenv import load_dotenv
-
 current_dir = os.path.dirname(os.path.abspath(__file__))
 # Construct the path to the .env file
 dotenv_path = os.path.join(current_dir, ".env")
 
+ROOT_FOLDER = os.path.abspath(os.path.join(current_dir, "../.."))
+# The database folder can be moved with the DATABASE_FOLDER environment variable,
+# e.g. to run the benchmarks without touching the database of the project
+DATABASE_FOLDER = os.getenv("DATABASE_FOLDER", os.path.join(ROOT_FOLDER, "database"))
+DUCKDB_FILE = os.path.join(DATABASE_FOLDER, "data.duckdb")
+# DuckDB spills there the data which doesn't fit in its memory limit, see connect_duckdb
+DUCKDB_TEMP_FOLDER = DUCKDB_FILE + ".tmp"
+
 
 def load_env_variables():
+    # Imported here, the CLI only loads the .env file to run a task
+    from dotenv import load_dotenv
+
     load_dotenv(dotenv_path)
 
 
@@ -20,3 +29,58 @@ def get_environment(default="prod"):
 
 def get_s3_path(env, filename="data.duckdb"):
     return f"{env}/database/{filename}"
+
+
+# Resources used by DuckDB, selected with DUCKDB_PROFILE. The memory limit is a fraction
+# of the memory of the machine: beyond it, the big loads spill to the temp directory.
+# threads None uses every core.
+DUCKDB_PROFILES = {
+    # A runner dedicated to the job, with little memory (7 GB)
+    "ci": {"memory_fraction": 0.6, "threads": None},
+    # Leave some memory and a core to the other applications
+    "laptop": {"memory_fraction": 0.5, "threads": max(1, (os.cpu_count() or 2) - 1)},
+    "server": {"memory_fraction": 0.8, "threads": None},
+}
+
+
+def get_total_memory():
+    """Returns the physical memory of the machine in bytes, or None if unknown"""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def get_duckdb_config(default_temp_directory=None):
+    """
+    Returns the settings of the DuckDB connections, from the DUCKDB_PROFILE profile
+    (default "laptop"). DUCKDB_MEMORY_LIMIT (e.g. "4GB"), DUCKDB_THREADS and
+    DUCKDB_TEMP_DIRECTORY override the settings of the profile.
+    :param default_temp_directory: The folder where DuckDB spills, if DUCKDB_TEMP_DIRECTORY is not set
+    :return: dict to pass as the config of duckdb.connect
+    """
+    profile_name = os.getenv("DUCKDB_PROFILE", "laptop")
+    if profile_name not in DUCKDB_PROFILES:
+        raise ValueError(
+            f"Invalid DuckDB profile: {profile_name}. Must be one of {list(DUCKDB_PROFILES)}."
+        )
+    profile = DUCKDB_PROFILES[profile_name]
+
+    # The order of the rows is never relied upon, not preserving it saves memory
+    config = {"preserve_insertion_order": False}
+
+    memory_limit = os.getenv("DUCKDB_MEMORY_LIMIT")
+    total_memory = get_total_memory()
+    if memory_limit is None and total_memory:
+        memory_limit = f"{int(total_memory * profile['memory_fraction'] / 1024**2)}MB"
+    if memory_limit:
+        config["memory_limit"] = memory_limit
+
+    threads = os.getenv("DUCKDB_THREADS") or profile["threads"]
+    if threads:
+        config["threads"] = int(threads)
+
+    temp_directory = os.getenv("DUCKDB_TEMP_DIRECTORY", default_temp_directory)
+    if temp_directory:
+        config["temp_directory"] = temp_directory
+    return config
@@ -7,8 +7,6 @@ import click
 # Importer et charger les variables d'environnement depuis config.py
 from pipelines.config.config import get_environment, load_env_variables
 
-load_env_variables()
-
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -17,32 +15,319 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# The task modules import duckdb, boto3, pandas... and create the database folders:
+# they are only imported by the command running the task, never to list or describe them.
+TASKS_DIR = os.path.join(os.path.dirname(__file__), "tasks")
+
+
+def get_task_docstring(module_name: str) -> str:
+    """
+    Returns the docstring of a task module, read from its source without importing it
+    :param module_name: The name of the module in the tasks folder, e.g. "build_database"
+    :return: The docstring, or None if the module has none
+    """
+    import ast
+
+    with open(os.path.join(TASKS_DIR, f"{module_name}.py"), encoding="utf-8") as f:
+        return ast.get_docstring(ast.parse(f.read()))
+
+
+def split_list(cast=str):
+    """
+    Returns a click callback converting a comma-separated list, e.g. "2023, 2024"
+    :param cast: The type of the items of the list
+    """
+
+    def callback(ctx, param, value):
+        if not value:
+            return None
+        return [cast(item.strip()) for item in value.split(",")]
+
+    return callback
+
+
+def flag_option(*names: str, help: str) -> click.Option:
+    """Returns a boolean option, off by default"""
+    return click.Option(
+        names, is_flag=True, show_default=True, default=False, help=help
+    )
+
+
+def env_option(help: str) -> click.Option:
+    """Returns the --env option of the tasks downloading from or uploading to S3"""
+    return click.Option(
+        ["--env"],
+        type=click.Choice(["dev", "prod"]),
+        default=None,
+        help=f"{help} It will override environment defined in .env",
+    )
+
+
+WORKERS_HELP = "Number of years downloaded and extracted in parallel. A single connection writes to the database."
+STREAMING_HELP = "Stream the files from the zip archives into the database instead of extracting them on disk."
+DIFF_HELP = "Apply only the rows which changed to the years already loaded, instead of reloading them."
+
+# The tasks of the CLI, each one run by the execute() function of pipelines/tasks/<name>.py:
+#   - help: The description of the command
+#   - env: For the tasks taking --env, the environment used when neither --env nor ENV is set
+#   - options: The click options of the command, passed by name to execute()
+TASKS = {
+    "build_database": {
+        "help": "Run build_database task.",
+        "options": [
+            click.Option(
+                ["--refresh-type"],
+                type=click.Choice(["all", "last", "custom"]),
+                default="all",
+                help="Type of refresh to perform",
+            ),
+            click.Option(
+                ["--custom-years"],
+                type=str,
+                callback=split_list(),
+                help="Comma-separated list of years to process (for custom refresh type)",
+            ),
+            flag_option(
+                "--drop-tables",
+                help="Drop and re-create edc tables in the database before data insertion.",
+            ),
+            flag_option(
+                "--check-update",
+                help="Apply refresh-type only on the years whose data has been modified from the source.",
+            ),
+            click.Option(
+                ["--workers"],
+                type=click.IntRange(min=1),
+                show_default=True,
+                default=1,
+                help=WORKERS_HELP,
+            ),
+            flag_option("--streaming", help=STREAMING_HELP),
+            flag_option(
+                "--optimize", help="Compact and sort the database once it is built."
+            ),
+            flag_option("--diff", help=DIFF_HELP),
+        ],
+    },
+    "optimize_database": {
+        "help": "Compact and sort the database.",
+        "options": [],
+    },
+    "transform": {
+        "help": "Run transform task.",
+        "options": [
+            flag_option(
+                "--full-refresh",
+                help="Rebuild every dbt model and every year from scratch.",
+            ),
+            click.Option(
+                ["--partitions"],
+                type=str,
+                callback=split_list(int),
+                help="Comma-separated list of years to rebuild, instead of the years loaded since the last transform",
+            ),
+        ],
+    },
+    "download_database": {
+        "help": "Download database from S3.",
+        "env": "prod",
+        "options": [
+            env_option("Environment to download from."),
+            flag_option(
+                "--delta",
+                help="Download only the partition tables which differ from the local database.",
+            ),
+        ],
+    },
+    "download_database_https": {
+        "help": "Download database from S3 via HTTPS.",
+        "env": "prod",
+        "options": [
+            env_option("Environment to download from."),
+            click.Option(
+                ["--segments"],
+                type=click.IntRange(min=1),
+                show_default=True,
+                default=1,
+                help="Number of byte ranges downloaded in parallel.",
+            ),
+        ],
+    },
+    "upload_database": {
+        "help": "Upload database to S3.",
+        "env": "dev",
+        "options": [
+            env_option("Environment to upload to."),
+            flag_option(
+                "--delta",
+                help="Upload only the partition tables which changed since the last upload.",
+            ),
+        ],
+    },
+    "rollback_database": {
+        "help": "Switch the database back to a previous version.",
+        "options": [
+            click.Option(
+                ["--version"],
+                type=str,
+                default=None,
+                help="Name of the version to switch to (default the version before the current one).",
+            ),
+            flag_option(
+                "--list",
+                "list_versions",
+                help="Only list the versions of the database.",
+            ),
+        ],
+    },
+    "export_parquet": {
+        "help": "Export the EDC tables as Parquet files and upload them to S3.",
+        "env": "dev",
+        "options": [
+            env_option("Environment to upload to."),
+            flag_option(
+                "--by-dept",
+                help="Also partition by département the tables having a cddept column.",
+            ),
+            flag_option(
+                "--skip-upload",
+                help="Only write the Parquet files locally, in database/parquet.",
+            ),
+        ],
+    },
+    "export_map": {
+        "help": "Export the communes conformity map as GeoParquet files and upload them to S3.",
+        "env": "dev",
+        "options": [
+            env_option("Environment to upload to."),
+            click.Option(
+                ["--geometries", "geometries_file"],
+                type=click.Path(dir_okay=False),
+                default=None,
+                help="File of the commune geometries (default database/geo/communes.geojson).",
+            ),
+            click.Option(
+                ["--code-column"],
+                type=str,
+                show_default=True,
+                default="code",
+                help="Column of the geometries file holding the INSEE code of the commune.",
+            ),
+            click.Option(
+                ["--source-crs"],
+                type=str,
+                show_default=True,
+                default="EPSG:4326",
+                help="Coordinate reference system of the geometries file, e.g. EPSG:2154.",
+            ),
+            click.Option(
+                ["--year"],
+                type=int,
+                default=None,
+                help="Year of the conformity data (default the last year in the database).",
+            ),
+            flag_option(
+                "--skip-upload",
+                help="Only write the GeoParquet files locally, in database/map.",
+            ),
+        ],
+    },
+    "pipeline": {
+        "help": "Download, update and upload the database.",
+        "env": "dev",
+        "options": [
+            env_option("Environment to download from and upload to."),
+            click.Option(
+                ["--workers"],
+                type=click.IntRange(min=1),
+                show_default=True,
+                default=5,
+                help=WORKERS_HELP,
+            ),
+            flag_option("--streaming", help=STREAMING_HELP),
+            flag_option(
+                "--delta",
+                help="Download and upload only the partition tables which changed.",
+            ),
+            flag_option("--diff", help=DIFF_HELP),
+            flag_option(
+                "--optimize", help="Compact and sort the database once it is updated."
+            ),
+            flag_option(
+                "--transform",
+                help="Also rebuild the dbt models of the updated years before the upload. A failing dbt model or test stops the upload.",
+            ),
+            flag_option(
+                "--export-parquet",
+                "export",
+                help="Also export the EDC tables as Parquet files and upload them to S3.",
+            ),
+            flag_option(
+                "--resume", help="Continue the last run from the stage which failed."
+            ),
+        ],
+    },
+    "benchmark_ingestion": {
+        "help": "Benchmark the ingestion stages on synthetic EDC datasets.",
+        "options": [
+            click.Option(
+                ["--rows"],
+                type=click.IntRange(min=1),
+                show_default=True,
+                default=100_000,
+                help="Number of results (DIS_RESULT_ rows) generated for each year.",
+            ),
+            click.Option(
+                ["--years"],
+                type=str,
+                show_default=True,
+                default="2024",
+                callback=split_list(),
+                help="Comma-separated list of years to generate.",
+            ),
+            flag_option(
+                "--streaming",
+                help="Stream the files from the zip archives instead of extracting them.",
+            ),
+            click.Option(
+                ["--workers"],
+                type=click.IntRange(min=1),
+                show_default=True,
+                default=1,
+                help=WORKERS_HELP,
+            ),
+            flag_option("--dbt", help="Also benchmark the dbt models."),
+            click.Option(
+                ["--output"],
+                type=click.Path(dir_okay=False),
+                default=None,
+                help="Path of the JSON report.",
+            ),
+        ],
+    },
+}
+
 
 @click.group()
 def cli():
-    pass
+    # Not called for --help, which then only needs click
+    load_env_variables()
 
 
 @cli.command()
 def list():
     """List all available tasks."""
-    tasks_dir = os.path.join(os.path.dirname(__file__), "tasks")
+    for module_name in sorted(TASKS):
+        doc = get_task_docstring(module_name) or "No description"
+        doc_lines = doc.strip().split("\n")
+        while doc_lines and not doc_lines[0].strip():
+            doc_lines.pop(0)
+        while doc_lines and not doc_lines[-1].strip():
+            doc_lines.pop()
 
-    for filename in sorted(os.listdir(tasks_dir)):
-        if filename.endswith(".py") and not filename.startswith("_"):
-            module_name = filename[:-3]
-            module = importlib.import_module(f"tasks.{module_name}")
-
-            doc = module.__doc__ or "No description"
-            doc_lines = doc.strip().split("\n")
-            while doc_lines and not doc_lines[0].strip():
-                doc_lines.pop(0)
-            while doc_lines and not doc_lines[-1].strip():
-                doc_lines.pop()
-
-            click.echo(f"\n{module_name}:")
-            for line in doc_lines:
-                click.echo(f"    {line}")
+        click.echo(f"\n{module_name}:")
+        for line in doc_lines:
+            click.echo(f"    {line}")
 
 
 @cli.group()
@@ -51,101 +336,29 @@ def run():
     pass
 
 
-@run.command("build_database")
-@click.option(
-    "--refresh-type",
-    type=click.Choice(["all", "last", "custom"]),
-    default="all",
-    help="Type of refresh to perform",
-)
-@click.option(
-    "--custom-years",
-    type=str,
-    help="Comma-separated list of years to process (for custom refresh type)",
-)
-@click.option(
-    "--drop-tables",
-    is_flag=True,
-    show_default=True,
-    default=False,
-    help="Drop and re-create edc tables in the database before data insertion.",
-)
-@click.option(
-    "--check-update",
-    is_flag=True,
-    show_default=True,
-    default=False,
-    help="Apply refresh-type only on the years whose data has been modified from the source.",
-)
-def run_build_database(refresh_type, custom_years, drop_tables, check_update):
-    """Run build_database task."""
-    module = importlib.import_module("tasks.build_database")
-    task_func = getattr(module, "execute")
-
-    custom_years_list = None
-    if custom_years:
-        custom_years_list = [year.strip() for year in custom_years.split(",")]
-
-    task_func(
-        refresh_type=refresh_type,
-        custom_years=custom_years_list,
-        drop_tables=drop_tables,
-        check_update=check_update,
+def get_task_command(name: str, task: dict) -> click.Command:
+    """
+    Returns the command running a task of TASKS, importing its module only when it runs
+    :param name: The name of the task, e.g. "build_database"
+    :param task: The description of the task in TASKS
+    """
+
+    def run_task(**options):
+        if "env" in task:
+            if options["env"] is not None:
+                os.environ["ENV"] = options["env"]
+            options["env"] = get_environment(default=task["env"])
+            logger.info(f"Running on env {options['env']}")
+        module = importlib.import_module(f"pipelines.tasks.{name}")
+        module.execute(**options)
+
+    return click.Command(
+        name, callback=run_task, params=task["options"], help=task["help"]
     )
 
 
-@run.command("download_database")
-@click.option(
-    "--env",
-    type=click.Choice(["dev", "prod"]),
-    default=None,
-    help="Environment to download from. It will override environment defined in .env",
-)
-def run_download_database(env):
-    """Download database from S3."""
-    if env is not None:
-        os.environ["ENV"] = env
-    env = get_environment(default="prod")
-    logger.info(f"Running on env {env}")
-    module = importlib.import_module("tasks.download_database")
-    task_func = getattr(module, "execute")
-    task_func(env)
-
-
-@run.command("download_database_https")
-@click.option(
-    "--env",
-    type=click.Choice(["dev", "prod"]),
-    default=None,
-    help="Environment to download from. It will override environment defined in .env",
-)
-def run_download_database_https(env):
-    """Download database from S3 via HTTPS."""
-    if env is not None:
-        os.environ["ENV"] = env
-    env = get_environment(default="prod")
-    logger.info(f"Running on env {env}")
-    module = importlib.import_module("tasks.download_database_https")
-    task_func = getattr(module, "execute")
-    task_func(env)
-
-
-@run.command("upload_database")
-@click.option(
-    "--env",
-    type=click.Choice(["dev", "prod"]),
-    default=None,
-    help="Environment to upload to. It will override environment defined in .env",
-)
-def run_upload_database(env):
-    """Upload database to S3."""
-    if env is not None:
-        os.environ["ENV"] = env
-    env = get_environment(default="dev")
-    logger.info(f"Running on env {env}")
-    module = importlib.import_module("tasks.upload_database")
-    task_func = getattr(module, "execute")
-    task_func(env)
+for task_name, task in TASKS.items():
+    run.add_command(get_task_command(task_name, task))
 
 
 if __name__ == "__main__":
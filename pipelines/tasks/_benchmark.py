@@ -0,0 +1,196 @@
+"""
+Synthetic EDC datasets and a local stand-in for www.data.gouv.fr, used by benchmark_ingestion.
+
+The fixtures have the files and the columns described in _config_edc.py, with keys linking
+them like the real datasets: every result belongs to a prélèvement, every prélèvement to a
+réseau, and the réseaux supply the communes.
+"""
+
+import logging
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List
+from zipfile import ZIP_DEFLATED, ZipFile
+
+from pipelines.utils.connections import connect_duckdb
+
+from ._config_edc import create_edc_yearly_filename, get_edc_config
+
+logger = logging.getLogger(__name__)
+edc_config = get_edc_config()
+
+FIXTURES_DATASET_DATETIME = "20250101-000000"
+# Number of results per prélèvement, and of communes per réseau
+RESULTS_PER_PRELEVEMENT = 10
+COMMUNES_PER_RESEAU = 2
+
+# Values of the generated columns, as SQL expressions of the row number i and the year.
+# The columns of _config_edc.py missing here get a generic text value.
+COLUMNS_VALUES = {
+    "communes": {
+        "inseecommune": "lpad(CAST(i % 99999 AS VARCHAR), 5, '0')",
+        "nomcommune": "'Commune ' || i",
+        "cdreseau": "'R' || lpad(CAST(i // {communes_per_reseau} AS VARCHAR), 8, '0')",
+        "nomreseau": "'Réseau ' || i // {communes_per_reseau}",
+        "debutalim": "'{year}-01-01'",
+    },
+    "prelevements": {
+        "cddept": "lpad(CAST(i % 95 + 1 AS VARCHAR), 3, '0')",
+        "cdreseau": "'R' || lpad(CAST(i % {reseaux} AS VARCHAR), 8, '0')",
+        "inseecommuneprinc": "lpad(CAST(i % {reseaux} * {communes_per_reseau} % 99999 AS VARCHAR), 5, '0')",
+        "cdreseauamont": "'R' || lpad(CAST(i % {reseaux} AS VARCHAR), 8, '0')",
+        "pourcentdebit": "'100 %'",
+        "referenceprel": "'P' || lpad(CAST(i AS VARCHAR), 10, '0')",
+        "dateprel": "DATE '{year}-01-01' + CAST(i % 365 AS INTEGER)",
+        "heureprel": "'08h00'",
+        "conclusionprel": "'Eau conforme aux exigences de qualité.'",
+        "plvconformitebacterio": "'C'",
+        "plvconformitechimique": "'C'",
+        "plvconformitereferencebact": "'C'",
+        "plvconformitereferencechim": "'C'",
+    },
+    "resultats": {
+        "cddept": "lpad(CAST(i % {prelevements} % 95 + 1 AS VARCHAR), 3, '0')",
+        "referenceprel": "'P' || lpad(CAST(i % {prelevements} AS VARCHAR), 10, '0')",
+        "cdparametresiseeaux": "'PAR' || i // {prelevements}",
+        "cdparametre": "1000 + i // {prelevements}",
+        "qualitparam": "CASE WHEN i % 3 = 0 THEN 'O' ELSE 'N' END",
+        "insituana": "CASE WHEN i % 5 = 0 THEN 'T' ELSE 'L' END",
+        "rqana": "CAST(i % 1000 / 10 AS VARCHAR)",
+        "valtraduite": "CAST(hash(i) % 100000 AS DECIMAL(18, 3)) / 1000",
+        "referenceanl": "'A' || lpad(CAST(i AS VARCHAR), 10, '0')",
+    },
+}
+
+
+def get_fixtures_row_counts(rows: int) -> Dict[str, int]:
+    """
+    Returns the number of rows of each file of a synthetic dataset
+    :param rows: The number of results (DIS_RESULT_) of the dataset
+    :return: dict of edc_config["files"] key -> number of rows
+    """
+    prelevements = max(1, rows // RESULTS_PER_PRELEVEMENT)
+    return {
+        "communes": max(1, prelevements // RESULTS_PER_PRELEVEMENT),
+        "prelevements": prelevements,
+        "resultats": rows,
+    }
+
+
+def generate_edc_fixtures(folder: str, years: List[str], rows: int) -> Dict[str, str]:
+    """
+    Write the zip archives of a synthetic EDC dataset for several years.
+    The archives already present in the folder are kept, so that they are generated once
+    for a given number of rows.
+    :param folder: The folder of the fixtures. The archives are written like on
+        data.gouv.fr in <folder>/<dataset datetime>/<zipfile>.
+    :param years: The years to generate, among edc_config["source"]["yearly_files_infos"]
+    :param rows: The number of results (DIS_RESULT_) of each year
+    :return: dict of year -> path of the zip archive
+    """
+    row_counts = get_fixtures_row_counts(rows)
+    zip_files = {}
+    for year in years:
+        zip_file = os.path.join(
+            folder,
+            FIXTURES_DATASET_DATETIME,
+            edc_config["source"]["yearly_files_infos"][year]["zipfile"],
+        )
+        zip_files[year] = zip_file
+        if os.path.exists(zip_file):
+            continue
+
+        logger.info(f"Generating a synthetic EDC dataset of {rows} results for {year}")
+        values = {
+            "year": year,
+            "reseaux": max(1, row_counts["communes"] // COMMUNES_PER_RESEAU),
+            "prelevements": row_counts["prelevements"],
+            "communes_per_reseau": COMMUNES_PER_RESEAU,
+        }
+        csv_folder = zip_file + ".tmp"
+        os.makedirs(csv_folder, exist_ok=True)
+        conn = connect_duckdb(":memory:")
+        try:
+            with ZipFile(zip_file + ".part", "w", ZIP_DEFLATED) as zip_ref:
+                for file_key, file_info in edc_config["files"].items():
+                    columns = ",\n".join(
+                        COLUMNS_VALUES[file_key]
+                        .get(column, f"'{column} ' || i % 97")
+                        .format(**values)
+                        + f" AS {column}"
+                        for column in file_info["column_types"]
+                    )
+                    filename = create_edc_yearly_filename(
+                        file_name_prefix=file_info["file_name_prefix"],
+                        file_extension=file_info["file_extension"],
+                        year=year,
+                    )
+                    csv_file = os.path.join(csv_folder, filename)
+                    query = f"""
+                        COPY (
+                            SELECT {columns}
+                            FROM range({row_counts[file_key]}) t(i)
+                        ) TO '{csv_file}' (HEADER, DELIMITER ',')
+                        ;
+                    """
+                    conn.execute(query)
+                    zip_ref.write(csv_file, filename)
+                    os.remove(csv_file)
+        finally:
+            conn.close()
+            shutil.rmtree(csv_folder, ignore_errors=True)
+        os.replace(zip_file + ".part", zip_file)
+    return zip_files
+
+
+class _FixturesRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serves the fixtures folder, and redirects the dataset urls (/r/<id>) to the zip
+    archive of the dataset, like data.gouv.fr does.
+    """
+
+    def _redirect(self) -> bool:
+        for infos in edc_config["source"]["yearly_files_infos"].values():
+            if self.path == f"/r/{infos['id']}":
+                self.send_response(302)
+                self.send_header(
+                    "Location", f"/{FIXTURES_DATASET_DATETIME}/{infos['zipfile']}"
+                )
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return True
+        return False
+
+    def do_HEAD(self):
+        if not self._redirect():
+            super().do_HEAD()
+
+    def do_GET(self):
+        if not self._redirect():
+            super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def serve_edc_fixtures(folder: str) -> Iterator[str]:
+    """
+    Serve the fixtures folder over HTTP on a free local port, in a background thread
+    :param folder: The folder of the fixtures, see generate_edc_fixtures
+    :return: The base url to use instead of edc_config["source"]["base_url"]
+    """
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(_FixturesRequestHandler, directory=folder)
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}/r/"
+    finally:
+        server.shutdown()
+        server.server_close()
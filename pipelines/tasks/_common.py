@@ -1,18 +1,48 @@
+import json
+import logging
 import os
 import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 import requests
-from typing import Union
+from typing import Iterator, Optional, Union
+from zipfile import ZipFile
 from tqdm import tqdm
 
-ROOT_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
-DATABASE_FOLDER = os.path.join(ROOT_FOLDER, "database")
-DUCKDB_FILE = os.path.join(DATABASE_FOLDER, "data.duckdb")
-CACHE_FOLDER = os.path.join(ROOT_FOLDER, "database", "cache")
+# The paths of the database are defined in config.py, the tasks import them from here
+from pipelines.config.config import DATABASE_FOLDER, DUCKDB_FILE, ROOT_FOLDER  # noqa: F401
+from pipelines.utils.connections import get_http_session, with_retries
+from pipelines.utils.instrumentation import span
+
+CACHE_FOLDER = os.path.join(DATABASE_FOLDER, "cache")
+# dbt project building the models on top of the EDC tables, see transform
+DBT_FOLDER = os.path.join(ROOT_FOLDER, "dbt_")
+# Parquet export of the EDC tables, see export_parquet
+PARQUET_FOLDER = os.path.join(DATABASE_FOLDER, "parquet")
+# Source files converted once to Parquet, see _raw.py
+RAW_FOLDER = os.path.join(DATABASE_FOLDER, "raw")
+# GeoParquet files of the webapp map, see export_map
+MAP_FOLDER = os.path.join(DATABASE_FOLDER, "map")
+# Downloaded files are kept between runs in this folder, see get_cache_path
+DOWNLOAD_CACHE_FOLDER = os.path.join(CACHE_FOLDER, "downloads")
+# Maximum size of the download cache, the least recently used files are evicted first
+CACHE_MAX_SIZE = int(float(os.getenv("CACHE_MAX_SIZE_GB", "10")) * 1024**3)
+HEADERS_SUFFIX = ".headers.json"
+PART_SUFFIX = ".part"
+SEGMENTS_SUFFIX = ".segments.json"
+
+# HTTP downloads settings
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = (10, 60)  # connect and read timeouts in seconds
 
 os.makedirs(CACHE_FOLDER, exist_ok=True)
 os.makedirs(DATABASE_FOLDER, exist_ok=True)
 
+logger = logging.getLogger(__name__)
+
 # common style for the progressbar dans cli
 tqdm_common = {
     "ncols": 100,
@@ -20,34 +50,402 @@ tqdm_common = {
 }
 
 
-def clear_cache(recreate_folder: bool = True):
-    """Clear the cache folder."""
-    shutil.rmtree(CACHE_FOLDER)
-    if recreate_folder:
-        os.makedirs(CACHE_FOLDER, exist_ok=True)
+def quote_identifier(name: str) -> str:
+    """
+    Returns a column or table name quoted for a duckdb query, for the names which can't
+    be passed as parameters. The double quotes in the name are doubled.
+    :param name: The name to quote
+    :return: The quoted name
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+def get_cache_path(*keys: str) -> str:
+    """
+    Returns the path of an entry of the persistent download cache.
+    Entries are content-addressed: the keys should identify the content of the file
+    (e.g. dataset id and source datetime), so that an existing entry never needs
+    to be downloaded again.
+    :param keys: The keys of the entry, the last one being the filename.
+    :return: The path of the entry, its parent folder is created if needed.
+    """
+    path = os.path.join(DOWNLOAD_CACHE_FOLDER, *keys)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def evict_cache(max_size: int = CACHE_MAX_SIZE):
+    """
+    Removes the least recently used entries of the download cache
+    until its total size is below max_size.
+    The files of the downloads in progress (.part and their state) are not entries:
+    they are never removed, so that a download is not removed from under its writer.
+    :param max_size: The maximum size of the download cache in bytes.
+    """
+    entries = []
+    for folder, _, filenames in os.walk(DOWNLOAD_CACHE_FOLDER):
+        for filename in filenames:
+            if filename.endswith((HEADERS_SUFFIX, PART_SUFFIX, SEGMENTS_SUFFIX)):
+                continue
+            path = os.path.join(folder, filename)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        logger.info(f"Evicting {path} from the download cache")
+        os.remove(path)
+        if os.path.exists(path + HEADERS_SUFFIX):
+            os.remove(path + HEADERS_SUFFIX)
+        total_size -= size
+
+    # Remove the folders left empty by the eviction
+    for folder, _, _ in os.walk(DOWNLOAD_CACHE_FOLDER, topdown=False):
+        if folder != DOWNLOAD_CACHE_FOLDER and not os.listdir(folder):
+            os.rmdir(folder)
+
+
+def _read_json(path: Path) -> dict:
+    if not path.exists():
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _write_json(path: Path, data: dict):
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+
+def _get_validators(response: requests.Response) -> dict:
+    return {
+        "etag": response.headers.get("etag"),
+        "last_modified": response.headers.get("last-modified"),
+    }
+
+
+def _read_cached_headers(filepath: Path) -> dict:
+    """
+    Returns the validators (ETag, Last-Modified) saved when filepath was downloaded,
+    or an empty dict if the file was modified since or never fully downloaded.
+    """
+    if not filepath.exists():
+        return {}
+    cached = _read_json(Path(str(filepath) + HEADERS_SUFFIX))
+    stat = filepath.stat()
+    if cached.get("size") != stat.st_size or cached.get("mtime") != stat.st_mtime:
+        return {}
+    return cached
+
+
+def _download_stream(
+    session: requests.Session, url: str, part_path: Path, cached: dict
+) -> Optional[dict]:
+    """
+    Downloads url into part_path in a single stream.
+    If part_path already holds the beginning of the file, only the remaining bytes
+    are requested (Range / If-Range), otherwise the request is conditional on the
+    validators of the cached file.
+    :return: The validators of the downloaded file, or None if the cached file is not modified.
+    """
+    part_headers_path = Path(str(part_path) + HEADERS_SUFFIX)
+    offset = part_path.stat().st_size if part_path.exists() else 0
+    part_validators = _read_json(part_headers_path) if offset else {}
+
+    request_headers = {}
+    if part_validators.get("etag") or part_validators.get("last_modified"):
+        request_headers["Range"] = f"bytes={offset}-"
+        request_headers["If-Range"] = (
+            part_validators["etag"] or part_validators["last_modified"]
+        )
+    else:
+        if cached.get("etag"):
+            request_headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            request_headers["If-Modified-Since"] = cached["last_modified"]
+
+    with session.get(
+        url, stream=True, headers=request_headers, timeout=DOWNLOAD_TIMEOUT
+    ) as response:
+        if response.status_code == 416:
+            # The partial file doesn't match the remote file anymore: start over
+            part_path.unlink()
+            part_headers_path.unlink()
+            return _download_stream(session, url, part_path, cached)
+        response.raise_for_status()
+        if response.status_code == 304:
+            return None
 
+        validators = _get_validators(response)
+        content_length = int(response.headers.get("content-length", 0))
+        if response.status_code == 206:
+            mode = "ab"
+        else:
+            # The server ignored the range or the remote file has changed: start over
+            offset = 0
+            mode = "wb"
+            _write_json(part_headers_path, validators)
 
-def download_file_from_https(url: str, filepath: Union[str, Path]):
+        with open(part_path, mode) as f:
+            with tqdm(
+                total=offset + content_length,
+                initial=offset,
+                unit="B",
+                unit_scale=True,
+                desc=f"Processing file {part_path.stem}",
+                **tqdm_common,
+            ) as pbar:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    pbar.update(len(chunk))
+
+    return validators
+
+
+def _download_segments(
+    session: requests.Session, url: str, part_path: Path, cached: dict, segments: int
+) -> Optional[dict]:
+    """
+    Downloads url into part_path with several ranged requests running in parallel.
+    The progress of each segment is saved next to part_path, so that an interrupted
+    download resumes each segment where it stopped.
+    Falls back to a single stream if the server doesn't support ranges.
+    :return: The validators of the downloaded file, or None if the cached file is not modified.
+    """
+
+    def head():
+        response = session.head(url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+        return response
+
+    response = with_retries(head, f"Request of {part_path.stem}")
+    validators = _get_validators(response)
+    size = int(response.headers.get("content-length", 0))
+
+    if cached and any(
+        validators[key] and validators[key] == cached.get(key) for key in validators
+    ):
+        return None
+
+    if (
+        response.headers.get("accept-ranges") != "bytes"
+        or not (validators["etag"] or validators["last_modified"])
+        or size < segments * DOWNLOAD_CHUNK_SIZE
+    ):
+        logger.info(f"   Parallel download not possible for {url}, using one stream")
+        return with_retries(
+            lambda: _download_stream(session, response.url, part_path, cached),
+            f"Download of {part_path.stem}",
+        )
+
+    state_path = Path(str(part_path) + SEGMENTS_SUFFIX)
+    state = _read_json(state_path)
+    if not (
+        part_path.exists()
+        and part_path.stat().st_size == size
+        and state.get("size") == size
+        and state.get("validators") == validators
+    ):
+        # Nothing to resume: allocate the file and split it in segments
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+        bounds = [size * i // segments for i in range(segments + 1)]
+        state = {
+            "size": size,
+            "validators": validators,
+            # [first byte, last byte, number of bytes already downloaded]
+            "segments": [[bounds[i], bounds[i + 1] - 1, 0] for i in range(segments)],
+        }
+    state_lock = threading.Lock()
+    if_range = validators["etag"] or validators["last_modified"]
+
+    def save_state():
+        with state_lock:
+            _write_json(state_path, state)
+
+    def fetch_segment(segment: list):
+        start, end, _ = segment
+        if start + segment[2] > end:
+            return
+        request_headers = {"Range": f"bytes={start + segment[2]}-{end}"}
+        request_headers["If-Range"] = if_range
+        with session.get(
+            response.url,
+            stream=True,
+            headers=request_headers,
+            timeout=DOWNLOAD_TIMEOUT,
+        ) as segment_response:
+            segment_response.raise_for_status()
+            if segment_response.status_code != 206:
+                raise requests.HTTPError(
+                    f"The server didn't return the requested range of {url}, "
+                    f"the remote file may have changed during the download"
+                )
+            with open(part_path, "r+b") as f:
+                f.seek(start + segment[2])
+                for i, chunk in enumerate(
+                    segment_response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+                ):
+                    f.write(chunk)
+                    segment[2] += len(chunk)
+                    pbar.update(len(chunk))
+                    if i % 16 == 15:
+                        f.flush()
+                        save_state()
+
+    def fetch_segment_with_retries(segment: list):
+        try:
+            with_retries(
+                lambda: fetch_segment(segment), f"Download of {part_path.stem}"
+            )
+        finally:
+            save_state()
+
+    with tqdm(
+        total=size,
+        initial=sum(segment[2] for segment in state["segments"]),
+        unit="B",
+        unit_scale=True,
+        desc=f"Processing file {part_path.stem}",
+        **tqdm_common,
+    ) as pbar:
+        with ThreadPoolExecutor(max_workers=segments) as executor:
+            for future in [
+                executor.submit(fetch_segment_with_retries, segment)
+                for segment in state["segments"]
+            ]:
+                future.result()
+
+    state_path.unlink()
+    return validators
+
+
+def download_file_from_https(
+    url: str,
+    filepath: Union[str, Path],
+    segments: int = 1,
+    session: requests.Session = None,
+):
     """
     Downloads a file from a https link to a local file.
+    The file is first written to a ".part" file, so that an interrupted download
+    is resumed (HTTP Range) instead of started over on the next call.
+    If the local file was already downloaded from this url, the request is conditional
+    (If-None-Match / If-Modified-Since) and the file is kept as is when the server
+    answers that it has not been modified.
     :param url: The url where to download the file.
     :param filepath: The path to the local file.
+    :param segments: Number of byte ranges downloaded in parallel.
+        With 1 (default), the file is downloaded in a single stream.
+    :param session: The HTTP session to use. Defaults to the shared session of the pipeline.
     :return: Downloaded file filename.
     """
-    response = requests.get(url, stream=True)
-    response.raise_for_status()
-    response_size = int(response.headers.get("content-length", 0))
     filepath = Path(filepath)
-    with open(filepath, "wb") as f:
-        with tqdm(
-            total=response_size,
-            unit="B",
-            unit_scale=True,
-            desc=f"Processing file {filepath.name}",
-            **tqdm_common,
-        ) as pbar:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-                pbar.update(len(chunk))
-
-    return filepath.name
+    with span(
+        "download_file", url=url, file=filepath.name, segments=segments
+    ) as download_span:
+        headers_path = Path(str(filepath) + HEADERS_SUFFIX)
+        part_path = Path(str(filepath) + PART_SUFFIX)
+        if session is None:
+            session = get_http_session()
+
+        cached = _read_cached_headers(filepath)
+        if cached.get("url") != url:
+            cached = {}
+
+        if segments > 1:
+            validators = _download_segments(session, url, part_path, cached, segments)
+        else:
+            validators = with_retries(
+                lambda: _download_stream(session, url, part_path, cached),
+                f"Download of {filepath.name}",
+            )
+
+        if validators is None:
+            logger.info(f"   {filepath.name} not modified, using the local file")
+            download_span.set(bytes=0, not_modified=True)
+            # Mark the file as recently used for the cache eviction
+            os.utime(filepath)
+            cached["mtime"] = filepath.stat().st_mtime
+            _write_json(headers_path, cached)
+            return filepath.name
+
+        if headers_path.exists():
+            headers_path.unlink()
+        os.replace(part_path, filepath)
+        part_headers_path = Path(str(part_path) + HEADERS_SUFFIX)
+        if part_headers_path.exists():
+            part_headers_path.unlink()
+
+        # Save the validators only once the file is complete
+        stat = filepath.stat()
+        download_span.set(bytes=stat.st_size, not_modified=False)
+        _write_json(
+            headers_path,
+            {
+                "url": url,
+                **validators,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+            },
+        )
+
+        return filepath.name
+
+
+@contextmanager
+def stream_zip_member(zip_file: Union[str, Path], member: str) -> Iterator[str]:
+    """
+    Exposes a member of a zip archive as a named pipe (FIFO), so that it can be read
+    like a regular file (e.g. by duckdb read_csv) without being extracted on disk.
+    The member is decompressed in a background thread while the reader consumes it.
+    Only available on platforms supporting os.mkfifo.
+    :param zip_file: The path to the zip archive.
+    :param member: The name of the member to stream.
+    :return: The path of the named pipe, valid until the context exits.
+    """
+    with ZipFile(zip_file, "r") as zip_ref:
+        # Fail early if the member is missing, before anyone waits on the pipe
+        zip_ref.getinfo(member)
+
+    fifo_folder = tempfile.mkdtemp(dir=CACHE_FOLDER)
+    fifo_path = os.path.join(fifo_folder, os.path.basename(member))
+    os.mkfifo(fifo_path)
+    errors = []
+
+    def feed_fifo():
+        try:
+            # Open the pipe first so that the reader is never left waiting for a writer
+            with open(fifo_path, "wb") as dst, ZipFile(zip_file, "r") as zip_ref:
+                # The member can only be read once: a reader opening the file again
+                # (e.g. duckdb when reporting an error) gets an error instead of an empty file
+                os.unlink(fifo_path)
+                with zip_ref.open(member) as src:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+        except BrokenPipeError:
+            # The reader stopped before the end of the member
+            pass
+        except Exception as ex:
+            errors.append(ex)
+
+    writer = threading.Thread(target=feed_fifo, daemon=True)
+    writer.start()
+    try:
+        yield fifo_path
+    finally:
+        while writer.is_alive():
+            # The reader never opened the pipe (or left early): briefly open it
+            # ourselves so that the writer can stop
+            try:
+                fd = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+            except FileNotFoundError:
+                fd = None
+            writer.join(timeout=0.1)
+            if fd is not None:
+                os.close(fd)
+        shutil.rmtree(fifo_folder, ignore_errors=True)
+
+    if errors:
+        raise errors[0]
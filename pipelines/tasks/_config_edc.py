@@ -1,3 +1,4 @@
+import os
 from typing import Dict
 
 
@@ -9,12 +10,20 @@ def get_edc_config() -> Dict:
         https://www.data.gouv.fr/fr/datasets/r/84a67a3b-08a7-4001-98e6-231c74a98139
     :return: A dict with the config used for processing.
         The "source" part is related to the data.gouv datasource
-        The "files" part is related to the extracted files information and sql table names
+        The "files" part is related to the extracted files information, sql table names
+        and the types of the columns, so that duckdb stores the raw data in native types.
+        The "sort_keys" are the columns used to order the tables in optimize_database,
+        so that the queries filtering on them can skip most of the row groups.
+        The "natural_keys" are the columns identifying a row: in diff mode, a row deleted
+        and inserted with the same key is counted as updated.
     """
 
     edc_config = {
         "source": {
-            "base_url": "https://www.data.gouv.fr/fr/datasets/r/",
+            # Can be overridden to download the files from another server (e.g. benchmarks)
+            "base_url": os.getenv(
+                "EDC_BASE_URL", "https://www.data.gouv.fr/fr/datasets/r/"
+            ),
             "available_years": [
                 # "2016",
                 # "2017",
@@ -70,16 +79,70 @@ def get_edc_config() -> Dict:
                 "file_name_prefix": "DIS_COM_UDI_",
                 "file_extension": ".txt",
                 "table_name": "edc_communes",
+                "sort_keys": ["de_partition", "inseecommune", "cdreseau"],
+                "natural_keys": ["inseecommune", "quartier", "cdreseau"],
+                "column_types": {
+                    "inseecommune": "VARCHAR",
+                    "nomcommune": "VARCHAR",
+                    "quartier": "VARCHAR",
+                    "cdreseau": "VARCHAR",
+                    "nomreseau": "VARCHAR",
+                    "debutalim": "VARCHAR",
+                },
             },
             "prelevements": {
                 "file_name_prefix": "DIS_PLV_",
                 "file_extension": ".txt",
                 "table_name": "edc_prelevements",
+                "sort_keys": ["de_partition", "cddept", "cdreseau", "referenceprel"],
+                "natural_keys": ["referenceprel", "cdreseau"],
+                "column_types": {
+                    "cddept": "VARCHAR",
+                    "cdreseau": "VARCHAR",
+                    "inseecommuneprinc": "VARCHAR",
+                    "nomcommuneprinc": "VARCHAR",
+                    "cdreseauamont": "VARCHAR",
+                    "nomreseauamont": "VARCHAR",
+                    # Values like "100 %", cleaned in stg_edc__prevelevements
+                    "pourcentdebit": "VARCHAR",
+                    "referenceprel": "VARCHAR",
+                    "dateprel": "DATE",
+                    "heureprel": "VARCHAR",
+                    "conclusionprel": "VARCHAR",
+                    "ugelib": "VARCHAR",
+                    "distrlib": "VARCHAR",
+                    "moalib": "VARCHAR",
+                    "plvconformitebacterio": "VARCHAR",
+                    "plvconformitechimique": "VARCHAR",
+                    "plvconformitereferencebact": "VARCHAR",
+                    "plvconformitereferencechim": "VARCHAR",
+                },
             },
             "resultats": {
                 "file_name_prefix": "DIS_RESULT_",
                 "file_extension": ".txt",
                 "table_name": "edc_resultats",
+                "sort_keys": ["de_partition", "cddept", "referenceprel", "cdparametre"],
+                "natural_keys": ["referenceprel", "cdparametre", "referenceanl"],
+                "column_types": {
+                    "cddept": "VARCHAR",
+                    "referenceprel": "VARCHAR",
+                    "cdparametresiseeaux": "VARCHAR",
+                    "cdparametre": "INTEGER",
+                    "libmajparametre": "VARCHAR",
+                    "libminparametre": "VARCHAR",
+                    "libwebparametre": "VARCHAR",
+                    "qualitparam": "VARCHAR",
+                    "insituana": "VARCHAR",
+                    "rqana": "VARCHAR",
+                    "cdunitereferencesiseeaux": "VARCHAR",
+                    "cdunitereference": "VARCHAR",
+                    "limitequal": "VARCHAR",
+                    "refqual": "VARCHAR",
+                    "valtraduite": "DECIMAL(18, 3)",
+                    "casparam": "VARCHAR",
+                    "referenceanl": "VARCHAR",
+                },
             },
         },
     }
@@ -0,0 +1,78 @@
+"""
+The resources shared by the tasks of a pipeline run: a single duckdb connection to the
+database and the pooled HTTP session, instead of each step opening its own.
+
+Every task accepts a PipelineContext. When a task runs on its own, it opens a context
+and closes it when it ends; when several tasks run in a row, they share the same one.
+"""
+
+import logging
+from contextlib import contextmanager
+from typing import Iterator
+
+import duckdb
+import requests
+
+from pipelines.utils.connections import connect_duckdb, get_http_session
+
+from ._common import DUCKDB_FILE
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineContext:
+    """
+    Owns the duckdb connection of a pipeline run, opened on first use.
+    The connection must be released before another process (e.g. dbt) opens the
+    database, or before the database file is replaced, see release_connection.
+    The connection is opened on database_file: DUCKDB_FILE, or the new version of the
+    database being written, see new_database_version.
+    """
+
+    def __init__(self):
+        self._conn = None
+        self.database_file = DUCKDB_FILE
+
+    @property
+    def conn(self) -> duckdb.DuckDBPyConnection:
+        """The duckdb connection to database_file, opened with the resource profile"""
+        if self._conn is None:
+            self._conn = connect_duckdb(self.database_file)
+        return self._conn
+
+    @property
+    def http(self) -> requests.Session:
+        """The HTTP session, with its connection pool and its retries"""
+        return get_http_session()
+
+    def release_connection(self):
+        """
+        Close the duckdb connection and its lock on the database file.
+        It is opened again the next time it is used.
+        """
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def close(self):
+        self.release_connection()
+
+    def __enter__(self) -> "PipelineContext":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+@contextmanager
+def pipeline_context(context: PipelineContext = None) -> Iterator[PipelineContext]:
+    """
+    Returns the context of the run, or a new context closed on exit when the task runs alone
+    :param context: The context of the pipeline run, if any
+    :return: The context to use
+    """
+    if context is not None:
+        yield context
+        return
+    with PipelineContext() as context:
+        yield context
@@ -0,0 +1,195 @@
+"""
+The tasks writing the database (build_database, optimize_database, download_database...)
+never write to the file opened by the readers (the webapp, dbt, notebooks).
+
+Each of them writes a new version of the database in database/versions (a copy of the
+current version, or a downloaded file), and DUCKDB_FILE (database/data.duckdb) is then
+switched at once to this version: it is a symbolic link to the current version. The
+readers keep reading the previous version until they open the database again, and a
+failed task leaves the current version untouched. The last versions are kept, so that
+rollback_database can switch back to one of them instantly.
+"""
+
+import json
+import logging
+import os
+import shutil
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+from pipelines.utils.instrumentation import span
+
+from ._common import DATABASE_FOLDER, DUCKDB_FILE
+from ._context import PipelineContext
+
+logger = logging.getLogger(__name__)
+
+VERSIONS_FOLDER = os.path.join(DATABASE_FOLDER, "versions")
+# Number of versions kept for rollback_database, the current one included
+VERSIONS_TO_KEEP = int(os.getenv("DATABASE_VERSIONS_TO_KEEP", "3"))
+VERSION_PREFIX = "data_"
+VERSION_SUFFIX = ".duckdb"
+# The source of a downloaded version, e.g. the url and the validators of the remote file
+SOURCE_SUFFIX = ".source.json"
+
+
+def get_version_file(version_datetime: datetime) -> str:
+    """
+    Returns the path of the version of the database written at a datetime
+    For example: database/versions/data_20250101-120000-000000.duckdb
+    :param version_datetime: The datetime of the version
+    :return: The path of the version file
+    """
+    return os.path.join(
+        VERSIONS_FOLDER,
+        f"{VERSION_PREFIX}{version_datetime:%Y%m%d-%H%M%S-%f}{VERSION_SUFFIX}",
+    )
+
+
+def get_database_versions() -> List[str]:
+    """Returns the paths of the versions of the database, from the oldest to the newest"""
+    if not os.path.isdir(VERSIONS_FOLDER):
+        return []
+    return [
+        os.path.join(VERSIONS_FOLDER, filename)
+        for filename in sorted(os.listdir(VERSIONS_FOLDER))
+        if filename.startswith(VERSION_PREFIX) and filename.endswith(VERSION_SUFFIX)
+    ]
+
+
+def get_current_database_version() -> Optional[str]:
+    """
+    Returns the path of the version DUCKDB_FILE links to, or None if DUCKDB_FILE doesn't
+    exist or is a regular file (database written before the versions were introduced)
+    """
+    if not os.path.islink(DUCKDB_FILE):
+        return None
+    return os.path.join(VERSIONS_FOLDER, os.path.basename(os.readlink(DUCKDB_FILE)))
+
+
+def get_database_version_source(version_file: Optional[str]) -> Optional[Dict]:
+    """
+    Returns the source recorded for a version of the database, see write_database_version_source
+    :param version_file: The version of the database, e.g. get_current_database_version()
+    :return: The source, or None if the version was not downloaded (e.g. built locally)
+    """
+    if version_file is None or not os.path.exists(version_file + SOURCE_SUFFIX):
+        return None
+    with open(version_file + SOURCE_SUFFIX) as f:
+        return json.load(f)
+
+
+def write_database_version_source(version_file: str, source: Dict):
+    """
+    Record where a version of the database was downloaded from, next to it
+    :param version_file: The version of the database
+    :param source: The source, e.g. the url and the validators (ETag, Last-Modified)
+        of the remote file
+    """
+    with open(version_file + SOURCE_SUFFIX, "w") as f:
+        json.dump(source, f, indent=2)
+
+
+def remove_database_version(version_file: str):
+    """Remove a version of the database, its write-ahead log and its source"""
+    for path in (version_file, version_file + ".wal", version_file + SOURCE_SUFFIX):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def switch_database_version(version_file: str):
+    """
+    Make DUCKDB_FILE point to a version of the database, at once: the readers opening the
+    database see either the previous version or this one.
+    A DUCKDB_FILE written before the versions were introduced becomes the first version.
+    :param version_file: The version of the database, in VERSIONS_FOLDER
+    """
+    os.makedirs(VERSIONS_FOLDER, exist_ok=True)
+    if os.path.exists(DUCKDB_FILE) and not os.path.islink(DUCKDB_FILE):
+        previous_file = get_version_file(
+            datetime.fromtimestamp(os.path.getmtime(DUCKDB_FILE))
+        )
+        logger.info(f"Keeping the current database as the version {previous_file}")
+        try:
+            os.link(DUCKDB_FILE, previous_file)
+        except OSError:
+            shutil.copyfile(DUCKDB_FILE, previous_file)
+        # duckdb looks for the write-ahead log next to the path it opens
+        if os.path.exists(DUCKDB_FILE + ".wal"):
+            os.replace(DUCKDB_FILE + ".wal", previous_file + ".wal")
+
+    switch_path = DUCKDB_FILE + ".switch"
+    if os.path.lexists(switch_path):
+        os.remove(switch_path)
+    try:
+        # The link is relative, so that the database folder can be moved or mounted
+        os.symlink(os.path.relpath(version_file, DATABASE_FOLDER), switch_path)
+    except OSError:
+        # Symbolic links may require privileges on Windows: the version is copied
+        logger.warning(
+            "Symbolic links are not available, the version of the database is copied"
+        )
+        shutil.copyfile(version_file, switch_path)
+    os.replace(switch_path, DUCKDB_FILE)
+    logger.info(f"✅ {DUCKDB_FILE} -> {version_file}")
+
+
+def prune_database_versions(keep: int = VERSIONS_TO_KEEP):
+    """
+    Remove the oldest versions of the database, the current one is always kept
+    :param keep: The number of versions to keep
+    """
+    current_version = get_current_database_version()
+    versions = get_database_versions()
+    for version_file in versions[: max(len(versions) - keep, 0)]:
+        if version_file != current_version:
+            logger.info(f"Removing the old version {version_file}")
+            remove_database_version(version_file)
+
+
+@contextmanager
+def new_database_version(
+    context: PipelineContext, copy_current: bool = True
+) -> Iterator[str]:
+    """
+    Write a new version of the database, then switch DUCKDB_FILE to it if no error was raised.
+    The connection of the context is opened on the new version meanwhile. When a version
+    is already being written in this context, it is used as is, e.g. when build_database
+    optimizes the database it has just built.
+    :param context: The context of the pipeline run
+    :param copy_current: Whether the new version starts as a copy of the current database,
+        or as no file at all, e.g. to download the database into it
+    :return: The path of the new version
+    """
+    if context.database_file != DUCKDB_FILE:
+        yield context.database_file
+        return
+
+    context.release_connection()
+    os.makedirs(VERSIONS_FOLDER, exist_ok=True)
+    version_file = get_version_file(datetime.now())
+    try:
+        if copy_current and os.path.exists(DUCKDB_FILE):
+            current_file = os.path.realpath(DUCKDB_FILE)
+            with span("copy_database_version", bytes=os.path.getsize(current_file)):
+                logger.info(f"Copying the database into the version {version_file}")
+                shutil.copyfile(current_file, version_file)
+                if os.path.exists(current_file + ".wal"):
+                    shutil.copyfile(current_file + ".wal", version_file + ".wal")
+
+        context.database_file = version_file
+        try:
+            yield version_file
+        finally:
+            # The connection is closed, so that the version is checkpointed
+            context.release_connection()
+            context.database_file = DUCKDB_FILE
+    except BaseException:
+        logger.error(f"The current database is left untouched, removing {version_file}")
+        remove_database_version(version_file)
+        raise
+
+    if os.path.exists(version_file):
+        switch_database_version(version_file)
+        prune_database_versions()
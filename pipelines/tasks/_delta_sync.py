@@ -0,0 +1,396 @@
+"""
+Synchronize the database with the object storage one partition table at a time.
+
+Each table of the database is stored as a Parquet file whose name is a key of its
+content: a hash of its rows, which doesn't depend on their order, and of its columns,
+computed with duckdb on both sides (see get_table_key). A manifest lists the key of every
+table: only the tables whose content differs are transferred. The EDC partition tables
+(e.g. edc_resultats_2024) are listed with their year, the other tables (the ingestion
+state tables, the tables built by dbt, _transform_runs...) with their columns. The other
+views (e.g. created by dbt) are recreated from their definition, stored in the manifest.
+
+The files replaced by an upload are deleted by the next upload, so that a reader of the
+previous manifest can still download its files.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from graphlib import TopologicalSorter
+from typing import Dict, List
+
+import duckdb
+
+from pipelines.config.config import get_s3_path
+from pipelines.utils.storage_client import ObjectStorageClient
+
+from ._common import CACHE_FOLDER, DUCKDB_FILE
+from ._config_edc import get_edc_config
+from ._context import PipelineContext, pipeline_context
+from ._database_versions import new_database_version
+from ._ingestion_state import create_ingestion_state_tables
+from ._partitions import (
+    STAGING_SUFFIX,
+    get_partition_tables,
+    migrate_to_partition_tables,
+    refresh_partitioned_view,
+)
+
+logger = logging.getLogger(__name__)
+edc_config = get_edc_config()
+
+DELTA_FOLDER = "delta"
+MANIFEST_FILE = "manifest.json"
+TRANSFER_WORKERS = 4
+
+
+def get_table_schema(conn: duckdb.DuckDBPyConnection, table_name: str) -> str:
+    """Returns the columns of a table and their types, e.g. year INTEGER, name VARCHAR"""
+    query = """
+        SELECT string_agg(column_name || ' ' || data_type, ', ' ORDER BY ordinal_position)
+        FROM information_schema.columns
+        WHERE table_name = ?
+        ;
+    """
+    return conn.execute(query, (table_name,)).fetchone()[0]
+
+
+def get_partition_keys(conn: duckdb.DuckDBPyConnection) -> Dict[str, Dict]:
+    """
+    Returns the content key of every EDC partition table of the database
+    :param conn: The duckdb connection to use
+    :return: dict of partition table -> {"table_name", "year", "key"}, see get_table_key
+    """
+    partition_keys = {}
+    for file_info in edc_config["files"].values():
+        table_name = file_info["table_name"]
+        for partition_table in get_partition_tables(conn, table_name):
+            partition_keys[partition_table] = {
+                "table_name": table_name,
+                "year": partition_table[len(table_name) + 1 :],
+                "key": get_table_key(conn, partition_table),
+            }
+    return partition_keys
+
+
+def get_other_tables(conn: duckdb.DuckDBPyConnection) -> List[str]:
+    """
+    Returns the tables of the database which are not EDC partition tables,
+    e.g. the ingestion state tables and the tables built by dbt
+    :param conn: The duckdb connection to use
+    :return: The list of the table names
+    """
+    partition_tables = {
+        partition_table
+        for file_info in edc_config["files"].values()
+        for partition_table in get_partition_tables(conn, file_info["table_name"])
+    }
+    query = """
+        SELECT table_name
+        FROM information_schema.tables
+        WHERE table_catalog = current_database()
+            AND table_schema = 'main'
+            AND table_type = 'BASE TABLE'
+        ORDER BY table_name
+        ;
+    """
+    conn.execute(query)
+    return [
+        table_name
+        for (table_name,) in conn.fetchall()
+        if table_name not in partition_tables
+        and not table_name.endswith(STAGING_SUFFIX)
+    ]
+
+
+def get_table_key(conn: duckdb.DuckDBPyConnection, table_name: str) -> str:
+    """
+    Returns a key of the content of a table, which doesn't depend on the order of its rows
+    :param conn: The duckdb connection to use
+    :param table_name: The table name
+    :return: The key
+    """
+    query = f"SELECT COUNT(*), SUM(CAST(hash(t) AS HUGEINT)) FROM {table_name} AS t;"
+    row_count, rows_hash = conn.execute(query).fetchone()
+    columns = get_table_schema(conn, table_name)
+    return hashlib.sha256(f"{columns}|{row_count}|{rows_hash}".encode()).hexdigest()
+
+
+def get_views(conn: duckdb.DuckDBPyConnection) -> Dict[str, str]:
+    """
+    Returns the views of the database other than the views of the EDC tables,
+    e.g. the views built by dbt
+    :param conn: The duckdb connection to use
+    :return: dict of view name -> CREATE VIEW statement
+    """
+    query = """
+        SELECT view_name, sql
+        FROM duckdb_views()
+        WHERE database_name = current_database()
+            AND schema_name = 'main'
+            AND NOT internal
+            AND NOT temporary
+            AND view_name NOT IN (SELECT UNNEST(?))
+        ORDER BY view_name
+        ;
+    """
+    edc_views = [file_info["table_name"] for file_info in edc_config["files"].values()]
+    conn.execute(query, (edc_views,))
+    return dict(conn.fetchall())
+
+
+def get_views_order(views: Dict[str, str]) -> List[str]:
+    """
+    Returns the order in which the views can be created, each one after the views
+    whose name appears in its definition
+    :param views: dict of view name -> CREATE VIEW statement, see get_views
+    :return: The names of the views in order
+    """
+    graph = {
+        view_name: [
+            other
+            for other in views
+            if other != view_name and re.search(rf"\b{re.escape(other)}\b", sql)
+        ]
+        for view_name, sql in views.items()
+    }
+    return list(TopologicalSorter(graph).static_order())
+
+
+def get_remote_manifest(s3: ObjectStorageClient, env: str) -> Dict:
+    """Returns the manifest of the database stored in the object storage, or None"""
+    file_key = get_s3_path(env, f"{DELTA_FOLDER}/{MANIFEST_FILE}")
+    if s3.get_object_hashes(file_key) is None:
+        return None
+    return s3.read_object_as_json(file_key)
+
+
+def upload_database_delta(env: str, context: PipelineContext = None):
+    """
+    Upload the partition tables of the database which changed since the last upload
+    :param env: The environment to upload to
+    :param context: The context of the pipeline run. If None, a new context is opened.
+    """
+    s3 = ObjectStorageClient()
+    remote_manifest = get_remote_manifest(s3, env) or {
+        "tables": {},
+        "other_tables": {},
+    }
+    local_folder = os.path.join(CACHE_FOLDER, DELTA_FOLDER)
+    shutil.rmtree(local_folder, ignore_errors=True)
+    os.makedirs(local_folder)
+
+    manifest = {
+        "generated_at": datetime.now().isoformat(timespec="seconds"),
+        "tables": {},
+        "other_tables": {},
+        "views": {},
+    }
+    to_upload = []
+    with pipeline_context(context) as context:
+        conn = context.conn
+        for partition_table, partition in get_partition_keys(conn).items():
+            remote_table = remote_manifest["tables"].get(partition_table)
+            key = partition["key"]
+            if remote_table is not None and remote_table["key"] == key:
+                manifest["tables"][partition_table] = remote_table
+                continue
+            local_path = os.path.join(local_folder, f"{partition_table}.parquet")
+            query = f"COPY {partition_table} TO '{local_path}' (FORMAT PARQUET, COMPRESSION ZSTD);"
+            conn.execute(query)
+            file = f"{DELTA_FOLDER}/{partition['table_name']}/{partition['year']}-{key}.parquet"
+            manifest["tables"][partition_table] = {
+                "table_name": partition["table_name"],
+                "year": partition["year"],
+                "key": key,
+                "file": file,
+                "byte_size": os.path.getsize(local_path),
+            }
+            to_upload.append((local_path, file))
+
+        for table_name in get_other_tables(conn):
+            key = get_table_key(conn, table_name)
+            remote_table = remote_manifest.get("other_tables", {}).get(table_name)
+            if remote_table is not None and remote_table["key"] == key:
+                manifest["other_tables"][table_name] = remote_table
+                continue
+            local_path = os.path.join(local_folder, f"{table_name}.parquet")
+            query = f"COPY {table_name} TO '{local_path}' (FORMAT PARQUET, COMPRESSION ZSTD);"
+            conn.execute(query)
+            file = f"{DELTA_FOLDER}/{table_name}/{key}.parquet"
+            manifest["other_tables"][table_name] = {
+                "key": key,
+                "file": file,
+                "columns": get_table_schema(conn, table_name),
+                "byte_size": os.path.getsize(local_path),
+            }
+            to_upload.append((local_path, file))
+
+        manifest["views"] = get_views(conn)
+
+    logger.info(
+        f"Uploading {len(to_upload)} changed tables out of "
+        f"{len(manifest['tables']) + len(manifest['other_tables'])}..."
+    )
+    with ThreadPoolExecutor(max_workers=TRANSFER_WORKERS) as executor:
+        for future in [
+            executor.submit(
+                s3.upload_object,
+                local_path=local_path,
+                file_key=get_s3_path(env, file),
+                public_read=True,
+            )
+            for local_path, file in to_upload
+        ]:
+            future.result()
+
+    # The files replaced by this upload are kept until the next one, for the readers
+    # of the previous manifest
+    files = {
+        table["file"]
+        for tables in (manifest["tables"], manifest["other_tables"])
+        for table in tables.values()
+    }
+    manifest["previous_files"] = sorted(
+        {
+            table["file"]
+            for tables in (remote_manifest["tables"], remote_manifest["other_tables"])
+            for table in tables.values()
+        }
+        - files
+    )
+
+    # The manifest is uploaded last, so that it never lists a file not uploaded yet
+    manifest_path = os.path.join(local_folder, MANIFEST_FILE)
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    s3.upload_object(
+        local_path=manifest_path,
+        file_key=get_s3_path(env, f"{DELTA_FOLDER}/{MANIFEST_FILE}"),
+        public_read=True,
+    )
+
+    # The files replaced by the previous upload are not listed by any manifest anymore
+    for file in remote_manifest.get("previous_files", []):
+        if file not in files:
+            s3.delete_object(get_s3_path(env, file))
+
+    shutil.rmtree(local_folder, ignore_errors=True)
+    logger.info(
+        f"✅ Base uploadée sur s3://{s3.bucket_name}/{get_s3_path(env, DELTA_FOLDER)}"
+    )
+
+
+def download_database_delta(env: str, context: PipelineContext = None):
+    """
+    Download the partition tables which differ from the local database, and replace them
+    :param env: The environment to download from
+    :param context: The context of the pipeline run. If None, a new context is opened.
+    """
+    s3 = ObjectStorageClient()
+    manifest = get_remote_manifest(s3, env)
+    if manifest is None:
+        raise ValueError(
+            f"No delta manifest found for env {env}, upload the database with --delta first"
+        )
+    if "other_tables" not in manifest:
+        raise ValueError(
+            f"The delta manifest of env {env} doesn't list the tables other than the EDC "
+            "partitions, upload the database with --delta again"
+        )
+    local_folder = os.path.join(CACHE_FOLDER, DELTA_FOLDER)
+    shutil.rmtree(local_folder, ignore_errors=True)
+    os.makedirs(local_folder)
+
+    # The tables are replaced in a new version, the readers keep the current one meanwhile
+    with pipeline_context(context) as context, new_database_version(context):
+        conn = context.conn
+        try:
+            for file_info in edc_config["files"].values():
+                migrate_to_partition_tables(
+                    conn=conn, table_name=file_info["table_name"]
+                )
+            create_ingestion_state_tables(conn)
+            local_keys = get_partition_keys(conn)
+            local_tables = get_other_tables(conn)
+
+            to_download = {
+                partition_table: table["file"]
+                for partition_table, table in manifest["tables"].items()
+                if partition_table not in local_keys
+                or local_keys[partition_table]["key"] != table["key"]
+            }
+            to_download.update(
+                {
+                    table_name: table["file"]
+                    for table_name, table in manifest["other_tables"].items()
+                    if table_name not in local_tables
+                    or get_table_key(conn, table_name) != table["key"]
+                }
+            )
+            remote_tables = {**manifest["tables"], **manifest["other_tables"]}
+            download_size = sum(
+                remote_tables[table_name]["byte_size"] for table_name in to_download
+            )
+            logger.info(
+                f"Downloading {len(to_download)} changed tables out of "
+                f"{len(remote_tables)} ({download_size / 1024**2:.1f} MB)..."
+            )
+            local_paths = {
+                table: os.path.join(local_folder, os.path.basename(file))
+                for table, file in to_download.items()
+            }
+            with ThreadPoolExecutor(max_workers=TRANSFER_WORKERS) as executor:
+                for future in [
+                    executor.submit(
+                        s3.download_object, get_s3_path(env, file), local_paths[table]
+                    )
+                    for table, file in to_download.items()
+                ]:
+                    future.result()
+
+            # The local database is updated in a single transaction
+            conn.begin()
+            try:
+                for partition_table in manifest["tables"]:
+                    if partition_table in local_paths:
+                        query = f"CREATE OR REPLACE TABLE {partition_table} AS SELECT * FROM read_parquet(?);"
+                        conn.execute(query, (local_paths[partition_table],))
+                for partition_table in set(local_keys) - set(manifest["tables"]):
+                    conn.execute(f"DROP TABLE {partition_table};")
+                for table_name, table in manifest["other_tables"].items():
+                    if table_name not in local_paths:
+                        continue
+                    # The tables created by the pipeline keep their definition
+                    if (
+                        table_name in local_tables
+                        and get_table_schema(conn, table_name) == table["columns"]
+                    ):
+                        conn.execute(f"DELETE FROM {table_name};")
+                        query = f"INSERT INTO {table_name} BY NAME SELECT * FROM read_parquet(?);"
+                    else:
+                        query = f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM read_parquet(?);"
+                    conn.execute(query, (local_paths[table_name],))
+                for table_name in set(local_tables) - set(manifest["other_tables"]):
+                    conn.execute(f"DROP TABLE {table_name};")
+                for file_info in edc_config["files"].values():
+                    refresh_partitioned_view(conn, file_info["table_name"])
+                for view_name in get_views(conn):
+                    conn.execute(f"DROP VIEW {view_name};")
+                for view_name in get_views_order(manifest["views"]):
+                    conn.execute(manifest["views"][view_name])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        finally:
+            shutil.rmtree(local_folder, ignore_errors=True)
+
+    logger.info(
+        f"✅ Base téléchargée depuis s3://{s3.bucket_name}/{get_s3_path(env, DELTA_FOLDER)} -> {DUCKDB_FILE}"
+    )
@@ -0,0 +1,318 @@
+import uuid
+from typing import Dict, List, Optional
+
+import duckdb
+
+INGESTION_RUNS_TABLE = "_ingestion_runs"
+PARTITION_STATE_TABLE = "_partition_state"
+TRANSFORM_RUNS_TABLE = "_transform_runs"
+PARTITION_CHANGES_TABLE = "_partition_changes"
+
+
+def create_ingestion_state_tables(conn: duckdb.DuckDBPyConnection):
+    """
+    Create the tables keeping track of the ingestion in the duckdb database, if needed.
+        - _ingestion_runs: one row per run of build_database, with its throughput
+        - _partition_state: one row per table and partition (year), describing the
+          source version currently loaded
+        - _transform_runs: one row per run of transform, with the partitions rebuilt by dbt
+        - _partition_changes: one row per partition updated in diff mode, with the
+          number of rows inserted, updated and deleted
+    :param conn: The duckdb connection to use
+    """
+    query = f"""
+        CREATE TABLE IF NOT EXISTS {INGESTION_RUNS_TABLE} (
+            run_id              VARCHAR PRIMARY KEY,
+            started_at          TIMESTAMP,
+            finished_at         TIMESTAMP,
+            status              VARCHAR,
+            refresh_type        VARCHAR,
+            years               VARCHAR[],
+            row_count           BIGINT,
+            byte_size           BIGINT,
+            load_duration       DOUBLE
+        );
+    """
+    conn.execute(query)
+    query = f"""
+        CREATE TABLE IF NOT EXISTS {PARTITION_STATE_TABLE} (
+            table_name          VARCHAR,
+            de_partition        INTEGER,
+            dataset_datetime    VARCHAR,
+            row_count           BIGINT,
+            byte_size           BIGINT,
+            load_duration       DOUBLE,
+            checksum            VARCHAR,
+            run_id              VARCHAR,
+            loaded_at           TIMESTAMP,
+            PRIMARY KEY (table_name, de_partition)
+        );
+    """
+    conn.execute(query)
+    query = f"""
+        CREATE TABLE IF NOT EXISTS {TRANSFORM_RUNS_TABLE} (
+            run_id              VARCHAR PRIMARY KEY,
+            started_at          TIMESTAMP,
+            finished_at         TIMESTAMP,
+            status              VARCHAR,
+            partitions          INTEGER[]
+        );
+    """
+    conn.execute(query)
+    query = f"""
+        CREATE TABLE IF NOT EXISTS {PARTITION_CHANGES_TABLE} (
+            table_name          VARCHAR,
+            de_partition        INTEGER,
+            dataset_datetime    VARCHAR,
+            rows_inserted       BIGINT,
+            rows_updated        BIGINT,
+            rows_deleted        BIGINT,
+            run_id              VARCHAR,
+            applied_at          TIMESTAMP
+        );
+    """
+    conn.execute(query)
+
+
+def check_ingestion_state_tables(conn: duckdb.DuckDBPyConnection) -> bool:
+    """
+    Check if the tables keeping track of the ingestion exist in the duckdb database
+    :param conn: The duckdb connection to use
+    :return: True if they exist, False if not (e.g. database built before they were added)
+    """
+    query = """
+        SELECT COUNT(*)
+        FROM information_schema.tables
+        WHERE table_name IN (?, ?)
+        ;
+    """
+    conn.execute(query, (INGESTION_RUNS_TABLE, PARTITION_STATE_TABLE))
+    return conn.fetchone()[0] == 2
+
+
+def start_ingestion_run(
+    conn: duckdb.DuckDBPyConnection, refresh_type: str, years: List[str]
+) -> str:
+    """
+    Record the start of a build_database run
+    :param conn: The duckdb connection to use
+    :param refresh_type: The refresh type of the run
+    :param years: The years processed by the run
+    :return: The id of the run
+    """
+    create_ingestion_state_tables(conn)
+    run_id = str(uuid.uuid4())
+    query = f"""
+        INSERT INTO {INGESTION_RUNS_TABLE} (run_id, started_at, status, refresh_type, years)
+        VALUES (?, current_localtimestamp(), 'running', ?, ?);
+    """
+    conn.execute(query, (run_id, refresh_type, years))
+    return run_id
+
+
+def finish_ingestion_run(conn: duckdb.DuckDBPyConnection, run_id: str, status: str):
+    """
+    Record the end of a build_database run and its throughput
+    :param conn: The duckdb connection to use
+    :param run_id: The id of the run
+    :param status: "success" or "failed"
+    """
+    query = f"""
+        UPDATE {INGESTION_RUNS_TABLE}
+        SET
+            finished_at = current_localtimestamp(),
+            status = $status,
+            row_count = loads.row_count,
+            byte_size = loads.byte_size,
+            load_duration = loads.load_duration
+        FROM (
+            SELECT
+                COALESCE(SUM(row_count), 0)         AS row_count,
+                COALESCE(SUM(byte_size), 0)         AS byte_size,
+                COALESCE(SUM(load_duration), 0)     AS load_duration
+            FROM {PARTITION_STATE_TABLE}
+            WHERE run_id = $run_id
+        ) AS loads
+        WHERE run_id = $run_id;
+    """
+    conn.execute(query, {"status": status, "run_id": run_id})
+
+
+def record_partition_state(
+    conn: duckdb.DuckDBPyConnection,
+    table_name: str,
+    year: str,
+    dataset_datetime: str,
+    row_count: int,
+    byte_size: int,
+    load_duration: float,
+    checksum: str,
+    run_id: Optional[str] = None,
+):
+    """
+    Record the source version loaded in one partition of a table
+    :param conn: The duckdb connection to use
+    :param table_name: The table loaded
+    :param year: The partition loaded
+    :param dataset_datetime: The dataset datetime as found on www.data.gouv.fr
+    :param row_count: Number of rows loaded
+    :param byte_size: Size of the source file in bytes
+    :param load_duration: Duration of the load in seconds
+    :param checksum: Checksum of the source file
+    :param run_id: The id of the build_database run
+    """
+    create_ingestion_state_tables(conn)
+    query = f"""
+        INSERT OR REPLACE INTO {PARTITION_STATE_TABLE}
+        VALUES (?, CAST(? AS INTEGER), ?, ?, ?, ?, ?, ?, current_localtimestamp());
+    """
+    conn.execute(
+        query,
+        (
+            table_name,
+            year,
+            dataset_datetime,
+            row_count,
+            byte_size,
+            load_duration,
+            checksum,
+            run_id,
+        ),
+    )
+
+
+def record_partition_changes(
+    conn: duckdb.DuckDBPyConnection,
+    table_name: str,
+    year: str,
+    dataset_datetime: str,
+    changes: Dict[str, int],
+    run_id: Optional[str] = None,
+):
+    """
+    Record the rows changed in one partition of a table by a load in diff mode
+    :param conn: The duckdb connection to use
+    :param table_name: The table loaded
+    :param year: The partition loaded
+    :param dataset_datetime: The dataset datetime as found on www.data.gouv.fr
+    :param changes: dict with the number of rows "inserted", "updated" and "deleted"
+    :param run_id: The id of the build_database run
+    """
+    create_ingestion_state_tables(conn)
+    query = f"""
+        INSERT INTO {PARTITION_CHANGES_TABLE}
+        VALUES (?, CAST(? AS INTEGER), ?, ?, ?, ?, ?, current_localtimestamp());
+    """
+    conn.execute(
+        query,
+        (
+            table_name,
+            year,
+            dataset_datetime,
+            changes["inserted"],
+            changes["updated"],
+            changes["deleted"],
+            run_id,
+        ),
+    )
+
+
+def delete_partition_state(conn: duckdb.DuckDBPyConnection, table_name: str):
+    """
+    Forget the partitions of a table, e.g. when the table is dropped
+    :param conn: The duckdb connection to use
+    :param table_name: The table whose partitions are forgotten
+    """
+    create_ingestion_state_tables(conn)
+    query = f"DELETE FROM {PARTITION_STATE_TABLE} WHERE table_name = ?;"
+    conn.execute(query, (table_name,))
+
+
+def get_partitions_dataset_datetime(
+    conn: duckdb.DuckDBPyConnection, table_name: str, years: List[str]
+) -> Dict[str, str]:
+    """
+    Return the dataset datetime recorded in _partition_state for the requested years
+    :param conn: The duckdb connection to use
+    :param table_name: The table to look for
+    :param years: The partitions to look for
+    :return: dict of year -> dataset datetime, for the years recorded in _partition_state
+    """
+    if not check_ingestion_state_tables(conn):
+        return {}
+
+    query = f"""
+        SELECT CAST(de_partition AS VARCHAR), dataset_datetime
+        FROM {PARTITION_STATE_TABLE}
+        WHERE table_name = ?
+            AND de_partition IN (SELECT CAST(UNNEST(?) AS INTEGER))
+        ;
+    """
+    conn.execute(query, (table_name, years))
+    return dict(conn.fetchall())
+
+
+def get_changed_partitions(conn: duckdb.DuckDBPyConnection) -> Optional[List[int]]:
+    """
+    Return the partitions (years) loaded by build_database since the start of the last
+    successful transform run, i.e. the partitions whose dbt models are out of date
+    :param conn: The duckdb connection to use
+    :return: The sorted list of the changed partitions, or None if no transform run
+        succeeded yet: every partition should then be rebuilt
+    """
+    if not check_ingestion_state_tables(conn):
+        return None
+    create_ingestion_state_tables(conn)
+    query = f"""
+        SELECT MAX(started_at)
+        FROM {TRANSFORM_RUNS_TABLE}
+        WHERE status = 'success'
+        ;
+    """
+    last_transform = conn.execute(query).fetchone()[0]
+    if last_transform is None:
+        return None
+
+    query = f"""
+        SELECT DISTINCT de_partition
+        FROM {PARTITION_STATE_TABLE}
+        WHERE loaded_at >= ?
+        ORDER BY de_partition
+        ;
+    """
+    conn.execute(query, (last_transform,))
+    return [row[0] for row in conn.fetchall()]
+
+
+def start_transform_run(
+    conn: duckdb.DuckDBPyConnection, partitions: Optional[List[int]]
+) -> str:
+    """
+    Record the start of a transform run
+    :param conn: The duckdb connection to use
+    :param partitions: The partitions rebuilt by the run, None if every partition is rebuilt
+    :return: The id of the run
+    """
+    create_ingestion_state_tables(conn)
+    run_id = str(uuid.uuid4())
+    query = f"""
+        INSERT INTO {TRANSFORM_RUNS_TABLE} (run_id, started_at, status, partitions)
+        VALUES (?, current_localtimestamp(), 'running', ?);
+    """
+    conn.execute(query, (run_id, partitions))
+    return run_id
+
+
+def finish_transform_run(conn: duckdb.DuckDBPyConnection, run_id: str, status: str):
+    """
+    Record the end of a transform run
+    :param conn: The duckdb connection to use
+    :param run_id: The id of the run
+    :param status: "success" or "failed"
+    """
+    query = f"""
+        UPDATE {TRANSFORM_RUNS_TABLE}
+        SET finished_at = current_localtimestamp(), status = $status
+        WHERE run_id = $run_id;
+    """
+    conn.execute(query, {"status": status, "run_id": run_id})
@@ -0,0 +1,268 @@
+"""
+Each EDC table is stored as one physical table per year (e.g. edc_resultats_2024),
+exposed to the readers through a view of the same name as the table (edc_resultats)
+that unions every year.
+
+Refreshing a year loads a staging table, then swaps it with the previous table of the
+year in a single transaction: the readers never see a half-loaded year, and dropping the
+previous table frees its storage instead of leaving deleted rows behind.
+
+In diff mode, a year already loaded is not swapped: only the rows of the staging table
+which differ from the partition table are inserted, and the rows which disappeared are
+deleted, see apply_partition_diff.
+"""
+
+import logging
+from typing import Dict, List
+
+import duckdb
+
+logger = logging.getLogger(__name__)
+
+STAGING_SUFFIX = "__staging"
+
+
+def get_partition_table_name(table_name: str, year: str) -> str:
+    """
+    Returns the name of the physical table holding one year of an EDC table
+    For example in 2024 for edc_resultats: edc_resultats_2024
+    :param table_name: The name of the EDC table (and of its view)
+    :param year: The year of the partition
+    :return: The partition table name
+    """
+    return f"{table_name}_{year}"
+
+
+def get_staging_table_name(table_name: str, year: str) -> str:
+    """Returns the name of the table used to load one year before the swap"""
+    return get_partition_table_name(table_name, year) + STAGING_SUFFIX
+
+
+def get_table_type(conn: duckdb.DuckDBPyConnection, table_name: str) -> str:
+    """
+    Returns the type of a table in the duckdb database
+    :param conn: The duckdb connection to use
+    :param table_name: The table name
+    :return: "BASE TABLE", "VIEW", or None if the table doesn't exist
+    """
+    query = """
+        SELECT table_type
+        FROM information_schema.tables
+        WHERE table_name = ?
+        ;
+    """
+    conn.execute(query, (table_name,))
+    result = conn.fetchone()
+    return result[0] if result else None
+
+
+def get_partition_tables(conn: duckdb.DuckDBPyConnection, table_name: str) -> List[str]:
+    """
+    Returns the partition tables of an EDC table, sorted by year
+    :param conn: The duckdb connection to use
+    :param table_name: The name of the EDC table
+    :return: The list of the partition tables names
+    """
+    query = """
+        SELECT table_name
+        FROM information_schema.tables
+        WHERE table_type = 'BASE TABLE'
+            AND regexp_full_match(table_name, ?)
+        ORDER BY table_name
+        ;
+    """
+    conn.execute(query, (f"{table_name}_[0-9]{{4}}",))
+    return [row[0] for row in conn.fetchall()]
+
+
+def get_table_columns(conn: duckdb.DuckDBPyConnection, table_name: str) -> List[str]:
+    """
+    Returns the columns of a table in the duckdb database
+    :param conn: The duckdb connection to use
+    :param table_name: The table name
+    :return: The names of the columns in order, an empty list if the table doesn't exist
+    """
+    query = """
+        SELECT column_name
+        FROM information_schema.columns
+        WHERE table_name = ?
+        ORDER BY ordinal_position
+        ;
+    """
+    conn.execute(query, (table_name,))
+    return [row[0] for row in conn.fetchall()]
+
+
+def refresh_partitioned_view(conn: duckdb.DuckDBPyConnection, table_name: str):
+    """
+    Create or replace the view unioning every partition table of an EDC table.
+    The columns are matched by name, so that years with different columns can coexist.
+    The view is dropped if there is no partition left.
+    :param conn: The duckdb connection to use
+    :param table_name: The name of the EDC table
+    """
+    partition_tables = get_partition_tables(conn, table_name)
+    if partition_tables:
+        union = "\nUNION ALL BY NAME\n".join(
+            f"SELECT * FROM {partition_table}" for partition_table in partition_tables
+        )
+        query = f"CREATE OR REPLACE VIEW {table_name} AS\n{union};"
+    else:
+        query = f"DROP VIEW IF EXISTS {table_name};"
+    conn.execute(query)
+
+
+def swap_partition_table(conn: duckdb.DuckDBPyConnection, table_name: str, year: str):
+    """
+    Replace the partition table of one year by its staging table, and refresh the view.
+    It should be called inside a transaction, so that the swap is atomic.
+    :param conn: The duckdb connection to use
+    :param table_name: The name of the EDC table
+    :param year: The year of the partition
+    """
+    partition_table = get_partition_table_name(table_name, year)
+    staging_table = get_staging_table_name(table_name, year)
+    conn.execute(f"DROP TABLE IF EXISTS {partition_table};")
+    conn.execute(f"ALTER TABLE {staging_table} RENAME TO {partition_table};")
+    refresh_partitioned_view(conn, table_name)
+
+
+def drop_partitioned_table(conn: duckdb.DuckDBPyConnection, table_name: str):
+    """
+    Drop the view and every partition table of an EDC table
+    :param conn: The duckdb connection to use
+    :param table_name: The name of the EDC table
+    """
+    for partition_table in get_partition_tables(conn, table_name):
+        conn.execute(f"DROP TABLE IF EXISTS {partition_table};")
+    if get_table_type(conn, table_name) == "BASE TABLE":
+        conn.execute(f"DROP TABLE IF EXISTS {table_name};")
+    conn.execute(f"DROP VIEW IF EXISTS {table_name};")
+
+
+def migrate_to_partition_tables(conn: duckdb.DuckDBPyConnection, table_name: str):
+    """
+    Split an EDC table created before the partition tables existed (one table holding
+    every year) into one table per year behind a view. Does nothing if it's already done.
+    :param conn: The duckdb connection to use
+    :param table_name: The name of the EDC table
+    """
+    if get_table_type(conn, table_name) != "BASE TABLE":
+        return
+
+    logger.info(f"Split table {table_name} into one table per year")
+    conn.begin()
+    try:
+        query = f"SELECT DISTINCT CAST(de_partition AS VARCHAR) FROM {table_name};"
+        years = [row[0] for row in conn.execute(query).fetchall()]
+        for year in years:
+            query = f"""
+                CREATE TABLE {get_partition_table_name(table_name, year)} AS
+                SELECT *
+                FROM {table_name}
+                WHERE de_partition = CAST(? AS INTEGER)
+                ;
+            """
+            conn.execute(query, (year,))
+        conn.execute(f"DROP TABLE {table_name};")
+        refresh_partitioned_view(conn, table_name)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def apply_partition_diff(
+    conn: duckdb.DuckDBPyConnection,
+    table_name: str,
+    year: str,
+    columns: List[str],
+    natural_keys: List[str],
+) -> Dict[str, int]:
+    """
+    Apply to the partition table of one year only the rows of its staging table which
+    changed, instead of replacing the whole table. The rows are compared on a hash of
+    the source columns: the rows of the partition missing from the staging table are
+    deleted, and the rows of the staging table missing from the partition are inserted.
+    Identical rows are matched one to one, so that duplicated rows are kept as many
+    times as in the source. Only the inserted rows are written, with the dataset datetime
+    of the staging table: the unchanged rows keep the one they were loaded with, the
+    version of the whole year being recorded in _partition_state.
+    It should be called inside a transaction, so that the readers never see a
+    half-applied diff.
+    :param conn: The duckdb connection to use
+    :param table_name: The name of the EDC table
+    :param year: The year of the partition
+    :param columns: The source columns, compared to detect the changed rows
+    :param natural_keys: The columns identifying a row: a row deleted and a row inserted
+        with the same key are counted as one updated row
+    :return: dict with the number of rows "inserted", "updated" and "deleted"
+    """
+    partition_table = get_partition_table_name(table_name, year)
+    staging_table = get_staging_table_name(table_name, year)
+    row_hash = f"hash({', '.join(columns)})"
+    key_hash = f"hash({', '.join(natural_keys)})"
+
+    for source, table in (("old", partition_table), ("new", staging_table)):
+        query = f"""
+            CREATE OR REPLACE TEMP TABLE _diff_{source} AS
+            SELECT
+                rowid                                               AS row_id,
+                {key_hash}                                          AS key_hash,
+                {row_hash}                                          AS row_hash,
+                row_number() OVER (PARTITION BY {row_hash})         AS occurrence
+            FROM {table}
+            ;
+        """
+        conn.execute(query)
+    # The deleted and inserted rows sharing a key are paired one to one as updates
+    query = """
+        CREATE OR REPLACE TEMP TABLE _diff_deleted AS
+        SELECT
+            row_id,
+            key_hash,
+            row_number() OVER (PARTITION BY key_hash)   AS key_occurrence
+        FROM _diff_old
+        ANTI JOIN _diff_new USING (row_hash, occurrence)
+        ;
+        CREATE OR REPLACE TEMP TABLE _diff_inserted AS
+        SELECT
+            row_id,
+            key_hash,
+            row_number() OVER (PARTITION BY key_hash)   AS key_occurrence
+        FROM _diff_new
+        ANTI JOIN _diff_old USING (row_hash, occurrence)
+        ;
+    """
+    conn.execute(query)
+
+    query = """
+        SELECT
+            (SELECT COUNT(*) FROM _diff_inserted),
+            (SELECT COUNT(*) FROM _diff_deleted),
+            (
+                SELECT COUNT(*) FROM _diff_inserted
+                INNER JOIN _diff_deleted USING (key_hash, key_occurrence)
+            )
+        ;
+    """
+    inserted, deleted, updated = conn.execute(query).fetchone()
+
+    query = f"""
+        DELETE FROM {partition_table}
+        WHERE rowid IN (SELECT row_id FROM _diff_deleted)
+        ;
+        INSERT INTO {partition_table} BY NAME
+        SELECT * FROM {staging_table}
+        WHERE rowid IN (SELECT row_id FROM _diff_inserted)
+        ;
+    """
+    conn.execute(query)
+    for source in ("old", "new", "deleted", "inserted"):
+        conn.execute(f"DROP TABLE _diff_{source};")
+
+    return {
+        "inserted": inserted - updated,
+        "updated": updated,
+        "deleted": deleted - updated,
+    }
@@ -0,0 +1,185 @@
+"""
+The raw layer of the EDC datasets: the files of each year, as published on data.gouv.fr,
+converted once to ZSTD compressed Parquet in database/raw/<year>/<dataset datetime>/.
+
+Parsing the CSV files is the slowest step of the ingestion. Once a version of a year is
+in the raw layer, the tables are loaded from the Parquet files instead: when they are
+dropped and rebuilt, or when the types of _config_edc.py change, the zip archive is
+neither downloaded nor parsed again. Every column is kept as text, as in the source
+file, and cast to the types of _config_edc.py when the tables are loaded: a value which
+can't be cast is loaded as NULL, and counted in the logs.
+A manifest.json, written last, describes the files of a complete version.
+"""
+
+import json
+import logging
+import os
+import shutil
+from contextlib import nullcontext
+from typing import Dict, Optional
+from zipfile import ZipFile
+
+import duckdb
+
+from pipelines.utils.instrumentation import span
+
+from ._common import RAW_FOLDER, stream_zip_member
+from ._config_edc import create_edc_yearly_filename, get_edc_config
+
+logger = logging.getLogger(__name__)
+edc_config = get_edc_config()
+
+RAW_MANIFEST_FILE = "manifest.json"
+
+
+def get_raw_folder(year: str, dataset_datetime: str) -> str:
+    """
+    Returns the folder of the Parquet files of one version of a yearly dataset
+    For example: database/raw/2024/20250101-120000
+    :param year: The year of the dataset
+    :param dataset_datetime: The dataset datetime as found on www.data.gouv.fr
+    :return: The folder
+    """
+    return os.path.join(RAW_FOLDER, year, dataset_datetime)
+
+
+def get_raw_manifest(year: str, dataset_datetime: str) -> Optional[Dict]:
+    """
+    Returns the manifest of one version of a yearly dataset in the raw layer
+    :param year: The year of the dataset
+    :param dataset_datetime: The dataset datetime as found on www.data.gouv.fr
+    :return: dict with a "files" dict of edc_config["files"] key -> dict with the
+        Parquet "file", the "byte_size" and "checksum" of the source file and its
+        "row_count". None if this version is not in the raw layer.
+    """
+    manifest_path = os.path.join(
+        get_raw_folder(year, dataset_datetime), RAW_MANIFEST_FILE
+    )
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def write_raw_files(
+    conn: duckdb.DuckDBPyConnection,
+    year: str,
+    dataset_datetime: str,
+    zip_file: str,
+    extract_folder: str = None,
+) -> Dict:
+    """
+    Convert the files of one version of a yearly dataset to Parquet in the raw layer,
+    and remove the other versions of the year
+    :param conn: The duckdb connection to use
+    :param year: The year of the dataset
+    :param dataset_datetime: The dataset datetime as found on www.data.gouv.fr
+    :param zip_file: The downloaded zip archive of the dataset
+    :param extract_folder: The folder where the dataset files were extracted.
+        If None, the files are streamed from zip_file without being written to disk.
+    :return: The manifest of the version, see get_raw_manifest
+    """
+    raw_folder = get_raw_folder(year, dataset_datetime)
+    # The files are written in a temporary folder, renamed once complete
+    part_folder = raw_folder + ".part"
+    shutil.rmtree(part_folder, ignore_errors=True)
+    os.makedirs(part_folder)
+
+    manifest = {"year": year, "dataset_datetime": dataset_datetime, "files": {}}
+    try:
+        with ZipFile(zip_file, "r") as zip_ref:
+            for file_key, file_info in edc_config["files"].items():
+                filename = create_edc_yearly_filename(
+                    file_name_prefix=file_info["file_name_prefix"],
+                    file_extension=file_info["file_extension"],
+                    year=year,
+                )
+                member_info = zip_ref.getinfo(filename)
+                if extract_folder is None:
+                    file_context = stream_zip_member(zip_file, filename)
+                else:
+                    file_context = nullcontext(os.path.join(extract_folder, filename))
+                raw_file = f"{file_info['table_name']}.parquet"
+                query = f"""
+                    COPY (
+                        SELECT * FROM read_csv(?, header=true, delim=',', all_varchar=true)
+                    ) TO '{os.path.join(part_folder, raw_file)}' (FORMAT PARQUET, COMPRESSION ZSTD)
+                    ;
+                """
+                with (
+                    span(
+                        "convert_raw_file",
+                        year=year,
+                        table=file_info["table_name"],
+                        bytes=member_info.file_size,
+                    ) as convert_span,
+                    file_context as filepath,
+                ):
+                    conn.execute(query, (filepath,))
+                    row_count = conn.fetchone()[0]
+                    convert_span.set(rows=row_count)
+                manifest["files"][file_key] = {
+                    "file": raw_file,
+                    "byte_size": member_info.file_size,
+                    "checksum": f"{member_info.CRC:08x}",
+                    "row_count": row_count,
+                }
+
+        with open(os.path.join(part_folder, RAW_MANIFEST_FILE), "w") as f:
+            json.dump(manifest, f, indent=2)
+        shutil.rmtree(raw_folder, ignore_errors=True)
+        os.replace(part_folder, raw_folder)
+    finally:
+        shutil.rmtree(part_folder, ignore_errors=True)
+
+    # Only the last version of each year is kept
+    year_folder = os.path.join(RAW_FOLDER, year)
+    for folder in os.listdir(year_folder):
+        if folder != dataset_datetime:
+            logger.info(f"   Removing the raw files of {year} {folder}")
+            shutil.rmtree(os.path.join(year_folder, folder), ignore_errors=True)
+    return manifest
+
+
+def get_raw_file_query(column_types: Dict[str, str]) -> str:
+    """
+    Returns the query reading a Parquet file of the raw layer, with its path as the only
+    parameter, where the columns are cast to their types. A value which can't be cast
+    (e.g. a malformed date) becomes NULL instead of failing the load, see
+    count_invalid_values.
+    :param column_types: dict of column -> duckdb type, see edc_config["files"]
+    :return: The SELECT query
+    """
+    replace = ", ".join(
+        f"TRY_CAST({column} AS {column_type}) AS {column}"
+        for column, column_type in column_types.items()
+    )
+    return f"SELECT * REPLACE ({replace}) FROM read_parquet(?)"
+
+
+def count_invalid_values(
+    conn: duckdb.DuckDBPyConnection, column_types: Dict[str, str], raw_file: str
+) -> Dict[str, int]:
+    """
+    Count the values of a Parquet file of the raw layer which can't be cast to their
+    types, and are loaded as NULL by get_raw_file_query
+    :param conn: The duckdb connection to use
+    :param column_types: dict of column -> duckdb type, see edc_config["files"]
+    :param raw_file: The path of the Parquet file
+    :return: dict of column -> number of invalid values, for the columns having any
+    """
+    columns = [
+        column
+        for column, column_type in column_types.items()
+        if column_type != "VARCHAR"
+    ]
+    if not columns:
+        return {}
+    counts = ", ".join(
+        f"COUNT({column}) - COUNT(TRY_CAST({column} AS {column_types[column]}))"
+        for column in columns
+    )
+    conn.execute(f"SELECT {counts} FROM read_parquet(?);", (raw_file,))
+    return {
+        column: count for column, count in zip(columns, conn.fetchone()) if count > 0
+    }
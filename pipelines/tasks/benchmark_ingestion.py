@@ -0,0 +1,264 @@
+"""
+Benchmark the ingestion of the EDC datasets on synthetic data.
+
+Synthetic DIS_COM_UDI_, DIS_PLV_ and DIS_RESULT_ files are generated for the requested
+years, then served by a local HTTP server standing in for www.data.gouv.fr. The pipeline
+runs against this server and a separate database (database/benchmark), each stage in its
+own process: download, extract, load and reload, optimize, freshness check and optionally
+the dbt models. The load and reload stages run build_database as the pipeline does, with
+its --workers: the load converts the files to Parquet in the raw layer and writes the first
+version of the database, the reload copies this version and reads the raw layer.
+The duration, throughput and peak RSS of every stage, and the size of the database, are
+written to a JSON report, to compare the throughput before and after a change.
+
+Args:
+    - rows (int): Number of results (DIS_RESULT_ rows) generated for each year (default 100000)
+    - years (str): Comma-separated list of years to generate (default 2024)
+    - workers (int): Number of years downloaded and extracted in parallel by build_database (default 1)
+    - streaming (bool): Stream the files from the zip archives instead of extracting them
+    - dbt (bool): Also benchmark the dbt models (transform --full-refresh)
+    - output (str): Path of the JSON report (default database/benchmark/report_<datetime>.json)
+
+Examples:
+    - benchmark_ingestion : Benchmark the ingestion of 100000 results for 2024
+    - benchmark_ingestion --rows 10000000 --years 2023,2024 : Benchmark 10 million results per year
+    - benchmark_ingestion --rows 1000000 --streaming --dbt : Benchmark the streaming ingestion and the dbt models
+    - benchmark_ingestion --years 2022,2023,2024 --workers 3 : Benchmark the years loaded in parallel
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, List
+from zipfile import ZipFile
+
+import duckdb
+
+from ._benchmark import (
+    generate_edc_fixtures,
+    get_fixtures_row_counts,
+    serve_edc_fixtures,
+)
+from ._common import DATABASE_FOLDER
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_FOLDER = os.path.join(DATABASE_FOLDER, "benchmark")
+STAGES = ["download", "extract", "load", "reload", "optimize", "freshness", "dbt"]
+
+
+def run_stage(stage: str, years: List[str], streaming: bool, workers: int):
+    """
+    Run one stage of the pipeline. It is called in a new process, where DATABASE_FOLDER
+    and EDC_BASE_URL point to the benchmark database and to the fixtures server.
+    :param stage: The stage to run, one of STAGES
+    :param years: The years to process
+    :param streaming: Whether the files are streamed from the zip archives
+    :param workers: Number of years downloaded and extracted in parallel by build_database
+    :return: dict with the duration of the stage, its peak RSS, and the value returned
+        by the stage
+    """
+    # The tasks are imported here, so that they read the environment of the benchmark
+    from . import build_database, optimize_database
+    from ._context import PipelineContext
+    from .build_database import (
+        download_extract_yearly_edc_data,
+        get_edc_dataset_years_to_update,
+    )
+    from .transform import transform
+
+    start_time = time.perf_counter()
+    result = None
+    if stage == "download":
+        for year in years:
+            download_extract_yearly_edc_data(year=year, streaming=True)
+    elif stage == "extract":
+        # The zip archives are not downloaded again, the server answers 304
+        for year in years:
+            download_extract_yearly_edc_data(year=year, streaming=False)
+    elif stage in ("load", "reload"):
+        # As in the pipeline: the compaction of the reloaded database is the optimize stage
+        with PipelineContext() as context:
+            build_database.execute(
+                refresh_type="custom",
+                custom_years=years,
+                workers=workers,
+                streaming=streaming,
+                context=context,
+            )
+    elif stage == "optimize":
+        optimize_database.execute()
+    elif stage == "freshness":
+        result = get_edc_dataset_years_to_update(years)
+    elif stage == "dbt":
+        transform(full_refresh=True)
+    duration = time.perf_counter() - start_time
+
+    # ru_maxrss is in kilobytes on Linux, the children are the dbt processes
+    peak_rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return {"duration": duration, "peak_rss": peak_rss * 1024, "result": result}
+
+
+def get_database_size(database_file: str) -> int:
+    """Returns the size in bytes of a duckdb database and of its write-ahead log"""
+    # The current version of the database, not the link to it
+    database_file = os.path.realpath(database_file)
+    return sum(
+        os.path.getsize(path)
+        for path in (database_file, database_file + ".wal")
+        if os.path.exists(path)
+    )
+
+
+def benchmark_ingestion(
+    rows: int = 100_000,
+    years: List[str] = None,
+    streaming: bool = False,
+    workers: int = 1,
+    dbt: bool = False,
+    output: str = None,
+) -> Dict:
+    """
+    Benchmark the stages of the ingestion on synthetic datasets, and write the JSON report
+    :param rows: The number of results generated for each year
+    :param years: The years to generate. Defaults to ["2024"].
+    :param streaming: Whether to stream the files from the zip archives instead of extracting them
+    :param workers: Number of years downloaded and extracted in parallel by build_database
+    :param dbt: Whether to also benchmark the dbt models
+    :param output: The path of the JSON report. Defaults to
+        BENCHMARK_FOLDER/report_<datetime>.json.
+    :return: The report
+    """
+    if years is None:
+        years = ["2024"]
+    if output is None:
+        output = os.path.join(
+            BENCHMARK_FOLDER, f"report_{datetime.now():%Y%m%d-%H%M%S}.json"
+        )
+    fixtures_folder = os.path.join(BENCHMARK_FOLDER, "fixtures", str(rows))
+    database_folder = os.path.join(BENCHMARK_FOLDER, "database")
+
+    zip_files = generate_edc_fixtures(folder=fixtures_folder, years=years, rows=rows)
+    row_counts = get_fixtures_row_counts(rows)
+    total_rows = sum(row_counts.values()) * len(years)
+    zip_size = sum(os.path.getsize(zip_file) for zip_file in zip_files.values())
+    extracted_size = 0
+    for zip_file in zip_files.values():
+        with ZipFile(zip_file) as zip_ref:
+            extracted_size += sum(info.file_size for info in zip_ref.infolist())
+
+    # Every run starts from an empty database and an empty cache
+    shutil.rmtree(database_folder, ignore_errors=True)
+    os.makedirs(database_folder)
+    database_file = os.path.join(database_folder, "data.duckdb")
+
+    stages = [stage for stage in STAGES if dbt or stage != "dbt"]
+    if streaming:
+        stages.remove("extract")
+
+    report = {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "parameters": {
+            "rows": rows,
+            "years": years,
+            "streaming": streaming,
+            "workers": workers,
+            "dbt": dbt,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "duckdb": duckdb.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "fixtures": {
+            "row_counts": row_counts,
+            "zip_size": zip_size,
+            "extracted_size": extracted_size,
+        },
+        "stages": {},
+    }
+
+    environ = os.environ.copy()
+    with serve_edc_fixtures(fixtures_folder) as base_url:
+        try:
+            # Read by the stage processes, see run_stage
+            os.environ["DATABASE_FOLDER"] = database_folder
+            os.environ["EDC_BASE_URL"] = base_url
+            for stage in stages:
+                logger.info(f"Benchmarking the {stage} stage...")
+                # A new process per stage, so that each stage has its own peak RSS
+                with ProcessPoolExecutor(
+                    max_workers=1, mp_context=multiprocessing.get_context("spawn")
+                ) as executor:
+                    stage_result = executor.submit(
+                        run_stage,
+                        stage=stage,
+                        years=years,
+                        streaming=streaming,
+                        workers=workers,
+                    ).result()
+
+                stage_report = {
+                    "duration_s": round(stage_result["duration"], 3),
+                    "peak_rss_mb": round(stage_result["peak_rss"] / 1024**2, 1),
+                }
+                if stage in ("load", "reload", "dbt"):
+                    stage_report["rows"] = total_rows
+                    stage_report["rows_per_s"] = round(
+                        total_rows / stage_result["duration"]
+                    )
+                # The download is measured on the zip archives, the extraction on the
+                # files written from them
+                if stage in ("download", "extract"):
+                    stage_bytes = zip_size if stage == "download" else extracted_size
+                    stage_report["bytes"] = stage_bytes
+                    stage_report["mb_per_s"] = round(
+                        stage_bytes / 1024**2 / stage_result["duration"], 1
+                    )
+                if stage == "freshness":
+                    stage_report["years_to_update"] = stage_result["result"]
+                if stage in ("load", "reload", "optimize", "dbt"):
+                    stage_report["database_size_mb"] = round(
+                        get_database_size(database_file) / 1024**2, 1
+                    )
+                report["stages"][stage] = stage_report
+                logger.info(f"   {stage}: {stage_report}")
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+    report["database_size_mb"] = round(get_database_size(database_file) / 1024**2, 1)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"✅ Benchmark report written to {output}")
+    return report
+
+
+def execute(
+    rows: int = 100_000,
+    years: List[str] = None,
+    streaming: bool = False,
+    workers: int = 1,
+    dbt: bool = False,
+    output: str = None,
+):
+    benchmark_ingestion(
+        rows=rows,
+        years=years,
+        streaming=streaming,
+        workers=workers,
+        dbt=dbt,
+        output=output,
+    )
@@ -1,9 +1,19 @@
 """
 Consolidate data into the database.
 
+The files of each year are converted once to Parquet in database/raw/<year>/<dataset datetime>/
+(see _raw.py): as long as data.gouv.fr publishes the same version of a year, the tables
+are loaded from these files, without downloading and parsing the CSV files again.
+
 Args:
     - refresh-type (str): Type of refresh to perform ("all", "last", or "custom")
     - custom-years (str): List of years to process when refresh_type is "custom"
+    - workers (int): Number of years downloaded and extracted in parallel (default 1)
+    - streaming (bool): Stream the files from the zip archives into the database instead of extracting them
+    - optimize (bool): Compact and sort the database once it is built (see optimize_database).
+        The tables replaced leave free space in the file: when years already loaded are
+        refreshed, the database is compacted even without this option.
+    - diff (bool): Apply only the rows which changed to the years already loaded, instead of reloading them
 
 Examples:
     - build_database --refresh-type all : Process all years
@@ -13,16 +23,27 @@ Examples:
     - build_database --refresh-type all --check_update : Process only years whose data has been modified from the source
     - build_database --refresh-type last --check_update : Process last year if its data has been modified from the source
     - build_database --refresh-type custom --custom-years 2018,2024 --check_update : Process only the years 2018 and 2024 if their data has been modified from the source
+    - build_database --refresh-type all --workers 5 : Download and extract up to 5 years in parallel while a single connection inserts them
+    - build_database --refresh-type last --streaming : Process last year without writing the extracted files on disk
+    - build_database --refresh-type all --optimize : Process all years, then compact and sort the database
+    - build_database --refresh-type all --check-update --diff : Apply only the rows which changed in the years modified from the source
 """
 
+import contextvars
 import logging
 import os
-from typing import List, Literal
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Literal
 from zipfile import ZipFile
 
 import duckdb
+import requests
 from tqdm import tqdm
 
+from pipelines.utils.connections import connect_duckdb
+from pipelines.utils.instrumentation import span
 from pipelines.utils.utils import (
     extract_dataset_datetime,
     get_edc_dataset_years_to_update,
@@ -30,12 +51,39 @@ from pipelines.utils.utils import (
 
 from ._common import (
     CACHE_FOLDER,
-    DUCKDB_FILE,
-    clear_cache,
     download_file_from_https,
+    evict_cache,
+    get_cache_path,
     tqdm_common,
 )
 from ._config_edc import create_edc_yearly_filename, get_edc_config
+from ._context import PipelineContext, pipeline_context
+from ._database_versions import new_database_version
+from ._ingestion_state import (
+    delete_partition_state,
+    finish_ingestion_run,
+    get_changed_partitions,
+    record_partition_changes,
+    record_partition_state,
+    start_ingestion_run,
+)
+from ._partitions import (
+    apply_partition_diff,
+    drop_partitioned_table,
+    get_partition_table_name,
+    get_staging_table_name,
+    get_table_columns,
+    migrate_to_partition_tables,
+    swap_partition_table,
+)
+from ._raw import (
+    count_invalid_values,
+    get_raw_file_query,
+    get_raw_folder,
+    get_raw_manifest,
+    write_raw_files,
+)
+from .optimize_database import optimize_database
 
 logger = logging.getLogger(__name__)
 edc_config = get_edc_config()
@@ -57,119 +105,391 @@ def check_table_existence(conn: duckdb.DuckDBPyConnection, table_name: str) -> b
     return list(conn.fetchone())[0] == 1
 
 
-def download_extract_insert_yearly_edc_data(year: str):
+def has_edc_tables(conn: duckdb.DuckDBPyConnection) -> bool:
     """
-    Downloads from www.data.gouv.fr the EDC (Eau distribuée par commune) dataset for one year,
-    extracts the files and insert the data into duckdb
+    Check if the EDC tables were already loaded in the duckdb database
+    :param conn: The duckdb connection to use
+    :return: True if any EDC table exists, False if not
+    """
+    return any(
+        check_table_existence(conn, file_info["table_name"])
+        for file_info in edc_config["files"].values()
+    )
+
+
+def get_edc_yearly_filenames(year: str) -> Dict[str, str]:
+    """
+    Returns the names of the files needed from the yearly EDC zip archive
+    :param year: The year of the dataset
+    :return: A dict with the edc_config["files"] keys and the associated yearly filenames
+    """
+    return {
+        file_key: create_edc_yearly_filename(
+            file_name_prefix=file_info["file_name_prefix"],
+            file_extension=file_info["file_extension"],
+            year=year,
+        )
+        for file_key, file_info in edc_config["files"].items()
+    }
+
+
+def download_extract_yearly_edc_data(
+    year: str, streaming: bool = False, session: requests.Session = None
+) -> Dict[str, str]:
+    """
+    Downloads from www.data.gouv.fr the EDC (Eau distribuée par commune) dataset for one year
+    and extracts the needed files in the cache folder.
+    This step doesn't touch the duckdb database, so it can safely run in parallel for several years.
     :param year: The year from which we want to download the dataset
-    :return: Create or replace the associated tables in the duckcb database.
-        It adds the column "de_partition" based on year as an integer.
+    :param streaming: If True, the files are not extracted. They will be streamed
+        from the zip archive into duckdb by insert_yearly_edc_data.
+    :param session: The HTTP session to use. Defaults to the shared session of the pipeline.
+    :return: A dict with the year, the dataset datetime, the zip file and the folder of the
+        extracted files (None when streaming). It can be passed as is to insert_yearly_edc_data.
+        When this version of the dataset is already in the raw layer (see _raw.py), it is
+        neither downloaded nor extracted, and the zip file is None.
     """
     # Dataset specific constants
     DATA_URL = (
         edc_config["source"]["base_url"]
         + edc_config["source"]["yearly_files_infos"][year]["id"]
     )
-    ZIP_FILE = os.path.join(
-        CACHE_FOLDER, edc_config["source"]["yearly_files_infos"][year]["zipfile"]
-    )
     EXTRACT_FOLDER = os.path.join(CACHE_FOLDER, f"raw_data_{year}")
-    FILES = edc_config["files"]
 
     logger.info(f"Processing EDC dataset for {year}...")
 
-    dataset_datetime = extract_dataset_datetime(DATA_URL)
+    dataset_datetime = extract_dataset_datetime(DATA_URL, session=session)
     logger.info(f"   EDC dataset datetime: {dataset_datetime}")
 
-    download_file_from_https(url=DATA_URL, filepath=ZIP_FILE)
+    # The files of this version were already converted to Parquet
+    if get_raw_manifest(year, dataset_datetime) is not None:
+        logger.info(f"   Using the raw files of {year} {dataset_datetime}")
+        return {
+            "year": year,
+            "dataset_datetime": dataset_datetime,
+            "zip_file": None,
+            "extract_folder": None,
+        }
+
+    # The zip file is kept in the download cache between runs,
+    # it is downloaded again only when data.gouv publishes a new version
+    ZIP_FILE = get_cache_path(
+        "edc",
+        edc_config["source"]["yearly_files_infos"][year]["id"],
+        dataset_datetime,
+        edc_config["source"]["yearly_files_infos"][year]["zipfile"],
+    )
+
+    download_file_from_https(url=DATA_URL, filepath=ZIP_FILE, session=session)
 
-    logger.info("   Extracting files...")
-    with ZipFile(ZIP_FILE, "r") as zip_ref:
-        file_list = zip_ref.namelist()
+    if streaming:
+        EXTRACT_FOLDER = None
+    else:
+        logger.info(f"   Extracting files for {year}...")
+        file_list = get_edc_yearly_filenames(year).values()
+        with (
+            span("extract", year=year, files=len(file_list)) as extract_span,
+            ZipFile(ZIP_FILE, "r") as zip_ref,
+        ):
+            with tqdm(
+                total=len(file_list), unit="file", desc="Extracting", **tqdm_common
+            ) as pbar:
+                for file in file_list:
+                    # Only the files listed in edc_config["files"] are extracted
+                    zip_ref.extract(file, EXTRACT_FOLDER)
+                    pbar.update(1)
+            extract_span.set(
+                bytes=sum(zip_ref.getinfo(file).file_size for file in file_list)
+            )
+
+    return {
+        "year": year,
+        "dataset_datetime": dataset_datetime,
+        "zip_file": ZIP_FILE,
+        "extract_folder": EXTRACT_FOLDER,
+    }
+
+
+def insert_yearly_edc_data(
+    conn: duckdb.DuckDBPyConnection,
+    year: str,
+    dataset_datetime: str,
+    zip_file: str,
+    extract_folder: str = None,
+    run_id: str = None,
+    diff: bool = False,
+):
+    """
+    Inserts the files of the EDC dataset for one year into duckdb
+    :param conn: The duckdb connection to use. It should be the only one writing to the database.
+    :param year: The year of the dataset
+    :param dataset_datetime: The dataset datetime as found on www.data.gouv.fr
+    :param zip_file: The downloaded zip archive of the dataset, converted to Parquet in
+        the raw layer first. None if this version is already in the raw layer.
+    :param extract_folder: The folder where the dataset files were extracted.
+        If None, the files are streamed from zip_file without being written to disk.
+    :param run_id: The id of the build_database run, recorded in _partition_state
+    :param diff: Whether to apply only the rows which changed to the tables of the year
+        already loaded, recording the number of rows changed in _partition_changes.
+        The tables not loaded yet, or whose columns changed, are replaced.
+    :return: Create or replace the tables of the year in the duckcb database
+        (e.g. edc_resultats_2024) and the views unioning every year (e.g. edc_resultats).
+        It adds the column "de_partition" based on year as an integer.
+    """
+    FILES = edc_config["files"]
+    raw_manifest = get_raw_manifest(year, dataset_datetime)
+    if raw_manifest is None:
+        logger.info(f"   Converting the files of {year} to Parquet...")
+        raw_manifest = write_raw_files(
+            conn=conn,
+            year=year,
+            dataset_datetime=dataset_datetime,
+            zip_file=zip_file,
+            extract_folder=extract_folder,
+        )
+    raw_folder = get_raw_folder(year, dataset_datetime)
+
+    logger.info(f"   Creating or updating tables in the database for {year}...")
+
+    # Each file is first loaded into a staging table, the tables of the year
+    # are then swapped all at once so that readers never see a half-loaded year
+    loads = {}
+    total_operations = len(FILES)
+    try:
         with tqdm(
-            total=len(file_list), unit="file", desc="Extracting", **tqdm_common
+            total=total_operations, unit="operation", desc="Handling", **tqdm_common
         ) as pbar:
-            for file in file_list:
-                zip_ref.extract(file, EXTRACT_FOLDER)  # Extract each file
+            for file_key, file_info in FILES.items():
+                raw_file_info = raw_manifest["files"][file_key]
+                query = f"""
+                    CREATE OR REPLACE TABLE {get_staging_table_name(file_info["table_name"], year)} AS
+                    SELECT
+                        *,
+                        CAST(? AS INTEGER)      AS de_partition,
+                        current_date            AS de_ingestion_date,
+                        ?                       AS de_dataset_datetime
+                    FROM ({get_raw_file_query(file_info["column_types"])});
+                """
+                start_time = time.perf_counter()
+                with span(
+                    "load_file",
+                    year=year,
+                    table=file_info["table_name"],
+                    bytes=raw_file_info["byte_size"],
+                ) as load_span:
+                    raw_file = os.path.join(raw_folder, raw_file_info["file"])
+                    conn.execute(query, (year, dataset_datetime, raw_file))
+                    row_count = conn.fetchone()[0]
+                    invalid_values = count_invalid_values(
+                        conn, file_info["column_types"], raw_file
+                    )
+                    load_span.set(
+                        rows=row_count,
+                        invalid_values=sum(invalid_values.values()),
+                    )
+                if invalid_values:
+                    logger.warning(
+                        f"   {file_info['table_name']} {year}: values which can't be "
+                        f"cast to their types, loaded as NULL: {invalid_values}"
+                    )
+                loads[file_key] = (row_count, time.perf_counter() - start_time)
                 pbar.update(1)
 
-    logger.info("   Creating or updating tables in the database...")
-    conn = duckdb.connect(DUCKDB_FILE)
-
-    total_operations = len(FILES)
-    with tqdm(
-        total=total_operations, unit="operation", desc="Handling", **tqdm_common
-    ) as pbar:
+        with span("swap_partitions", year=year, tables=len(FILES)):
+            conn.begin()
+            try:
+                for file_key, file_info in FILES.items():
+                    table_name = file_info["table_name"]
+                    if diff and get_table_columns(
+                        conn, get_partition_table_name(table_name, year)
+                    ) == get_table_columns(
+                        conn, get_staging_table_name(table_name, year)
+                    ):
+                        with span(
+                            "apply_partition_diff", year=year, table=table_name
+                        ) as diff_span:
+                            changes = apply_partition_diff(
+                                conn=conn,
+                                table_name=table_name,
+                                year=year,
+                                columns=list(file_info["column_types"]),
+                                natural_keys=file_info["natural_keys"],
+                            )
+                            diff_span.set(**changes)
+                        logger.info(f"   {table_name} {year}: {changes}")
+                        record_partition_changes(
+                            conn=conn,
+                            table_name=table_name,
+                            year=year,
+                            dataset_datetime=dataset_datetime,
+                            changes=changes,
+                            run_id=run_id,
+                        )
+                    else:
+                        swap_partition_table(
+                            conn=conn, table_name=table_name, year=year
+                        )
+                    row_count, load_duration = loads[file_key]
+                    record_partition_state(
+                        conn=conn,
+                        table_name=table_name,
+                        year=year,
+                        dataset_datetime=dataset_datetime,
+                        row_count=row_count,
+                        byte_size=raw_manifest["files"][file_key]["byte_size"],
+                        load_duration=load_duration,
+                        checksum=raw_manifest["files"][file_key]["checksum"],
+                        run_id=run_id,
+                    )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        # The blocks of the tables replaced are only freed by a checkpoint: the next
+        # years loaded reuse them instead of growing the file
+        conn.execute("CHECKPOINT;")
+    finally:
         for file_info in FILES.values():
-            filepath = os.path.join(
-                EXTRACT_FOLDER,
-                create_edc_yearly_filename(
-                    file_name_prefix=file_info["file_name_prefix"],
-                    file_extension=file_info["file_extension"],
-                    year=year,
-                ),
-            )
+            staging_table = get_staging_table_name(file_info["table_name"], year)
+            conn.execute(f"DROP TABLE IF EXISTS {staging_table};")
 
-            if check_table_existence(conn=conn, table_name=file_info["table_name"]):
-                query = f"""
-                    DELETE FROM {file_info["table_name"]}
-                    WHERE de_partition = CAST(? AS INTEGER)
-                    ;
-                """
-                conn.execute(query, (year,))
-                query_start = f"INSERT INTO {file_info['table_name']} "
+    return True
 
-            else:
-                query_start = f"CREATE TABLE {file_info['table_name']} AS "
 
-            query_select = """
-                SELECT
-                    *,
-                    CAST(? AS INTEGER)      AS de_partition,
-                    current_date            AS de_ingestion_date,
-                    ?                       AS de_dataset_datetime
-                FROM read_csv(?, header=true, delim=',');
-            """
-            conn.execute(query_start + query_select, (year, dataset_datetime, filepath))
-            pbar.update(1)
+def clear_yearly_edc_cache(year: str):
+    """
+    Remove the extracted files of one year from the cache folder.
+    The downloaded zip file is kept in the download cache for the next runs,
+    and the files of the other years are left untouched.
+    :param year: The year whose files should be removed
+    """
+    with span("cleanup", year=year):
+        shutil.rmtree(
+            os.path.join(CACHE_FOLDER, f"raw_data_{year}"), ignore_errors=True
+        )
 
-    conn.close()
+
+def download_extract_insert_yearly_edc_data(
+    year: str,
+    conn: duckdb.DuckDBPyConnection = None,
+    streaming: bool = False,
+    run_id: str = None,
+    diff: bool = False,
+    session: requests.Session = None,
+):
+    """
+    Downloads from www.data.gouv.fr the EDC (Eau distribuée par commune) dataset for one year,
+    extracts the files and insert the data into duckdb
+    :param year: The year from which we want to download the dataset
+    :param conn: The duckdb connection to use. If None, a new connection is opened.
+    :param streaming: Whether to stream the files from the zip archive instead of extracting them
+    :param run_id: The id of the build_database run, recorded in _partition_state
+    :param diff: Whether to apply only the rows which changed, see insert_yearly_edc_data
+    :param session: The HTTP session to use. Defaults to the shared session of the pipeline.
+    :return: Create or replace the associated tables in the duckcb database.
+        It adds the column "de_partition" based on year as an integer.
+    """
+    close_conn = conn is None
+    if close_conn:
+        conn = connect_duckdb()
+
+    try:
+        with span("edc_year", year=year, streaming=streaming):
+            insert_yearly_edc_data(
+                conn=conn,
+                run_id=run_id,
+                diff=diff,
+                **download_extract_yearly_edc_data(
+                    year=year, streaming=streaming, session=session
+                ),
+            )
+    finally:
+        if close_conn:
+            conn.close()
 
     logger.info("   Cleaning up cache...")
-    clear_cache()
+    clear_yearly_edc_cache(year)
 
     return True
 
 
-def drop_edc_tables():
+def drop_edc_tables(conn: duckdb.DuckDBPyConnection):
     """Drop tables using tables names defined in _config_edc.py"""
-    conn = duckdb.connect(DUCKDB_FILE)
     tables_names = [
         file_info["table_name"] for file_info in edc_config["files"].values()
     ]
     for table_name in tables_names:
-        query = f"DROP TABLE IF EXISTS {table_name};"
-        logger.info(f"Drop table {table_name} (query: {query})")
-        conn.execute(query)
+        logger.info(f"Drop table {table_name} and its partition tables")
+        drop_partitioned_table(conn=conn, table_name=table_name)
+        delete_partition_state(conn=conn, table_name=table_name)
     return True
 
 
-def process_edc_datasets(
+def process_edc_years_in_parallel(
+    conn: duckdb.DuckDBPyConnection,
+    years: List[str],
+    workers: int,
+    streaming: bool = False,
+    run_id: str = None,
+    diff: bool = False,
+    session: requests.Session = None,
+):
+    """
+    Downloads and extracts the EDC datasets of several years in a thread pool,
+    while the calling thread inserts each year into duckdb as soon as its files are ready.
+    The calling thread is the only one writing to the database, so there is no lock
+    contention on the duckdb file.
+    :param conn: The duckdb connection used to insert the data
+    :param years: The years to process
+    :param workers: Maximum number of years downloaded and extracted at the same time
+    :param streaming: Whether to stream the files from the zip archives instead of extracting them
+    :param run_id: The id of the build_database run, recorded in _partition_state
+    :param diff: Whether to apply only the rows which changed, see insert_yearly_edc_data
+    :param session: The HTTP session shared by the downloads
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # The downloads run in the context of the caller, so that their spans
+        # are recorded as children of the build_database span
+        futures = {
+            executor.submit(
+                contextvars.copy_context().run,
+                download_extract_yearly_edc_data,
+                year=year,
+                streaming=streaming,
+                session=session,
+            ): year
+            for year in years
+        }
+        try:
+            for future in as_completed(futures):
+                year = futures[future]
+                insert_yearly_edc_data(
+                    conn=conn, run_id=run_id, diff=diff, **future.result()
+                )
+                logger.info(f"   Cleaning up cache for {year}...")
+                clear_yearly_edc_cache(year)
+        except Exception:
+            # Do not start downloading the remaining years if one of them failed
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def get_edc_years_to_update(
     refresh_type: Literal["all", "last", "custom"] = "last",
     custom_years: List[str] = None,
-    drop_tables: bool = False,
     check_update: bool = False,
-):
+    conn: duckdb.DuckDBPyConnection = None,
+    session: requests.Session = None,
+) -> List[str]:
     """
-    Process the EDC datasets.
-    :param refresh_type: Refresh type to run
-        - "all": Drop edc tables and import the data for every possible year.
-        - "last": Refresh the data only for the last available year
-        - "custom": Refresh the data for the years specified in the list custom_years
+    Returns the years of the EDC datasets to process
+    :param refresh_type: Refresh type to run, see process_edc_datasets
     :param custom_years: years to update
-    :param drop_tables: Whether to drop edc tables in the database before data insertion.
-    :param check_update: Whether to process only whose data has been modified from the source
-    :return:
+    :param check_update: Whether to keep only the years whose data has been modified from the source
+    :param conn: The duckdb connection used to check the update
+    :param session: The HTTP session used to check the update
+    :return: The years to process
     """
     available_years = edc_config["source"]["available_years"]
 
@@ -199,18 +519,121 @@ def process_edc_datasets(
         )
 
     if check_update:
-        years_to_update = get_edc_dataset_years_to_update(years_to_update)
-    else:
-        if drop_tables or (refresh_type == "all"):
-            drop_edc_tables()
+        with span("check_update", years=years_to_update) as check_span:
+            years_to_update = get_edc_dataset_years_to_update(
+                years_to_update, conn=conn, session=session
+            )
+            check_span.set(years_to_update=years_to_update)
+    return years_to_update
+
+
+def process_edc_datasets(
+    refresh_type: Literal["all", "last", "custom"] = "last",
+    custom_years: List[str] = None,
+    drop_tables: bool = False,
+    check_update: bool = False,
+    workers: int = 1,
+    streaming: bool = False,
+    diff: bool = False,
+    years_to_update: List[str] = None,
+    context: PipelineContext = None,
+):
+    """
+    Process the EDC datasets.
+    :param refresh_type: Refresh type to run
+        - "all": Drop edc tables and import the data for every possible year.
+        - "last": Refresh the data only for the last available year
+        - "custom": Refresh the data for the years specified in the list custom_years
+    :param custom_years: years to update
+    :param drop_tables: Whether to drop edc tables in the database before data insertion.
+    :param check_update: Whether to process only whose data has been modified from the source
+    :param workers: Number of years downloaded and extracted in parallel.
+        The data is always inserted into duckdb by a single connection.
+    :param streaming: Whether to stream the files from the zip archives into duckdb
+        instead of extracting them on disk first.
+    :param diff: Whether to apply only the rows which changed to the years already loaded
+        instead of reloading them. The tables are still dropped for the refresh type "all"
+        without check_update.
+    :param years_to_update: The years to process, as returned by get_edc_years_to_update.
+        If None, they are computed from refresh_type, custom_years and check_update.
+    :param context: The context of the pipeline run, whose connection is used.
+        If None, a new context is opened.
+    :return:
+    """
+    if workers < 1:
+        raise ValueError(
+            f"workers needs to be a positive integer, it can't be: {workers}"
+        )
 
-    logger.info(f"Launching processing of EDC datasets for years: {years_to_update}")
+    if streaming and not hasattr(os, "mkfifo"):
+        logger.warning(
+            "Streaming is not supported on this platform, files will be extracted"
+        )
+        streaming = False
+
+    with pipeline_context(context) as context:
+        if years_to_update is None:
+            years_to_update = get_edc_years_to_update(
+                refresh_type=refresh_type,
+                custom_years=custom_years,
+                check_update=check_update,
+                conn=context.conn,
+                session=context.http,
+            )
+        if check_update and not years_to_update:
+            logger.info("EDC datasets are up to date")
+            return True
 
-    for year in years_to_update:
-        download_extract_insert_yearly_edc_data(year=year)
+        conn = context.conn
+        run_id = start_ingestion_run(
+            conn=conn, refresh_type=refresh_type, years=years_to_update
+        )
+        try:
+            for file_info in edc_config["files"].values():
+                migrate_to_partition_tables(
+                    conn=conn, table_name=file_info["table_name"]
+                )
+
+            if not check_update and (drop_tables or (refresh_type == "all")):
+                drop_edc_tables(conn=conn)
+
+            logger.info(
+                f"Launching processing of EDC datasets for years: {years_to_update}"
+            )
+
+            if workers > 1 and len(years_to_update) > 1:
+                process_edc_years_in_parallel(
+                    conn=conn,
+                    years=years_to_update,
+                    workers=min(workers, len(years_to_update)),
+                    streaming=streaming,
+                    run_id=run_id,
+                    diff=diff,
+                    session=context.http,
+                )
+            else:
+                for year in years_to_update:
+                    download_extract_insert_yearly_edc_data(
+                        year=year,
+                        conn=conn,
+                        streaming=streaming,
+                        run_id=run_id,
+                        diff=diff,
+                        session=context.http,
+                    )
+        except Exception:
+            finish_ingestion_run(conn=conn, run_id=run_id, status="failed")
+            raise
+        else:
+            finish_ingestion_run(conn=conn, run_id=run_id, status="success")
+            changed_partitions = get_changed_partitions(conn=conn)
+            logger.info(
+                "Years to rebuild with the transform task: "
+                f"{'all' if changed_partitions is None else changed_partitions}"
+            )
 
     logger.info("Cleaning up cache...")
-    clear_cache(recreate_folder=False)
+    evict_cache()
     return True
 
 
@@ -219,6 +642,11 @@ def execute(
     custom_years: List[str] = None,
     drop_tables: bool = False,
     check_update: bool = False,
+    workers: int = 1,
+    streaming: bool = False,
+    optimize: bool = False,
+    diff: bool = False,
+    context: PipelineContext = None,
 ):
     """
     Execute the EDC dataset processing with specified parameters.
@@ -226,11 +654,59 @@ def execute(
     :param refresh_type: Type of refresh to perform ("all", "last", or "custom")
     :param custom_years: List of years to process when refresh_type is "custom"
     :param drop_tables: Whether to drop edc tables in the database before data insertion.
+    :param check_update: Whether to process only the years whose data has been modified from the source
+    :param workers: Number of years downloaded and extracted in parallel
+    :param streaming: Whether to stream the files from the zip archives instead of extracting them
+    :param optimize: Whether to compact and sort the database once it is built.
+        When the task runs alone and replaces tables already loaded, it is always compacted.
+    :param diff: Whether to apply only the rows which changed to the years already loaded
+    :param context: The context of the pipeline run. If None, a new context is opened.
     """
-    # Build database
-    process_edc_datasets(
-        refresh_type=refresh_type,
-        custom_years=custom_years,
-        drop_tables=drop_tables,
-        check_update=check_update,
-    )
+    standalone = context is None
+    with pipeline_context(context) as context:
+        # The update is checked first, so that an up to date database is left untouched.
+        # Without a database, every year is loaded: the connection is not opened, it
+        # would create an empty database outside of the versions.
+        check_update = check_update and os.path.exists(context.database_file)
+        years_to_update = get_edc_years_to_update(
+            refresh_type=refresh_type,
+            custom_years=custom_years,
+            check_update=check_update,
+            conn=context.conn if check_update else None,
+            session=context.http,
+        )
+        if check_update and not years_to_update and not optimize:
+            logger.info("EDC datasets are up to date, the database is left untouched")
+            return
+
+        # The database is built in a new version, the readers keep the current one meanwhile
+        with new_database_version(context):
+            # Refreshing the years already loaded frees the blocks of their previous tables,
+            # which the file keeps: up to twice the size of the data. When the task runs
+            # alone, the database is then compacted; a pipeline does it with --optimize.
+            if standalone and not optimize:
+                optimize = has_edc_tables(context.conn)
+
+            # Build database
+            with span(
+                "build_database",
+                refresh_type=refresh_type,
+                check_update=check_update,
+                workers=workers,
+                streaming=streaming,
+                diff=diff,
+            ):
+                process_edc_datasets(
+                    refresh_type=refresh_type,
+                    custom_years=custom_years,
+                    drop_tables=drop_tables,
+                    check_update=check_update,
+                    workers=workers,
+                    streaming=streaming,
+                    diff=diff,
+                    years_to_update=years_to_update,
+                    context=context,
+                )
+
+            if optimize:
+                optimize_database(context=context)
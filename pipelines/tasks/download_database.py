@@ -3,35 +3,57 @@ Download database from S3 storage.
 
 Args:
     - env (str): Environment to download from ("dev" or "prod")
+    - delta (bool): Download only the partition tables which differ from the local database
 
 Examples:
     - download_database --env prod : Download database from production environment
     - download_database --env dev  : Download database from development environment
+    - download_database --env prod --delta : Download only the years which changed since the last download
 """
 
 import logging
 
 from pipelines.config.config import get_s3_path
-from pipelines.tasks._common import DUCKDB_FILE
+from pipelines.utils.instrumentation import span
 from pipelines.utils.storage_client import ObjectStorageClient
 
+from ._common import DUCKDB_FILE
+from ._context import PipelineContext, pipeline_context
+from ._database_versions import new_database_version
+from ._delta_sync import download_database_delta
+
 logger = logging.getLogger(__name__)
 
 
-def download_database_from_storage(env):
+def download_database_from_storage(env, context: PipelineContext = None):
     """
     Download the database from Storage Object depending on the environment
     This requires setting the correct environment variables for the Scaleway credentials
+    :param context: The context of the pipeline run. If None, a new context is opened.
     """
     s3 = ObjectStorageClient()
     remote_s3_path = get_s3_path(env)
     local_db_path = DUCKDB_FILE
 
-    s3.download_object(remote_s3_path, local_db_path)
+    # The database is not downloaded again if the local one is already up to date
+    if s3.is_unchanged(local_db_path, remote_s3_path):
+        logger.info(f"✅ Base locale déjà à jour: {local_db_path}")
+        return
+
+    # The database is downloaded as a new version, the readers keep the current one meanwhile
+    with (
+        pipeline_context(context) as context,
+        new_database_version(context, copy_current=False) as version_file,
+    ):
+        s3.download_object(remote_s3_path, version_file)
     logger.info(
         f"✅ Base téléchargée depuis s3://{s3.bucket_name}/{remote_s3_path} -> {local_db_path}"
     )
 
 
-def execute(env):
-    download_database_from_storage(env)
+def execute(env, delta: bool = False, context: PipelineContext = None):
+    with span("download_database", env=env, delta=delta):
+        if delta:
+            download_database_delta(env, context=context)
+        else:
+            download_database_from_storage(env, context=context)
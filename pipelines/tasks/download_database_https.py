@@ -3,34 +3,112 @@ Download database from HTTP Scaleway object storage public link.
 
 Args:
     - env (str): Environment to download from ("dev" or "prod")
+    - segments (int): Number of byte ranges downloaded in parallel (default 1)
 
 Examples:
     - download_database_https --env prod : Download database from production environment
     - download_database_https --env dev  : Download database from development environment
+    - download_database_https --env prod --segments 8 : Download database with 8 parallel connections
+
+An interrupted download is resumed on the next run. The database is not downloaded again
+while the current version is the one downloaded last, and the remote file is unchanged.
 """
 
+import json
 import logging
+import os
+import shutil
 
 from pipelines.config.config import get_s3_path
-from pipelines.tasks._common import DUCKDB_FILE
+from pipelines.utils.connections import with_retries
 from pipelines.utils.storage_client import ObjectStorageClient
-from ._common import download_file_from_https
+from ._common import (
+    DOWNLOAD_TIMEOUT,
+    DUCKDB_FILE,
+    HEADERS_SUFFIX,
+    download_file_from_https,
+    get_cache_path,
+)
+from ._context import PipelineContext, pipeline_context
+from ._database_versions import (
+    get_current_database_version,
+    get_database_version_source,
+    new_database_version,
+    write_database_version_source,
+)
 
 logger = logging.getLogger(__name__)
 
 
-def download_database_from_https(env):
+def is_current_version_up_to_date(url: str, validators: dict) -> bool:
+    """
+    Whether the version of the database behind DUCKDB_FILE was downloaded from url,
+    and the remote file has not changed since
+    :param url: The url of the database
+    :param validators: The validators (ETag, Last-Modified) of the remote file
+    :return: True if the current version is the remote file
+    """
+    source = get_database_version_source(get_current_database_version())
+    if source is None or source.get("url") != url:
+        return False
+    return any(
+        validators[key] and validators[key] == source.get(key) for key in validators
+    )
+
+
+def download_database_from_https(
+    env, segments: int = 1, context: PipelineContext = None
+):
     """
     Download the database from Storage Object depending on the environment
     This requires setting the correct environment variables for the Scaleway credentials
+    :param context: The context of the pipeline run. If None, a new context is opened.
     """
     s3 = ObjectStorageClient()
     url = f"https://{s3.bucket_name}.{s3.endpoint_url.split('https://')[1]}/{get_s3_path(env)}"
     local_db_path = DUCKDB_FILE
 
-    download_file_from_https(url=url, filepath=local_db_path)
+    with pipeline_context(context) as context:
+
+        def head():
+            response = context.http.head(
+                url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT
+            )
+            response.raise_for_status()
+            return response
+
+        response = with_retries(head, "Request of the database")
+        validators = {
+            "etag": response.headers.get("etag"),
+            "last_modified": response.headers.get("last-modified"),
+        }
+        if is_current_version_up_to_date(url, validators):
+            logger.info(f"✅ Base locale déjà à jour: {local_db_path}")
+            return
+
+        # The download goes through the download cache, so that an interrupted download
+        # is resumed on the next run. The file is then moved into the new version.
+        download_path = get_cache_path("database", env, "data.duckdb")
+        download_file_from_https(
+            url=url, filepath=download_path, segments=segments, session=context.http
+        )
+        with open(download_path + HEADERS_SUFFIX) as f:
+            downloaded = json.load(f)
+
+        # The readers keep the current version until the new one is complete
+        with new_database_version(context, copy_current=False) as version_file:
+            shutil.move(download_path, version_file)
+            os.remove(download_path + HEADERS_SUFFIX)
+            write_database_version_source(
+                version_file,
+                {
+                    "url": url,
+                    "etag": downloaded.get("etag"),
+                    "last_modified": downloaded.get("last_modified"),
+                },
+            )
     logger.info(f"✅ Base téléchargée depuis s3 via HTTPS: {url} -> {local_db_path}")
 
 
-def execute(env):
-    download_database_from_https(env)
+def execute(env, segments: int = 1, context: PipelineContext = None):
+    download_database_from_https(env, segments=segments, context=context)
@@ -0,0 +1,302 @@
+"""
+Export the communes with their water conformity as GeoParquet files for the webapp map.
+
+The commune geometries come from a local file (GeoJSON, Shapefile, GeoPackage... any
+format read by the DuckDB spatial extension), e.g. the administrative boundaries of
+the communes published by IGN. They are joined with the conformity of the prélèvements
+of one year in each commune, then simplified for several zoom levels: one ZSTD
+compressed GeoParquet file per zoom level, whose geometries are simplified to about one
+pixel at this zoom. A manifest.json lists the files with the zoom levels they cover, so
+that the map loads static files instead of querying the database.
+
+Args:
+    - env (str): Environment to upload to ("dev" or "prod")
+    - geometries (str): File of the commune geometries (default database/geo/communes.geojson)
+    - code-column (str): Column of the geometries file holding the INSEE code of the commune (default "code")
+    - source-crs (str): Coordinate reference system of the geometries file (default EPSG:4326)
+    - year (int): Year of the conformity data (default the last year in the database)
+    - skip-upload (bool): Only write the GeoParquet files locally
+
+Examples:
+    - export_map --env dev : Export the map of the last year and upload it to development environment
+    - export_map --env prod --year 2023 : Export the map of the year 2023
+    - export_map --geometries COMMUNE.shp --code-column INSEE_COM --source-crs EPSG:2154 --skip-upload : Export from the IGN shapefile in Lambert-93, without uploading
+"""
+
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Dict, List
+
+import duckdb
+from tqdm import tqdm
+
+from pipelines.config.config import get_s3_path
+from pipelines.utils.storage_client import ObjectStorageClient
+
+from ._common import DATABASE_FOLDER, MAP_FOLDER, quote_identifier, tqdm_common
+from ._context import PipelineContext, pipeline_context
+
+logger = logging.getLogger(__name__)
+
+GEOMETRIES_FILE = os.path.join(DATABASE_FOLDER, "geo", "communes.geojson")
+MANIFEST_FILE = "manifest.json"
+# Each file is used from its zoom level up to the next one
+MAP_ZOOM_LEVELS = [5, 8, 11]
+
+
+def get_simplify_tolerance(zoom: int) -> float:
+    """
+    Returns the tolerance used to simplify the geometries for a zoom level:
+    the size of a pixel of a 256 px web map tile at the equator, in degrees
+    :param zoom: The zoom level of the map
+    :return: The tolerance in degrees
+    """
+    return 360 / (256 * 2**zoom)
+
+
+def load_communes_geometries(
+    conn: duckdb.DuckDBPyConnection,
+    geometries_file: str,
+    code_column: str,
+    source_crs: str,
+):
+    """
+    Load the commune geometries into the temporary table map_geometries, in WGS 84
+    :param conn: The duckdb connection to use, with the spatial extension loaded
+    :param geometries_file: The file of the geometries
+    :param code_column: The column holding the INSEE code of the commune
+    :param source_crs: The coordinate reference system of the file, e.g. EPSG:2154
+    """
+    parameters = {"geometries_file": geometries_file}
+    geometry = "geom"
+    if source_crs != "EPSG:4326":
+        geometry = "ST_Transform(geom, $source_crs, 'EPSG:4326', always_xy := true)"
+        parameters["source_crs"] = source_crs
+    query = f"""
+        CREATE OR REPLACE TEMP TABLE map_geometries AS
+        SELECT
+            CAST({quote_identifier(code_column)} AS VARCHAR)    AS inseecommune,
+            {geometry}                                          AS geometry
+        FROM ST_Read($geometries_file)
+        WHERE geom IS NOT NULL
+        ;
+    """
+    conn.execute(query, parameters)
+
+
+def compute_communes_conformity(conn: duckdb.DuckDBPyConnection, year: int):
+    """
+    Compute the conformity of the prélèvements of one year for each commune, into
+    the temporary table map_conformity. A prélèvement is counted in every commune
+    supplied by its réseau.
+    :param conn: The duckdb connection to use
+    :param year: The year of the data
+    """
+    query = """
+        CREATE OR REPLACE TEMP TABLE map_conformity AS
+        WITH communes_reseaux AS (
+            SELECT inseecommune, cdreseau, ANY_VALUE(nomcommune) AS nomcommune
+            FROM edc_communes
+            WHERE de_partition = $year
+            GROUP BY inseecommune, cdreseau
+        ),
+        prelevements AS (
+            SELECT DISTINCT
+                cdreseau,
+                referenceprel,
+                dateprel,
+                plvconformitebacterio = 'N' OR plvconformitechimique = 'N' AS non_conforme
+            FROM edc_prelevements
+            WHERE de_partition = $year
+        )
+        SELECT
+            communes_reseaux.inseecommune,
+            ANY_VALUE(communes_reseaux.nomcommune)                      AS nomcommune,
+            CAST($year AS SMALLINT)                                     AS de_partition,
+            COUNT(DISTINCT prelevements.referenceprel)                  AS nb_prelevements,
+            COUNT(DISTINCT prelevements.referenceprel)
+                FILTER (WHERE prelevements.non_conforme)                AS nb_prelevements_non_conformes,
+            MAX(prelevements.dateprel)                                  AS dernier_prelevement
+        FROM communes_reseaux
+        LEFT JOIN prelevements USING (cdreseau)
+        GROUP BY communes_reseaux.inseecommune
+        ;
+    """
+    conn.execute(query, {"year": year})
+
+
+def write_map_zoom_level(
+    conn: duckdb.DuckDBPyConnection, zoom: int, output_file: str
+) -> Dict:
+    """
+    Write the communes, their conformity and their geometries simplified for a zoom level
+    as a GeoParquet file. The communes without data for the year are kept, with empty values.
+    :param conn: The duckdb connection to use, where map_geometries and map_conformity exist
+    :param zoom: The zoom level
+    :param output_file: The GeoParquet file to write
+    :return: The number of communes and the size of the file
+    """
+    tolerance = get_simplify_tolerance(zoom)
+    query = f"""
+        COPY (
+            SELECT
+                map_geometries.inseecommune,
+                map_conformity.nomcommune,
+                map_conformity.de_partition,
+                map_conformity.nb_prelevements,
+                map_conformity.nb_prelevements_non_conformes,
+                ROUND(
+                    1 - map_conformity.nb_prelevements_non_conformes
+                        / NULLIF(map_conformity.nb_prelevements, 0),
+                    4
+                )                                               AS taux_conformite,
+                map_conformity.dernier_prelevement,
+                ST_SimplifyPreserveTopology(map_geometries.geometry, {tolerance}) AS geometry
+            FROM map_geometries
+            LEFT JOIN map_conformity USING (inseecommune)
+            ORDER BY map_geometries.inseecommune
+        ) TO '{output_file}' (FORMAT PARQUET, COMPRESSION ZSTD)
+        ;
+    """
+    conn.execute(query)
+    conn.execute("SELECT COUNT(*) FROM map_geometries;")
+    return {
+        "row_count": conn.fetchone()[0],
+        "byte_size": os.path.getsize(output_file),
+    }
+
+
+def export_map(
+    geometries_file: str = None,
+    code_column: str = "code",
+    source_crs: str = "EPSG:4326",
+    year: int = None,
+    output_folder: str = None,
+    zoom_levels: List[int] = None,
+    context: PipelineContext = None,
+) -> Dict:
+    """
+    Write the GeoParquet files of the map for every zoom level, and their manifest
+    :param geometries_file: The file of the commune geometries. Defaults to GEOMETRIES_FILE.
+    :param code_column: The column of the file holding the INSEE code of the commune
+    :param source_crs: The coordinate reference system of the file
+    :param year: The year of the conformity data. Defaults to the last year in the database.
+    :param output_folder: The folder where the files are written. Defaults to MAP_FOLDER.
+    :param zoom_levels: The zoom levels to write. Defaults to MAP_ZOOM_LEVELS.
+    :param context: The context of the pipeline run. If None, a new context is opened.
+    :return: The manifest
+    """
+    if geometries_file is None:
+        geometries_file = GEOMETRIES_FILE
+    if output_folder is None:
+        output_folder = MAP_FOLDER
+    if zoom_levels is None:
+        zoom_levels = MAP_ZOOM_LEVELS
+    if not os.path.exists(geometries_file):
+        raise FileNotFoundError(
+            f"Commune geometries not found: {geometries_file}. "
+            "Download the administrative boundaries of the communes there, "
+            "or pass another file with --geometries."
+        )
+    os.makedirs(output_folder, exist_ok=True)
+
+    with pipeline_context(context) as context:
+        conn = context.conn
+        conn.execute("INSTALL spatial;")
+        conn.execute("LOAD spatial;")
+        if year is None:
+            conn.execute("SELECT MAX(de_partition) FROM edc_prelevements;")
+            year = conn.fetchone()[0]
+        logger.info(f"Exporting the map of the communes for {year}...")
+
+        load_communes_geometries(
+            conn=conn,
+            geometries_file=geometries_file,
+            code_column=code_column,
+            source_crs=source_crs,
+        )
+        compute_communes_conformity(conn=conn, year=year)
+
+        manifest = {
+            "generated_at": datetime.now().isoformat(timespec="seconds"),
+            "format": "geoparquet",
+            "crs": "EPSG:4326",
+            "de_partition": year,
+            "zoom_levels": [],
+        }
+        for i, zoom in enumerate(
+            tqdm(zoom_levels, unit="zoom", desc="Writing", **tqdm_common)
+        ):
+            file = f"communes_z{zoom}.parquet"
+            manifest["zoom_levels"].append(
+                {
+                    "min_zoom": zoom,
+                    "max_zoom": zoom_levels[i + 1] - 1
+                    if i + 1 < len(zoom_levels)
+                    else None,
+                    "tolerance": get_simplify_tolerance(zoom),
+                    "file": file,
+                    **write_map_zoom_level(
+                        conn=conn,
+                        zoom=zoom,
+                        output_file=os.path.join(output_folder, file),
+                    ),
+                }
+            )
+        conn.execute("DROP TABLE map_geometries;")
+        conn.execute("DROP TABLE map_conformity;")
+
+    with open(os.path.join(output_folder, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def upload_map_to_storage(env: str, manifest: Dict, output_folder: str = None):
+    """
+    Upload the GeoParquet files of the map and their manifest to Storage Object
+    This requires setting the correct environment variables for the Scaleway credentials
+    :param env: The environment to upload to
+    :param manifest: The manifest of the files to upload
+    :param output_folder: The folder where the files were written. Defaults to MAP_FOLDER.
+    """
+    if output_folder is None:
+        output_folder = MAP_FOLDER
+    s3 = ObjectStorageClient()
+    for zoom_level in manifest["zoom_levels"]:
+        s3.upload_object(
+            local_path=os.path.join(output_folder, zoom_level["file"]),
+            file_key=get_s3_path(env, f"map/{zoom_level['file']}"),
+            public_read=True,
+            skip_unchanged=True,
+        )
+
+    # The manifest is uploaded last, so that it never lists a file not uploaded yet
+    s3_path = get_s3_path(env, f"map/{MANIFEST_FILE}")
+    s3.upload_object(
+        local_path=os.path.join(output_folder, MANIFEST_FILE),
+        file_key=s3_path,
+        public_read=True,
+    )
+    logger.info(f"✅ Carte uploadée sur s3://{s3.bucket_name}/{s3_path}")
+
+
+def execute(
+    env: str,
+    geometries_file: str = None,
+    code_column: str = "code",
+    source_crs: str = "EPSG:4326",
+    year: int = None,
+    skip_upload: bool = False,
+    context: PipelineContext = None,
+):
+    manifest = export_map(
+        geometries_file=geometries_file,
+        code_column=code_column,
+        source_crs=source_crs,
+        year=year,
+        context=context,
+    )
+    if not skip_upload:
+        upload_map_to_storage(env=env, manifest=manifest)
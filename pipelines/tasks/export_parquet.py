@@ -0,0 +1,195 @@
+"""
+Export the EDC tables as Parquet files and upload them to S3 storage.
+
+Each table is written as ZSTD compressed Parquet files partitioned by year (Hive layout,
+e.g. edc_resultats/de_partition=2024/data_0.parquet), optionally by département too.
+A manifest.json lists the files with their number of rows and size. The clients can then
+read only the partitions they need, e.g. with DuckDB httpfs:
+    SELECT * FROM read_parquet('https://.../edc_resultats/de_partition=2024/*.parquet')
+When partitioned by département, read cddept as a string to keep its leading zeros:
+    read_parquet('...', hive_partitioning=true, hive_types={'cddept': VARCHAR})
+
+Args:
+    - env (str): Environment to upload to ("dev" or "prod")
+    - by-dept (bool): Also partition by département (cddept) the tables having this column
+    - skip-upload (bool): Only write the Parquet files locally
+
+Examples:
+    - export_parquet --env dev : Export the tables and upload them to development environment
+    - export_parquet --env prod --by-dept : Export the tables partitioned by year and département
+    - export_parquet --skip-upload : Export the tables in database/parquet without uploading them
+"""
+
+import json
+import logging
+import os
+import shutil
+from datetime import datetime
+from typing import Dict, List
+
+import duckdb
+from tqdm import tqdm
+
+from pipelines.config.config import get_s3_path
+from pipelines.utils.storage_client import ObjectStorageClient
+
+from ._common import PARQUET_FOLDER, tqdm_common
+from ._config_edc import get_edc_config
+from ._context import PipelineContext, pipeline_context
+
+logger = logging.getLogger(__name__)
+edc_config = get_edc_config()
+
+MANIFEST_FILE = "manifest.json"
+
+
+def get_partition_columns(
+    conn: duckdb.DuckDBPyConnection, table_name: str, by_dept: bool = False
+) -> List[str]:
+    """
+    Returns the columns used to partition the Parquet files of a table
+    :param conn: The duckdb connection to use
+    :param table_name: The table to export
+    :param by_dept: Whether to also partition by cddept, if the table has this column
+    :return: The list of the partition columns
+    """
+    partition_columns = ["de_partition"]
+    if by_dept:
+        query = """
+            SELECT COUNT(*)
+            FROM information_schema.columns
+            WHERE table_name = ? AND column_name = 'cddept'
+            ;
+        """
+        conn.execute(query, (table_name,))
+        if conn.fetchone()[0] == 1:
+            partition_columns.append("cddept")
+    return partition_columns
+
+
+def export_table_to_parquet(
+    conn: duckdb.DuckDBPyConnection,
+    table_name: str,
+    output_folder: str,
+    partition_columns: List[str],
+) -> List[Dict]:
+    """
+    Write a table as Parquet files partitioned with the Hive layout
+    :param conn: The duckdb connection to use
+    :param table_name: The table to export
+    :param output_folder: The folder where the partitions of the table are written
+    :param partition_columns: The columns to partition by
+    :return: The list of the files written, with their path relative to output_folder,
+        their number of rows and their size in bytes
+    """
+    shutil.rmtree(output_folder, ignore_errors=True)
+    query = f"""
+        COPY (SELECT * FROM {table_name})
+        TO '{output_folder}'
+        (FORMAT PARQUET, COMPRESSION ZSTD, PARTITION_BY ({", ".join(partition_columns)}))
+        ;
+    """
+    conn.execute(query)
+
+    query = """
+        SELECT file_name, num_rows
+        FROM parquet_file_metadata(?)
+        ORDER BY file_name
+        ;
+    """
+    conn.execute(query, (os.path.join(output_folder, "**", "*.parquet"),))
+    return [
+        {
+            "path": os.path.relpath(file_name, output_folder),
+            "row_count": num_rows,
+            "byte_size": os.path.getsize(file_name),
+        }
+        for file_name, num_rows in conn.fetchall()
+    ]
+
+
+def export_edc_tables_to_parquet(
+    by_dept: bool = False, output_folder: str = None, context: PipelineContext = None
+) -> Dict:
+    """
+    Export the EDC tables as Parquet files, and write the manifest describing them
+    :param by_dept: Whether to also partition by cddept the tables having this column
+    :param output_folder: The folder where the Parquet files and the manifest are written.
+        Defaults to PARQUET_FOLDER.
+    :param context: The context of the pipeline run. If None, a new context is opened.
+    :return: The manifest
+    """
+    if output_folder is None:
+        output_folder = PARQUET_FOLDER
+    os.makedirs(output_folder, exist_ok=True)
+    manifest = {
+        "generated_at": datetime.now().isoformat(timespec="seconds"),
+        "format": "parquet",
+        "compression": "zstd",
+        "tables": {},
+    }
+
+    with pipeline_context(context) as context:
+        conn = context.conn
+        for file_info in edc_config["files"].values():
+            table_name = file_info["table_name"]
+            logger.info(f"Exporting {table_name} as Parquet...")
+            partition_columns = get_partition_columns(conn, table_name, by_dept)
+            manifest["tables"][table_name] = {
+                "partition_by": partition_columns,
+                "files": export_table_to_parquet(
+                    conn=conn,
+                    table_name=table_name,
+                    output_folder=os.path.join(output_folder, table_name),
+                    partition_columns=partition_columns,
+                ),
+            }
+
+    with open(os.path.join(output_folder, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def upload_parquet_to_storage(env: str, manifest: Dict, output_folder: str = None):
+    """
+    Upload the Parquet files and their manifest to Storage Object depending on the environment
+    This requires setting the correct environment variables for the Scaleway credentials
+    :param env: The environment to upload to
+    :param manifest: The manifest of the Parquet files to upload
+    :param output_folder: The folder where the Parquet files and the manifest were written.
+        Defaults to PARQUET_FOLDER.
+    """
+    if output_folder is None:
+        output_folder = PARQUET_FOLDER
+    s3 = ObjectStorageClient()
+    files = [
+        os.path.join(table_name, file["path"])
+        for table_name, table in manifest["tables"].items()
+        for file in table["files"]
+    ]
+    for file in tqdm(files, unit="file", desc="Uploading", **tqdm_common):
+        s3.upload_object(
+            local_path=os.path.join(output_folder, file),
+            file_key=get_s3_path(env, f"parquet/{file}"),
+            public_read=True,
+        )
+
+    # The manifest is uploaded last, so that it never lists a file not uploaded yet
+    s3_path = get_s3_path(env, f"parquet/{MANIFEST_FILE}")
+    s3.upload_object(
+        local_path=os.path.join(output_folder, MANIFEST_FILE),
+        file_key=s3_path,
+        public_read=True,
+    )
+    logger.info(f"✅ Parquet uploadés sur s3://{s3.bucket_name}/{s3_path}")
+
+
+def execute(
+    env: str,
+    by_dept: bool = False,
+    skip_upload: bool = False,
+    context: PipelineContext = None,
+):
+    manifest = export_edc_tables_to_parquet(by_dept=by_dept, context=context)
+    if not skip_upload:
+        upload_parquet_to_storage(env=env, manifest=manifest)
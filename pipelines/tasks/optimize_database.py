@@ -0,0 +1,176 @@
+"""
+Compact the database and sort the EDC tables to speed up the queries.
+
+The database is copied into a new file, table by table, the EDC tables being sorted by
+the sort_keys of _config_edc.py. The new file has no free blocks left by the previous
+refreshes, and its row groups are ordered, so that the queries filtering on de_partition,
+cddept, referenceprel... can skip most of them. The new file then replaces the database,
+as a new version of the database (see _database_versions.py).
+
+Examples:
+    - optimize_database : Compact and sort the database
+    - build_database --refresh-type all --optimize : Build the database, then optimize it
+"""
+
+import logging
+import os
+
+import duckdb
+
+from pipelines.utils.connections import connect_duckdb
+from pipelines.utils.instrumentation import span
+
+from ._common import DUCKDB_FILE
+from ._config_edc import get_edc_config
+from ._context import PipelineContext, pipeline_context
+from ._database_versions import new_database_version
+from ._partitions import get_partition_tables
+
+logger = logging.getLogger(__name__)
+edc_config = get_edc_config()
+
+
+def get_tables_sort_keys(conn: duckdb.DuckDBPyConnection) -> dict:
+    """
+    Returns the sort keys of the EDC partition tables found in the database
+    :param conn: The duckdb connection to use
+    :return: dict of table name -> list of the columns to sort the table by
+    """
+    sort_keys = {}
+    for file_info in edc_config["files"].values():
+        for table_name in get_partition_tables(conn, file_info["table_name"]):
+            sort_keys[table_name] = file_info["sort_keys"]
+    return sort_keys
+
+
+def copy_sorted_database(
+    conn: duckdb.DuckDBPyConnection, source: str, target: str, sort_keys: dict
+):
+    """
+    Copy every schema, table and view of an attached database into another one
+    :param conn: The duckdb connection where both databases are attached
+    :param source: The alias of the database to copy
+    :param target: The alias of the new database
+    :param sort_keys: dict of table name -> list of the columns to sort the table by
+    """
+    conn.execute(f"USE {target};")
+
+    query = """
+        SELECT schema_name
+        FROM duckdb_schemas()
+        WHERE database_name = ? AND NOT internal
+        ;
+    """
+    for (schema_name,) in conn.execute(query, (source,)).fetchall():
+        conn.execute(f"CREATE SCHEMA IF NOT EXISTS {schema_name};")
+
+    # The tables are created from their original statement to keep their constraints
+    query = """
+        SELECT schema_name, table_name, sql
+        FROM duckdb_tables()
+        WHERE database_name = ?
+        ORDER BY schema_name, table_name
+        ;
+    """
+    for schema_name, table_name, sql in conn.execute(query, (source,)).fetchall():
+        conn.execute(sql)
+        query = """
+            SELECT column_name
+            FROM duckdb_columns()
+            WHERE database_name = ? AND schema_name = ? AND table_name = ?
+            ;
+        """
+        columns = [
+            row[0]
+            for row in conn.execute(query, (source, schema_name, table_name)).fetchall()
+        ]
+        order_by = [key for key in sort_keys.get(table_name, []) if key in columns]
+        query = f"""
+            INSERT INTO {target}.{schema_name}.{table_name}
+            SELECT *
+            FROM {source}.{schema_name}.{table_name}
+            {"ORDER BY " + ", ".join(order_by) if order_by else ""}
+            ;
+        """
+        conn.execute(query)
+        logger.info(f"   Copied table {schema_name}.{table_name}")
+
+    # A view can only be created once the views it depends on exist
+    query = """
+        SELECT sql
+        FROM duckdb_views()
+        WHERE database_name = ? AND NOT internal
+        ;
+    """
+    views = [row[0] for row in conn.execute(query, (source,)).fetchall()]
+    while views:
+        remaining_views = []
+        for sql in views:
+            try:
+                conn.execute(sql)
+            except duckdb.CatalogException:
+                remaining_views.append(sql)
+        if len(remaining_views) == len(views):
+            raise RuntimeError(f"Views could not be recreated: {remaining_views}")
+        views = remaining_views
+
+
+def optimize_database(database_file: str = None, context: PipelineContext = None):
+    """
+    Replace the database by a compacted copy whose EDC tables are sorted
+    :param database_file: The duckdb database to optimize. Defaults to the database of
+        the context, or to DUCKDB_FILE.
+    :param context: The context of the pipeline run, whose connection is released
+        before the database file is replaced
+    """
+    if database_file is None:
+        database_file = DUCKDB_FILE if context is None else context.database_file
+    if context is not None:
+        context.release_connection()
+    # Replace the file itself, not the link to the current version
+    database_file = os.path.realpath(database_file)
+    optimized_file = database_file + ".optimized"
+    if os.path.exists(optimized_file):
+        os.remove(optimized_file)
+
+    # Merge the write-ahead log into the database before copying it
+    conn = connect_duckdb(database_file)
+    conn.execute("CHECKPOINT;")
+    conn.close()
+    size_before = os.path.getsize(database_file)
+
+    with span("optimize_database", bytes=size_before) as optimize_span:
+        logger.info(f"Optimizing {database_file}...")
+        conn = connect_duckdb(":memory:")
+        try:
+            conn.execute(f"ATTACH '{database_file}' AS source (READ_ONLY);")
+            conn.execute(f"ATTACH '{optimized_file}' AS optimized;")
+            conn.execute("USE source;")
+            sort_keys = get_tables_sort_keys(conn)
+            copy_sorted_database(
+                conn=conn, source="source", target="optimized", sort_keys=sort_keys
+            )
+            conn.execute("ANALYZE;")
+            conn.execute("CHECKPOINT optimized;")
+            conn.execute("USE memory;")
+            conn.execute("DETACH optimized;")
+            conn.execute("DETACH source;")
+        except Exception:
+            conn.close()
+            if os.path.exists(optimized_file):
+                os.remove(optimized_file)
+            raise
+        conn.close()
+
+        os.replace(optimized_file, database_file)
+        optimize_span.set(optimized_bytes=os.path.getsize(database_file))
+    size_after = os.path.getsize(database_file)
+    logger.info(
+        f"✅ Database optimized: {size_before / 1024**2:.1f} MB -> {size_after / 1024**2:.1f} MB"
+    )
+    return True
+
+
+def execute(context: PipelineContext = None):
+    with pipeline_context(context) as context, new_database_version(context):
+        optimize_database(context=context)
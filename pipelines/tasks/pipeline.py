@@ -0,0 +1,294 @@
+"""
+Run the whole synchronization of the database as one pipeline, sharing a single duckdb
+connection: download the database from Storage, update it with the EDC datasets which
+changed, optionally rebuild the dbt models of the updated years and export the Parquet
+files, then upload the database.
+
+The stages form a dependency graph, run in the order of their dependencies. The stages
+ready at the same time run concurrently, e.g. the Parquet export and the upload of the
+database once it is updated. While the database is updated, the next years are
+downloaded while the previous ones are loaded (see --workers). A checkpoint is written
+after every stage: with --resume, a failed run continues from the stage which failed
+instead of downloading the database again.
+
+Args:
+    - env (str): Environment to download from and upload to ("dev" or "prod")
+    - workers (int): Number of years downloaded and extracted in parallel (default 5)
+    - streaming (bool): Stream the files from the zip archives instead of extracting them
+    - delta (bool): Download and upload only the partition tables which changed
+    - diff (bool): Apply only the rows which changed to the years already loaded
+    - optimize (bool): Compact and sort the database once it is updated
+    - transform (bool): Also rebuild the dbt models of the updated years before the upload.
+      A failing dbt model or test then stops the pipeline before the upload.
+    - export-parquet (bool): Also export the EDC tables as Parquet files
+    - resume (bool): Skip the stages already done by the last run, if it failed
+
+Examples:
+    - pipeline --env prod : Synchronize the EDC tables of the production database
+    - pipeline --env prod --transform : Also rebuild the dbt models, and upload them
+    - pipeline --env prod --resume : Continue the last run from the stage which failed
+    - pipeline --env dev --delta --export-parquet : Synchronize the development database
+      with the delta files, and export it as Parquet
+"""
+
+import contextvars
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from graphlib import TopologicalSorter
+from typing import Dict, List
+
+from pipelines.utils.instrumentation import span
+
+from . import build_database, download_database, export_parquet, upload_database
+from . import transform as dbt_transform
+from ._common import DATABASE_FOLDER
+from ._context import PipelineContext, pipeline_context
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_FILE = os.path.join(DATABASE_FOLDER, "pipeline_checkpoint.json")
+
+
+def get_pipeline_stages(
+    env: str,
+    workers: int = 5,
+    streaming: bool = False,
+    delta: bool = False,
+    diff: bool = False,
+    optimize: bool = False,
+    transform: bool = False,
+    export: bool = False,
+) -> Dict[str, Dict]:
+    """
+    Returns the stages of the pipeline
+    :param env: The environment to download from and upload to
+    :param workers: Number of years downloaded and extracted in parallel
+    :param streaming: Whether to stream the files from the zip archives
+    :param delta: Whether to download and upload only the partition tables which changed
+    :param diff: Whether to apply only the rows which changed to the years already loaded
+    :param optimize: Whether to compact and sort the database once it is updated
+    :param transform: Whether to rebuild the dbt models before the upload
+    :param export: Whether to also export the EDC tables as Parquet files
+    :return: dict of stage name -> dict with the stages it depends on ("depends_on")
+        and the function running it with a context ("run")
+    """
+    stages = {
+        "download_database": {
+            "depends_on": [],
+            "run": lambda context: download_database.execute(
+                env, delta=delta, context=context
+            ),
+        },
+        "build_database": {
+            "depends_on": ["download_database"],
+            "run": lambda context: build_database.execute(
+                refresh_type="all",
+                check_update=True,
+                workers=workers,
+                streaming=streaming,
+                optimize=optimize,
+                diff=diff,
+                context=context,
+            ),
+        },
+    }
+    # The last stage writing the database, the next ones only read it
+    updated_by = "build_database"
+    if transform:
+        stages["transform"] = {
+            "depends_on": ["build_database"],
+            "run": lambda context: dbt_transform.execute(context=context),
+        }
+        updated_by = "transform"
+    stages["upload_database"] = {
+        "depends_on": [updated_by],
+        "run": lambda context: upload_database.execute(
+            env, delta=delta, context=context
+        ),
+    }
+    if export:
+        # Run alongside upload_database, both only read the database
+        stages["export_parquet"] = {
+            "depends_on": [updated_by],
+            "run": lambda context: export_parquet.execute(env, context=context),
+        }
+    return stages
+
+
+def get_stages_batches(stages: Dict[str, Dict]) -> List[List[str]]:
+    """
+    Returns the batches of stages, in the order in which they run: the stages of a batch
+    only depend on the stages of the previous batches, so they can run concurrently
+    :param stages: The stages, see get_pipeline_stages
+    :return: The names of the stages of each batch
+    """
+    sorter = TopologicalSorter(
+        {name: stage["depends_on"] for name, stage in stages.items()}
+    )
+    sorter.prepare()
+    batches = []
+    while sorter.is_active():
+        batch = sorted(sorter.get_ready())
+        batches.append(batch)
+        sorter.done(*batch)
+    return batches
+
+
+def read_checkpoint(checkpoint_file: str) -> Dict:
+    """Returns the checkpoint of the last run, or None if there is none"""
+    if not os.path.exists(checkpoint_file):
+        return None
+    with open(checkpoint_file) as f:
+        return json.load(f)
+
+
+def write_checkpoint(checkpoint_file: str, checkpoint: Dict):
+    """Write the checkpoint of the run, replacing the previous one at once"""
+    os.makedirs(os.path.dirname(os.path.abspath(checkpoint_file)), exist_ok=True)
+    with open(checkpoint_file + ".part", "w") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(checkpoint_file + ".part", checkpoint_file)
+
+
+def run_pipeline(
+    stages: Dict[str, Dict],
+    parameters: Dict,
+    resume: bool = False,
+    checkpoint_file: str = None,
+    context: PipelineContext = None,
+) -> Dict:
+    """
+    Run the stages in the order of their dependencies, writing the checkpoint after each one
+    :param stages: The stages, see get_pipeline_stages
+    :param parameters: The parameters of the run, recorded in the checkpoint. A run is
+        only resumed with the same parameters.
+    :param resume: Whether to skip the stages done by the last run, if it failed
+    :param checkpoint_file: The checkpoint file. Defaults to CHECKPOINT_FILE.
+    :param context: The context of the pipeline run. If None, a new context is opened.
+    :return: The checkpoint of the run
+    """
+    if checkpoint_file is None:
+        checkpoint_file = CHECKPOINT_FILE
+
+    done = {}
+    previous = read_checkpoint(checkpoint_file)
+    if resume and previous is not None and previous["status"] != "success":
+        if previous["parameters"] != parameters:
+            raise ValueError(
+                f"The last run had other parameters: {previous['parameters']}. "
+                "Run the pipeline again without --resume."
+            )
+        done = {
+            name: stage
+            for name, stage in previous["stages"].items()
+            if stage["status"] == "success"
+        }
+        logger.info(f"Resuming the last run, skipping the stages: {list(done)}")
+    elif resume:
+        logger.info("No failed run to resume, running every stage")
+
+    checkpoint = {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "parameters": parameters,
+        "status": "running",
+        "stages": done,
+    }
+    write_checkpoint(checkpoint_file, checkpoint)
+
+    def run_stage(name: str, stage_context: PipelineContext) -> Dict:
+        logger.info(f"Running the {name} stage...")
+        start_time = time.perf_counter()
+        try:
+            stages[name]["run"](stage_context)
+        except Exception as ex:
+            return {"status": "failed", "error": repr(ex), "exception": ex}
+        return {
+            "status": "success",
+            "finished_at": datetime.now().isoformat(timespec="seconds"),
+            "duration_s": round(time.perf_counter() - start_time, 3),
+        }
+
+    def run_stage_alone(name: str) -> Dict:
+        # A stage running alongside others gets its own connection to the database
+        with PipelineContext() as stage_context:
+            return run_stage(name, stage_context)
+
+    with pipeline_context(context) as context, span("pipeline", **parameters):
+        for batch in get_stages_batches(stages):
+            names = [name for name in batch if name not in done]
+            if len(names) == 1:
+                results = {names[0]: run_stage(names[0], context)}
+            elif names:
+                # The connection of the pipeline is closed first, so that every change
+                # is written to the database file read by the stages
+                context.release_connection()
+                with ThreadPoolExecutor(max_workers=len(names)) as executor:
+                    # The stages run in the context of the caller, so that their spans
+                    # are recorded as children of the pipeline span
+                    futures = {
+                        name: executor.submit(
+                            contextvars.copy_context().run, run_stage_alone, name
+                        )
+                        for name in names
+                    }
+                results = {name: future.result() for name, future in futures.items()}
+            else:
+                continue
+
+            # The stages of a batch are all recorded, even if one of them failed
+            errors = {
+                name: result.pop("exception")
+                for name, result in results.items()
+                if result["status"] == "failed"
+            }
+            checkpoint["stages"].update(results)
+            if errors:
+                checkpoint["status"] = "failed"
+            write_checkpoint(checkpoint_file, checkpoint)
+            for name in errors:
+                logger.error(f"The {name} stage failed, continue from it with --resume")
+            if errors:
+                raise next(iter(errors.values()))
+
+    checkpoint["status"] = "success"
+    write_checkpoint(checkpoint_file, checkpoint)
+    logger.info("✅ Pipeline done")
+    return checkpoint
+
+
+def execute(
+    env: str,
+    workers: int = 5,
+    streaming: bool = False,
+    delta: bool = False,
+    diff: bool = False,
+    optimize: bool = False,
+    transform: bool = False,
+    export: bool = False,
+    resume: bool = False,
+):
+    stages = get_pipeline_stages(
+        env=env,
+        workers=workers,
+        streaming=streaming,
+        delta=delta,
+        diff=diff,
+        optimize=optimize,
+        transform=transform,
+        export=export,
+    )
+    parameters = {
+        "env": env,
+        "workers": workers,
+        "streaming": streaming,
+        "delta": delta,
+        "diff": diff,
+        "optimize": optimize,
+        "transform": transform,
+        "export": export,
+    }
+    run_pipeline(stages=stages, parameters=parameters, resume=resume)
@@ -0,0 +1,75 @@
+"""
+Switch the database back to a previous version.
+
+build_database, optimize_database and download_database write the database as a new
+version in database/versions, then switch database/data.duckdb to it. The last versions
+are kept (DATABASE_VERSIONS_TO_KEEP, 3 by default), so that the database can be switched
+back instantly, e.g. after a build which loaded wrong data.
+
+Args:
+    - version (str): Name of the version to switch to (default the version before the current one)
+    - list (bool): Only list the versions
+
+Examples:
+    - rollback_database : Switch back to the version before the current one
+    - rollback_database --list : List the versions
+    - rollback_database --version data_20250101-120000-000000.duckdb : Switch to this version
+"""
+
+import logging
+import os
+
+from ._database_versions import (
+    get_current_database_version,
+    get_database_versions,
+    switch_database_version,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def list_database_versions():
+    """Log the versions of the database, the current one being marked"""
+    current_version = get_current_database_version()
+    for version_file in get_database_versions():
+        marker = "*" if version_file == current_version else " "
+        size = os.path.getsize(version_file) / 1024**2
+        logger.info(f"{marker} {os.path.basename(version_file)} ({size:.1f} MB)")
+
+
+def rollback_database(version: str = None):
+    """
+    Switch the database to a previous version
+    :param version: The file name of the version to switch to. Defaults to the version
+        before the current one.
+    """
+    versions = get_database_versions()
+    current_version = get_current_database_version()
+    if version is None:
+        if current_version not in versions:
+            raise ValueError("The database has no current version to roll back from")
+        index = versions.index(current_version)
+        if index == 0:
+            raise ValueError(
+                f"No version older than the current one: {os.path.basename(current_version)}"
+            )
+        version_file = versions[index - 1]
+    else:
+        version_files = {
+            os.path.basename(version_file): version_file for version_file in versions
+        }
+        if os.path.basename(version) not in version_files:
+            raise ValueError(
+                f"Unknown version {version}. Versions: {list(version_files)}"
+            )
+        version_file = version_files[os.path.basename(version)]
+
+    logger.info(f"Rolling back the database to {os.path.basename(version_file)}")
+    switch_database_version(version_file)
+
+
+def execute(version: str = None, list_versions: bool = False):
+    if list_versions:
+        list_database_versions()
+    else:
+        rollback_database(version=version)
@@ -0,0 +1,113 @@
+"""
+Build the dbt models on top of the EDC tables, for the years which changed only.
+
+dbt writes into a new version of the database, see _database_versions.py: the readers
+keep the current version during the build, and a failed build is dropped.
+
+The years loaded by build_database since the last successful transform are read from
+_partition_state, and passed to dbt as the edc_partitions variable: the incremental
+models only rebuild these years. Every year is rebuilt the first time.
+
+Args:
+    - full-refresh (bool): Rebuild every model and every year from scratch
+    - partitions (str): Comma-separated list of years to rebuild, instead of the changed ones
+
+Examples:
+    - transform : Rebuild the years loaded by build_database since the last transform
+    - transform --full-refresh : Rebuild every year
+    - transform --partitions 2023,2024 : Rebuild the years 2023 and 2024
+"""
+
+import json
+import logging
+import os
+import subprocess
+from typing import List
+
+
+from pipelines.utils.instrumentation import span
+
+from ._common import DBT_FOLDER
+from ._context import PipelineContext, pipeline_context
+from ._database_versions import new_database_version
+from ._ingestion_state import (
+    finish_transform_run,
+    get_changed_partitions,
+    start_transform_run,
+)
+
+logger = logging.getLogger(__name__)
+
+# The target of dbt_/profiles.yml opening the database for writing
+DBT_TARGET = "transform"
+
+
+def run_dbt(args: List[str], database_file: str):
+    """
+    Run a dbt command in the dbt project folder
+    :param args: The arguments of the dbt command, e.g. ["build"]
+    :param database_file: The database dbt opens, e.g. the version being written
+    """
+    command = ["dbt", *args]
+    logger.info(f"Running {' '.join(command)}")
+    # The dbt profile reads the path of the database from DUCKDB_FILE
+    with span("dbt", command=args[0]):
+        subprocess.run(
+            command,
+            cwd=DBT_FOLDER,
+            env={**os.environ, "DUCKDB_FILE": database_file},
+            check=True,
+        )
+
+
+def transform(
+    full_refresh: bool = False,
+    partitions: List[int] = None,
+    context: PipelineContext = None,
+):
+    """
+    Run dbt build for the partitions (years) which changed since the last transform
+    :param full_refresh: Whether to rebuild every model and every year from scratch
+    :param partitions: The years to rebuild. Defaults to the years loaded by
+        build_database since the last successful transform.
+    :param context: The context of the pipeline run. If None, a new context is opened.
+    """
+    with pipeline_context(context) as context:
+        # A failed dbt run drops the version, the current database is left untouched
+        with new_database_version(context) as version_file:
+            if not full_refresh and partitions is None:
+                partitions = get_changed_partitions(context.conn)
+            if full_refresh:
+                partitions = None
+            run_id = start_transform_run(conn=context.conn, partitions=partitions)
+            # dbt opens its own connection to the database
+            context.release_connection()
+
+            if partitions is None:
+                logger.info("Building the dbt models for every year")
+            else:
+                logger.info(f"Building the dbt models for the years: {partitions}")
+
+            args = ["build", "--target", DBT_TARGET]
+            if full_refresh:
+                args.append("--full-refresh")
+            if partitions is not None:
+                args += ["--vars", json.dumps({"edc_partitions": partitions})]
+
+            status = "failed"
+            try:
+                if not os.path.exists(os.path.join(DBT_FOLDER, "dbt_packages")):
+                    run_dbt(["deps"], database_file=version_file)
+                run_dbt(args, database_file=version_file)
+                status = "success"
+            finally:
+                finish_transform_run(conn=context.conn, run_id=run_id, status=status)
+    return True
+
+
+def execute(
+    full_refresh: bool = False,
+    partitions: List[int] = None,
+    context: PipelineContext = None,
+):
+    transform(full_refresh=full_refresh, partitions=partitions, context=context)
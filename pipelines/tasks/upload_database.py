@@ -3,34 +3,53 @@ Upload database to S3 storage.
 
 Args:
     - env (str): Environment to upload to ("dev" or "prod")
+    - delta (bool): Upload only the partition tables which changed, as Parquet files
 
 Examples:
     - upload_database --env dev  : Upload database to development environment
     - upload_database --env prod : Upload database to production environment
+    - upload_database --env prod --delta : Upload only the years which changed since the last upload
 """
 
 import logging
 
 from pipelines.config.config import get_s3_path
-from pipelines.tasks._common import DUCKDB_FILE
+from pipelines.utils.instrumentation import span
 from pipelines.utils.storage_client import ObjectStorageClient
 
+from ._common import DUCKDB_FILE
+from ._context import PipelineContext
+from ._delta_sync import upload_database_delta
+
 logger = logging.getLogger(__name__)
 
 
-def upload_database_to_storage(env):
+def upload_database_to_storage(env, context: PipelineContext = None):
     """
     Upload the database built locally to Storage Object depending on the environment
     This requires setting the correct environment variables for the Scaleway credentials
+    :param context: The context of the pipeline run, whose connection is released
+        so that every change is written to the database file before the upload
     """
     s3 = ObjectStorageClient()
 
     db_path = DUCKDB_FILE  # Fichier local
     s3_path = get_s3_path(env)  # Destination sur S3
-
-    s3.upload_object(local_path=db_path, file_key=s3_path, public_read=True)
-    logger.info(f"✅ Base uploadée sur s3://{s3.bucket_name}/{s3_path}")
-
-
-def execute(env):
-    upload_database_to_storage(env)
+    if context is not None:
+        context.release_connection()
+
+    # The database is not uploaded again if it has not changed since the last upload
+    if s3.upload_object(
+        local_path=db_path, file_key=s3_path, public_read=True, skip_unchanged=True
+    ):
+        logger.info(f"✅ Base uploadée sur s3://{s3.bucket_name}/{s3_path}")
+    else:
+        logger.info(f"✅ Base déjà à jour sur s3://{s3.bucket_name}/{s3_path}")
+
+
+def execute(env, delta: bool = False, context: PipelineContext = None):
+    with span("upload_database", env=env, delta=delta):
+        if delta:
+            upload_database_delta(env, context=context)
+        else:
+            upload_database_to_storage(env, context=context)
@@ -0,0 +1,93 @@
+"""
+The connections opened by the pipelines: the duckdb connections, opened with the resource
+profile of config.py, and the HTTP session shared by the downloads, with its retries.
+"""
+
+import logging
+import threading
+import time
+from typing import Callable
+
+import duckdb
+import requests
+from requests.adapters import HTTPAdapter
+
+from pipelines.config.config import DUCKDB_FILE, DUCKDB_TEMP_FOLDER, get_duckdb_config
+
+logger = logging.getLogger(__name__)
+
+# HTTP requests settings
+HTTP_POOL_SIZE = 16
+DOWNLOAD_MAX_RETRIES = 5
+DOWNLOAD_BACKOFF = 1  # seconds, doubled after each failed attempt
+# Transient HTTP errors, the request is retried like a dropped connection
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def connect_duckdb(
+    database: str = None, read_only: bool = False
+) -> duckdb.DuckDBPyConnection:
+    """
+    Opens a duckdb connection with the resource profile of config.py (memory limit,
+    threads, temp directory). Every connection of the pipelines should be opened here:
+    duckdb refuses to open a file twice in a process with different settings.
+    :param database: The database to open, ":memory:" for an in-memory database.
+        Defaults to DUCKDB_FILE.
+    :param read_only: Whether to open the database in read-only mode
+    :return: The connection
+    """
+    if database is None:
+        database = DUCKDB_FILE
+    return duckdb.connect(
+        database,
+        read_only=read_only,
+        config=get_duckdb_config(default_temp_directory=DUCKDB_TEMP_FOLDER),
+    )
+
+
+def get_http_session() -> requests.Session:
+    """
+    Returns the requests session shared by the downloads of the pipeline.
+    Its connection pool lets parallel downloads (several years, several segments of a file)
+    reuse their connections. The session itself doesn't retry: the requests are retried
+    by with_retries(), which also resumes the transfers interrupted midway.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            adapter = HTTPAdapter(
+                pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE
+            )
+            _http_session = requests.Session()
+            _http_session.mount("http://", adapter)
+            _http_session.mount("https://", adapter)
+    return _http_session
+
+
+def with_retries(func: Callable, description: str):
+    """
+    Calls func, and calls it again with an exponential backoff when the connection
+    fails or drops during the transfer, or when the server answers with a transient
+    HTTP error (RETRY_STATUSES). func is called at most DOWNLOAD_MAX_RETRIES + 1 times,
+    and is expected to resume where the previous call stopped.
+    """
+    for attempt in range(DOWNLOAD_MAX_RETRIES + 1):
+        try:
+            return func()
+        except (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+            requests.HTTPError,
+        ) as ex:
+            transient = not isinstance(ex, requests.HTTPError) or (
+                ex.response is not None and ex.response.status_code in RETRY_STATUSES
+            )
+            if not transient or attempt == DOWNLOAD_MAX_RETRIES:
+                raise
+            delay = DOWNLOAD_BACKOFF * 2**attempt
+            logger.warning(f"   {description} interrupted ({ex}), retry in {delay}s")
+            time.sleep(delay)
@@ -0,0 +1,185 @@
+"""
+Spans measuring the stages of the pipelines: duration, CPU time, peak memory, and the
+rows and bytes they handled.
+
+    with span("load_file", table=table_name) as load_span:
+        ...
+        load_span.set(rows=row_count, bytes=byte_size)
+
+When SPANS_FILE is set (e.g. database/spans.jsonl), every span is appended to it as a
+JSON line; nothing is written by default. The spans opened inside another span record
+it as their parent. When OTEL_EXPORTER_OTLP_ENDPOINT is set, the spans are
+also exported in OpenTelemetry format to this collector, which requires the
+opentelemetry-sdk and opentelemetry-exporter-otlp-proto-http packages.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Iterator
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the CPU time and peak memory are not recorded
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+SPANS_FILE = os.getenv("SPANS_FILE")
+# Every span written by a process shares the same trace id
+TRACE_ID = uuid.uuid4().hex
+
+_current_span = ContextVar("current_span", default=None)
+_write_lock = threading.Lock()
+_otel_lock = threading.Lock()
+_otel_tracer = None
+
+
+class Span:
+    """A stage being measured, see span()"""
+
+    def __init__(self, name: str, attributes: dict, parent_id: str = None):
+        self.name = name
+        self.attributes = attributes
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+
+    def set(self, **attributes):
+        """Add attributes to the span, e.g. the number of rows or bytes handled"""
+        self.attributes.update(attributes)
+
+
+def get_otel_tracer():
+    """
+    Returns the OpenTelemetry tracer exporting the spans to OTEL_EXPORTER_OTLP_ENDPOINT,
+    or None if the variable is not set or the packages are not installed
+    """
+    global _otel_tracer
+    if not os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT"):
+        return None
+    with _otel_lock:
+        if _otel_tracer is None:
+            try:
+                from opentelemetry import trace
+                from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+                    OTLPSpanExporter,
+                )
+                from opentelemetry.sdk.resources import Resource
+                from opentelemetry.sdk.trace import TracerProvider
+                from opentelemetry.sdk.trace.export import BatchSpanProcessor
+            except ImportError:
+                logger.warning(
+                    "Exporting the spans to OpenTelemetry requires opentelemetry: "
+                    "uv pip install opentelemetry-sdk opentelemetry-exporter-otlp-proto-http"
+                )
+                _otel_tracer = False
+            else:
+                # The endpoint and the headers are read from the OTEL_* variables
+                provider = TracerProvider(
+                    resource=Resource.create({"service.name": "pollution_eau"})
+                )
+                provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+                trace.set_tracer_provider(provider)
+                _otel_tracer = trace.get_tracer(__name__)
+    return _otel_tracer or None
+
+
+def get_cpu_time() -> float:
+    """Returns the CPU time (user and system) used by the process so far, in seconds"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def get_peak_rss() -> int:
+    """Returns the peak resident memory of the process so far, in bytes"""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def write_span(record: dict):
+    """Append a span to SPANS_FILE, if it is set"""
+    if not SPANS_FILE:
+        return
+    with _write_lock:
+        os.makedirs(os.path.dirname(os.path.abspath(SPANS_FILE)), exist_ok=True)
+        with open(SPANS_FILE, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Span]:
+    """
+    Measure a stage of a pipeline, and record it when it exits
+    The CPU time is that of the whole process: it includes the other threads running at
+    the same time. The memory is recorded as process_peak_rss, the peak resident memory of
+    the process since it started, and peak_rss_delta, how much the stage raised it: 0 when
+    the stage used less memory than an earlier one.
+    :param name: The name of the stage, e.g. "download_file"
+    :param attributes: Attributes describing the stage, e.g. year="2024".
+        More can be added with Span.set().
+    :return: The span
+    """
+    parent = _current_span.get()
+    current = Span(name, attributes, parent.span_id if parent else None)
+    token = _current_span.set(current)
+    tracer = get_otel_tracer()
+    started_at = datetime.now()
+    start_time = time.perf_counter()
+    start_cpu_time = get_cpu_time()
+    start_peak_rss = get_peak_rss()
+    error = None
+    with tracer.start_as_current_span(name) if tracer else nullcontext() as otel_span:
+        try:
+            yield current
+        except BaseException as ex:
+            error = repr(ex)
+            raise
+        finally:
+            _current_span.reset(token)
+            cpu_time = get_cpu_time()
+            peak_rss = get_peak_rss()
+            record = {
+                "trace_id": TRACE_ID,
+                "span_id": current.span_id,
+                "parent_id": current.parent_id,
+                "name": name,
+                "started_at": started_at.isoformat(timespec="milliseconds"),
+                "duration_s": round(time.perf_counter() - start_time, 3),
+                "cpu_s": None
+                if cpu_time is None
+                else round(cpu_time - start_cpu_time, 3),
+                "process_peak_rss": peak_rss,
+                "peak_rss_delta": None
+                if peak_rss is None
+                else peak_rss - start_peak_rss,
+                "status": "error" if error else "ok",
+                "error": error,
+                "attributes": current.attributes,
+            }
+            try:
+                write_span(record)
+            except OSError as ex:
+                logger.warning(f"Span {name} could not be written: {ex}")
+            if otel_span is not None:
+                for key in (
+                    "duration_s",
+                    "cpu_s",
+                    "process_peak_rss",
+                    "peak_rss_delta",
+                ):
+                    if record[key] is not None:
+                        otel_span.set_attribute(key, record[key])
+                for key, value in current.attributes.items():
+                    if isinstance(value, (str, bool, int, float)):
+                        otel_span.set_attribute(key, value)
@@ -1,33 +1,103 @@
 import os
+import hashlib
+import logging
+import threading
+import tempfile
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
+from botocore.exceptions import ClientError
 import pandas as pd
-import io
+import json
+
+from pipelines.utils.connections import connect_duckdb
+from pipelines.utils.instrumentation import span
 
 """Client class to interact with Scaleway Object Storage."""
 
+logger = logging.getLogger(__name__)
+
+# Transfers settings, files bigger than the chunk size are sent in parallel parts
+TRANSFER_CHUNK_SIZE = int(os.getenv("S3_CHUNK_SIZE_MB", "64")) * 1024 * 1024
+TRANSFER_MAX_CONCURRENCY = int(os.getenv("S3_MAX_CONCURRENCY", "10"))
+HASH_CHUNK_SIZE = 1024 * 1024
+# Metadata key holding the sha256 of the uploaded files
+SHA256_METADATA = "sha256"
+
+
+def get_file_format(file_key):
+    """Returns the format of a dataframe file from its extension: csv, parquet or arrow"""
+    extension = os.path.splitext(file_key)[1].lower()
+    if extension == ".parquet":
+        return "parquet"
+    if extension in (".arrow", ".feather", ".ipc"):
+        return "arrow"
+    return "csv"
+
+
+def import_pyarrow_feather():
+    """pyarrow is only needed for the Arrow IPC format, it is not a dependency of the project"""
+    try:
+        from pyarrow import feather
+    except ImportError as e:
+        raise ImportError(
+            "The Arrow IPC format requires pyarrow: uv pip install pyarrow"
+        ) from e
+    return feather
+
+
+def compute_sha256(local_path):
+    """Returns the sha256 hex digest of a local file"""
+    sha256 = hashlib.sha256()
+    with open(local_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
 
 class ObjectStorageClient:
     region_name = "fr-par"
     endpoint_url = "https://s3.fr-par.scw.cloud"
     bucket_name = "pollution-eau-s3"
 
+    # The session and the clients (with their connection pools) are shared
+    # by every instance, they are thread safe
+    _session = None
+    _clients = {}
+    _lock = threading.Lock()
+
     def __init__(self):
         # Need to use V2 signature for upload and V4 for download
         self.client_v2 = self.build_client("s3")
         self.client_v4 = self.build_client("s3v4")
+        self.transfer_config = TransferConfig(
+            multipart_threshold=TRANSFER_CHUNK_SIZE,
+            multipart_chunksize=TRANSFER_CHUNK_SIZE,
+            max_concurrency=TRANSFER_MAX_CONCURRENCY,
+        )
 
     @staticmethod
     def build_client(signature_version: str = "s3v4"):
-        return boto3.session.Session().client(
-            service_name="s3",
-            config=Config(signature_version=signature_version),
-            region_name=ObjectStorageClient.region_name,
-            use_ssl=True,
-            endpoint_url=ObjectStorageClient.endpoint_url,
-            aws_access_key_id=os.getenv("SCW_ACCESS_KEY"),
-            aws_secret_access_key=os.getenv("SCW_SECRET_KEY"),
-        )
+        with ObjectStorageClient._lock:
+            if signature_version not in ObjectStorageClient._clients:
+                if ObjectStorageClient._session is None:
+                    ObjectStorageClient._session = boto3.session.Session()
+                ObjectStorageClient._clients[signature_version] = (
+                    ObjectStorageClient._session.client(
+                        service_name="s3",
+                        config=Config(
+                            signature_version=signature_version,
+                            # One connection per thread of the multipart transfers
+                            max_pool_connections=TRANSFER_MAX_CONCURRENCY,
+                        ),
+                        region_name=ObjectStorageClient.region_name,
+                        use_ssl=True,
+                        endpoint_url=ObjectStorageClient.endpoint_url,
+                        aws_access_key_id=os.getenv("SCW_ACCESS_KEY"),
+                        aws_secret_access_key=os.getenv("SCW_SECRET_KEY"),
+                    )
+                )
+            return ObjectStorageClient._clients[signature_version]
 
     # def list_buckets(self):
     #     response = self.client_v4.list_buckets()
@@ -40,33 +110,154 @@ class ObjectStorageClient:
         else:
             return []
 
-    def download_object(self, file_key, local_path):
-        self.client_v4.download_file(self.bucket_name, file_key, local_path)
+    def get_object_hashes(self, file_key):
+        """
+        Returns the hashes known for a remote object, or None if the object doesn't exist:
+            - "sha256": set in the metadata by upload_object, None for the other objects
+            - "etag": the md5 of the objects uploaded in a single part
+        """
+        try:
+            response = self.client_v4.head_object(Bucket=self.bucket_name, Key=file_key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return {
+            "sha256": response.get("Metadata", {}).get(SHA256_METADATA),
+            "etag": response["ETag"].strip('"'),
+        }
+
+    def is_unchanged(self, local_path, file_key, sha256=None):
+        """
+        Whether the local file and the remote object have the same content
+        :param sha256: The sha256 of the local file, if already computed
+        """
+        if not os.path.exists(local_path):
+            return False
+        remote_hashes = self.get_object_hashes(file_key)
+        if remote_hashes is None:
+            return False
+        if remote_hashes["sha256"] is not None:
+            return (sha256 or compute_sha256(local_path)) == remote_hashes["sha256"]
+        # Multipart ETags ("<md5>-<number of parts>") are not the md5 of the file
+        if "-" in remote_hashes["etag"]:
+            return False
+        md5 = hashlib.md5()
+        with open(local_path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                md5.update(chunk)
+        return md5.hexdigest() == remote_hashes["etag"]
+
+    def download_object(self, file_key, local_path, skip_unchanged=False):
+        """
+        Download an object in parallel parts
+        :param skip_unchanged: Don't download the object if local_path already has its content
+        :return: True if the object was downloaded, False if it was skipped
+        """
+        with span("s3_download", file_key=file_key) as download_span:
+            if skip_unchanged and self.is_unchanged(local_path, file_key):
+                logger.info(
+                    f"{local_path} is up to date with {file_key}, skip download"
+                )
+                download_span.set(skipped=True)
+                return False
+            self.client_v4.download_file(
+                self.bucket_name, file_key, local_path, Config=self.transfer_config
+            )
+            download_span.set(skipped=False, bytes=os.path.getsize(local_path))
+            return True
 
-    def upload_object(self, local_path, file_key=None, public_read=False):
+    def upload_object(
+        self, local_path, file_key=None, public_read=False, skip_unchanged=False
+    ):
+        """
+        Upload a file in parallel parts, with its sha256 in the object metadata
+        :param skip_unchanged: Don't upload the file if the remote object already has its content
+        :return: True if the file was uploaded, False if it was skipped
+        """
         if file_key is None:
             file_key = os.path.basename(local_path)
-        self.client_v2.upload_file(
-            local_path,
-            self.bucket_name,
-            file_key,
-            ExtraArgs={"ACL": "public-read"} if public_read else None,
-        )
+        with span(
+            "s3_upload", file_key=file_key, bytes=os.path.getsize(local_path)
+        ) as upload_span:
+            sha256 = compute_sha256(local_path)
+            if skip_unchanged and self.is_unchanged(local_path, file_key, sha256):
+                logger.info(f"{file_key} is up to date with {local_path}, skip upload")
+                upload_span.set(skipped=True)
+                return False
+            extra_args = {"Metadata": {SHA256_METADATA: sha256}}
+            if public_read:
+                extra_args["ACL"] = "public-read"
+            self.client_v2.upload_file(
+                local_path,
+                self.bucket_name,
+                file_key,
+                ExtraArgs=extra_args,
+                Config=self.transfer_config,
+            )
+            upload_span.set(skipped=False)
+            return True
 
-    def upload_dataframe(self, df, file_key):
-        csv_buffer = io.StringIO()
-        df.to_csv(csv_buffer, index=False)
+    def upload_dataframe(self, df, file_key, file_format=None):
+        """
+        Upload a dataframe without building the whole file in memory: it is written
+        to a temporary file, then uploaded in parallel parts if it is big enough.
+        :param file_format: "csv", "parquet" or "arrow" (Arrow IPC, requires pyarrow).
+            Defaults to the extension of file_key, or "csv".
+        """
+        file_format = file_format or get_file_format(file_key)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            local_path = os.path.join(tmp_dir, "dataframe")
+            if file_format == "csv":
+                df.to_csv(local_path, index=False)
+            elif file_format == "parquet":
+                with connect_duckdb(":memory:") as conn:
+                    conn.register("dataframe", df)
+                    conn.execute(
+                        f"COPY dataframe TO '{local_path}' (FORMAT PARQUET, COMPRESSION ZSTD);"
+                    )
+            elif file_format == "arrow":
+                pyarrow_feather = import_pyarrow_feather()
+                pyarrow_feather.write_feather(df, local_path)
+            else:
+                raise ValueError(f"Unsupported file format: {file_format}")
 
-        # Upload the buffer to S3
-        self.client_v2.put_object(
-            Bucket=self.bucket_name, Key=file_key, Body=csv_buffer.getvalue()
-        )
+            self.client_v2.upload_file(
+                local_path, self.bucket_name, file_key, Config=self.transfer_config
+            )
+
+    def read_object_as_dataframe(self, file_key, file_format=None):
+        """
+        Read an object as a dataframe without copying its whole content in memory first
+        :param file_format: "csv", "parquet" or "arrow" (Arrow IPC, requires pyarrow).
+            Defaults to the extension of file_key, or "csv".
+        """
+        file_format = file_format or get_file_format(file_key)
+        if file_format == "csv":
+            # The response body is parsed while it is downloaded
+            response = self.client_v4.get_object(Bucket=self.bucket_name, Key=file_key)
+            return pd.read_csv(response["Body"])
+        if file_format not in ("parquet", "arrow"):
+            raise ValueError(f"Unsupported file format: {file_format}")
+
+        # Parquet and Arrow files are read from the end, they are downloaded
+        # in parallel parts to a temporary file first
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            local_path = os.path.join(tmp_dir, "dataframe")
+            self.client_v4.download_file(
+                self.bucket_name, file_key, local_path, Config=self.transfer_config
+            )
+            if file_format == "parquet":
+                with connect_duckdb(":memory:") as conn:
+                    return conn.execute(
+                        "SELECT * FROM read_parquet(?);", (local_path,)
+                    ).df()
+            pyarrow_feather = import_pyarrow_feather()
+            return pyarrow_feather.read_feather(local_path)
 
-    def read_object_as_dataframe(self, file_key):
+    def read_object_as_json(self, file_key):
         response = self.client_v4.get_object(Bucket=self.bucket_name, Key=file_key)
-        csv_data = response["Body"].read().decode("utf-8")
-        df = pd.read_csv(io.StringIO(csv_data))
-        return df
+        return json.loads(response["Body"].read().decode("utf-8"))
 
     def delete_object(self, key):
         self.client_v4.delete_object(Bucket=self.bucket_name, Key=key)
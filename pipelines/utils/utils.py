@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import requests
 import duckdb
@@ -6,7 +7,8 @@ from urllib.parse import urlparse
 import logging
 
 from pipelines.tasks._config_edc import get_edc_config
-from pipelines.tasks._common import DUCKDB_FILE
+from pipelines.tasks._ingestion_state import get_partitions_dataset_datetime
+from pipelines.utils.connections import connect_duckdb, get_http_session, with_retries
 
 logger = logging.getLogger(__name__)
 
@@ -20,120 +22,167 @@ def get_project_root() -> Path:
     return Path(__file__).parent.parent.parent
 
 
-def get_url_headers(url: str) -> dict:
+def get_url_headers(url: str, session: requests.Session = None) -> dict:
     """
     Get url HTTP headers
     :param url: static dataset url
+    :param session: The HTTP session to use. Defaults to the shared session of the pipeline.
     :return: HTTP headers
     """
-    try:
-        response = requests.head(url, timeout=5)
+    if session is None:
+        session = get_http_session()
+
+    def head():
+        response = session.head(url, timeout=5)
         response.raise_for_status()
-        return response.headers
+        return response
+
+    try:
+        return with_retries(head, f"Request of {url}").headers
     except requests.exceptions.RequestException as ex:
         logger.error(f"Exception raised: {ex}")
         return {}
 
 
-def extract_dataset_datetime(url: str) -> str:
+def extract_dataset_datetime(url: str, session: requests.Session = None) -> str:
     """
     Extract the dataset datetime from dataset location url
     which can be found in the static dataset url headers
     :param url: static dataset url
+    :param session: The HTTP session to use. Defaults to the shared session of the pipeline.
     :return: dataset datetime under format "YYYYMMDD-HHMMSS"
     """
-    metadata = get_url_headers(url)
+    metadata = get_url_headers(url, session=session)
     parsed_url = urlparse(metadata.get("location"))
     path_parts = parsed_url.path.strip("/").split("/")
     return path_parts[-2]
 
 
-def get_edc_dataset_years_to_update(years: list) -> list:
+def get_edc_partitions_dataset_datetime(
+    conn: duckdb.DuckDBPyConnection, table_name: str, years: list
+) -> dict:
+    """
+    Return the EDC dataset datetime stored in the database for every requested year, in one query
+    :param conn: The duckdb connection to use
+    :param table_name: The EDC table to read
+    :param years: list of years to look for
+    :return: dict of year -> dataset datetime, for the years present in the table.
+        None if the table doesn't exist.
+    """
+    query = """
+        SELECT COUNT(*)
+        FROM information_schema.tables
+        WHERE table_name = ?
+        ;
+    """
+    conn.execute(query, (table_name,))
+    if conn.fetchone()[0] == 0:
+        return None
+
+    query = f"""
+        SELECT CAST(de_partition AS VARCHAR), MAX(de_dataset_datetime)
+        FROM {table_name}
+        WHERE de_partition IN (SELECT CAST(UNNEST(?) AS INTEGER))
+        GROUP BY de_partition
+        ;
+    """
+    conn.execute(query, (years,))
+    return dict(conn.fetchall())
+
+
+def get_edc_dataset_years_to_update(
+    years: list,
+    conn: duckdb.DuckDBPyConnection = None,
+    session: requests.Session = None,
+) -> list:
     """
     Return the list of EDC dataset's years that are no longer up to date
     compared to the site www.data.gouv.fr
     :param years: list of years to check
+    :param conn: The duckdb connection to use. If None, a new connection is opened.
+    :param session: The HTTP session to use. Defaults to the shared session of the pipeline.
     :return: list of years that are no longer up to date
     """
     update_years = []
 
     logger.info("Check that EDC dataset are up to date according to www.data.gouv.fr")
 
-    conn = duckdb.connect(DUCKDB_FILE)
+    edc_config = get_edc_config()
+    # Only one table is checked because the update is done for the whole year
+    table_name = next(iter(edc_config["files"].values()))["table_name"]
 
+    close_conn = conn is None
+    if close_conn:
+        conn = connect_duckdb()
+    try:
+        # The ingestion metadata only holds a few rows per year
+        recorded_datetimes = get_partitions_dataset_datetime(
+            conn=conn, table_name=table_name, years=years
+        )
+        # Years loaded before _partition_state existed are read from the EDC table
+        unrecorded_years = [year for year in years if year not in recorded_datetimes]
+        current_datetimes = recorded_datetimes
+        if unrecorded_years:
+            current_datetimes = get_edc_partitions_dataset_datetime(
+                conn=conn, table_name=table_name, years=unrecorded_years
+            )
+            if current_datetimes is not None:
+                current_datetimes.update(recorded_datetimes)
+    finally:
+        if close_conn:
+            conn.close()
+
+    if current_datetimes is None:
+        # EDC table will be created with process_edc_datasets
+        logger.info("      Database doesn't exists")
+        current_datetimes = {}
+        table_exists = False
+    else:
+        table_exists = True
+
+    # The HEAD requests to www.data.gouv.fr are sent concurrently
+    years_in_database = [year for year in years if year in current_datetimes]
+    data_urls = [
+        edc_config["source"]["base_url"]
+        + edc_config["source"]["yearly_files_infos"][year]["id"]
+        for year in years_in_database
+    ]
+    with ThreadPoolExecutor(max_workers=max(len(data_urls), 1)) as executor:
+        data_gouv_datetimes = dict(
+            zip(
+                years_in_database,
+                executor.map(
+                    lambda url: extract_dataset_datetime(url, session=session),
+                    data_urls,
+                ),
+            )
+        )
+
+    format_str = "%Y%m%d-%H%M%S"
     for year in years:
         logger.info(f"   Check EDC dataset datetime for {year}")
-
-        edc_config = get_edc_config()
-        data_url = (
-            edc_config["source"]["base_url"]
-            + edc_config["source"]["yearly_files_infos"][year]["id"]
+        if year not in current_datetimes:
+            if table_exists:
+                logger.info(f"      {year} doesn't exist in the database")
+            update_years.append(year)
+            continue
+
+        logger.info(f"      Database - EDC dataset datetime: {current_datetimes[year]}")
+        logger.info(
+            f"      Datagouv - EDC dataset datetime: {data_gouv_datetimes[year]}"
+        )
+        last_data_gouv_dataset_datetime = datetime.strptime(
+            data_gouv_datetimes[year], format_str
+        )
+        current_dataset_datetime = datetime.strptime(
+            current_datetimes[year], format_str
         )
-        files = edc_config["files"]
-
-        for file_info in files.values():
-            # Check database presence
-            query = """
-                SELECT COUNT(*)
-                FROM information_schema.tables
-                WHERE table_name = ?
-                ;
-                """
-            conn.execute(query, (file_info["table_name"],))
-            if conn.fetchone()[0] == 1:
-                # Check dataset year is present in the database
-                query = f"""
-                    SELECT EXISTS (
-                        SELECT 1
-                        FROM {file_info["table_name"]}
-                        WHERE de_partition = CAST(? as INTEGER)
-                    );
-                """
-                conn.execute(query, (year,))
-                if conn.fetchone()[0]:
-                    # get dataset datetime
-                    query = f"""
-                        SELECT de_dataset_datetime
-                        FROM {file_info["table_name"]}
-                        WHERE de_partition = CAST(? as INTEGER)
-                        ;
-                    """
-                    conn.execute(query, (year,))
-                    current_dataset_datetime = conn.fetchone()[0]
-                    logger.info(
-                        f"      Database - EDC dataset datetime: {current_dataset_datetime}"
-                    )
-
-                    format_str = "%Y%m%d-%H%M%S"
-                    last_data_gouv_dataset_datetime = extract_dataset_datetime(data_url)
-                    logger.info(
-                        f"      Datagouv - EDC dataset datetime: "
-                        f"{last_data_gouv_dataset_datetime}"
-                    )
-
-                    last_data_gouv_dataset_datetime = datetime.strptime(
-                        last_data_gouv_dataset_datetime, format_str
-                    )
-                    current_dataset_datetime = datetime.strptime(
-                        current_dataset_datetime, format_str
-                    )
-
-                    if last_data_gouv_dataset_datetime > current_dataset_datetime:
-                        update_years.append(year)
-                else:
-                    logger.info(f"      {year} doesn't exist in the database")
-                    update_years.append(year)
-            else:
-                # EDC table will be created with process_edc_datasets
-                logger.info("      Database doesn't exists")
-                update_years.append(year)
-            # Only one check of a file is needed because the update is done for the whole
-            break
+        if last_data_gouv_dataset_datetime > current_dataset_datetime:
+            update_years.append(year)
 
     if update_years:
         logger.info(f"   EDC dataset update is necessary for {update_years}")
     else:
         logger.info("   All EDC dataset are already up to date")
 
-    conn.close()
     return update_years
@@ -0,0 +1,69 @@
+import importlib
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The pipelines create their folders when they are imported: they are created in a
+# temporary folder instead of the database folder of the project
+os.environ["DATABASE_FOLDER"] = tempfile.mkdtemp(prefix="pollution_eau_tests_")
+
+# The paths of the database folder, and the module defining each of them
+DATABASE_PATHS = {
+    "DATABASE_FOLDER": "",
+    "DUCKDB_FILE": "data.duckdb",
+    "DUCKDB_TEMP_FOLDER": "data.duckdb.tmp",
+    "CACHE_FOLDER": "cache",
+    "DOWNLOAD_CACHE_FOLDER": "cache/downloads",
+    "PARQUET_FOLDER": "parquet",
+    "RAW_FOLDER": "raw",
+    "MAP_FOLDER": "map",
+    "VERSIONS_FOLDER": "versions",
+}
+
+
+@pytest.fixture
+def database_folder(tmp_path, monkeypatch):
+    """
+    Point the database folder of every pipelines module to an empty temporary folder
+    :return: The temporary database folder
+    """
+    importlib.import_module("pipelines.tasks._database_versions")
+    for name, module in list(sys.modules.items()):
+        if not name.startswith("pipelines."):
+            continue
+        for attribute, path in DATABASE_PATHS.items():
+            if hasattr(module, attribute):
+                monkeypatch.setattr(
+                    module, attribute, os.path.join(tmp_path, path).rstrip(os.sep)
+                )
+    os.makedirs(tmp_path / "cache" / "downloads")
+    return tmp_path
+
+
+@pytest.fixture(scope="session")
+def edc_fixtures_folder(tmp_path_factory):
+    """Synthetic EDC datasets for 2024, see _benchmark.py"""
+    from pipelines.tasks._benchmark import generate_edc_fixtures
+
+    folder = tmp_path_factory.mktemp("edc_fixtures")
+    generate_edc_fixtures(folder=str(folder), years=["2024"], rows=1000)
+    return folder
+
+
+@pytest.fixture
+def edc_server(edc_fixtures_folder, monkeypatch):
+    """
+    Serve the synthetic EDC datasets instead of www.data.gouv.fr
+    :return: The base url of the datasets
+    """
+    from pipelines.tasks._benchmark import serve_edc_fixtures
+
+    with serve_edc_fixtures(str(edc_fixtures_folder)) as base_url:
+        monkeypatch.setenv("EDC_BASE_URL", base_url)
+        for name, module in list(sys.modules.items()):
+            edc_config = getattr(module, "edc_config", None)
+            if name.startswith("pipelines.") and isinstance(edc_config, dict):
+                monkeypatch.setitem(edc_config["source"], "base_url", base_url)
+        yield base_url
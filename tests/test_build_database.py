@@ -0,0 +1,36 @@
+import os
+
+from pipelines.tasks import _database_versions, build_database
+from pipelines.tasks._database_versions import (
+    get_current_database_version,
+    get_database_versions,
+)
+
+
+def test_first_build_creates_a_single_version(database_folder, edc_server):
+    build_database.execute(
+        refresh_type="custom", custom_years=["2024"], check_update=True
+    )
+
+    assert os.path.islink(_database_versions.DUCKDB_FILE)
+    assert get_database_versions() == [get_current_database_version()]
+
+
+def test_up_to_date_build_leaves_the_database_untouched(database_folder, edc_server):
+    build_database.execute(refresh_type="custom", custom_years=["2024"])
+    versions = get_database_versions()
+
+    build_database.execute(
+        refresh_type="custom", custom_years=["2024"], check_update=True
+    )
+
+    assert get_database_versions() == versions
+
+
+def test_refreshing_a_year_doesnt_grow_the_database(database_folder, edc_server):
+    build_database.execute(refresh_type="custom", custom_years=["2024"])
+    size = os.path.getsize(os.path.realpath(_database_versions.DUCKDB_FILE))
+
+    build_database.execute(refresh_type="custom", custom_years=["2024"])
+
+    assert os.path.getsize(os.path.realpath(_database_versions.DUCKDB_FILE)) <= size
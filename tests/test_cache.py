@@ -0,0 +1,38 @@
+import os
+
+from pipelines.tasks import _common
+from pipelines.tasks._common import evict_cache
+
+
+def write_file(path, size, mtime):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"0" * size)
+    os.utime(path, (mtime, mtime))
+
+
+def test_evict_cache_removes_the_least_recently_used_entries(database_folder):
+    cache = _common.DOWNLOAD_CACHE_FOLDER
+    write_file(os.path.join(cache, "2023", "dis-2023.zip"), 100, mtime=1)
+    write_file(os.path.join(cache, "2023", "dis-2023.zip.headers.json"), 10, mtime=1)
+    write_file(os.path.join(cache, "2024", "dis-2024.zip"), 100, mtime=2)
+
+    evict_cache(max_size=150)
+
+    assert not os.path.exists(os.path.join(cache, "2023"))
+    assert os.path.exists(os.path.join(cache, "2024", "dis-2024.zip"))
+
+
+def test_evict_cache_keeps_the_downloads_in_progress(database_folder):
+    cache = _common.DOWNLOAD_CACHE_FOLDER
+    in_progress = [
+        os.path.join(cache, "2024", "dis-2024.zip.part"),
+        os.path.join(cache, "2024", "dis-2024.zip.part.headers.json"),
+        os.path.join(cache, "2024", "dis-2024.zip.part.segments.json"),
+    ]
+    for path in in_progress:
+        write_file(path, 100, mtime=1)
+
+    evict_cache(max_size=0)
+
+    assert all(os.path.exists(path) for path in in_progress)
@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+from pipelines.tasks import _database_versions, _delta_sync, build_database
+from pipelines.utils.connections import connect_duckdb
+
+
+class FakeObjectStorage:
+    """Stand-in for ObjectStorageClient, keeping the objects in memory"""
+
+    bucket_name = "bucket"
+    objects = {}
+    uploads = []
+
+    def get_object_hashes(self, file_key):
+        return {} if file_key in self.objects else None
+
+    def read_object_as_json(self, file_key):
+        return json.loads(self.objects[file_key])
+
+    def upload_object(self, local_path, file_key=None, public_read=False):
+        with open(local_path, "rb") as f:
+            self.objects[file_key] = f.read()
+        self.uploads.append(file_key)
+        return True
+
+    def download_object(self, file_key, local_path, skip_unchanged=False):
+        with open(local_path, "wb") as f:
+            f.write(self.objects[file_key])
+        return True
+
+    def delete_object(self, key):
+        del self.objects[key]
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    monkeypatch.setattr(FakeObjectStorage, "objects", {})
+    monkeypatch.setattr(FakeObjectStorage, "uploads", [])
+    monkeypatch.setattr(_delta_sync, "ObjectStorageClient", FakeObjectStorage)
+    return FakeObjectStorage
+
+
+def upload(storage):
+    """Upload the database, returns the tables uploaded"""
+    storage.uploads.clear()
+    _delta_sync.upload_database_delta("dev")
+    return [
+        file_key.split("/")[-2]
+        for file_key in storage.uploads
+        if not file_key.endswith(_delta_sync.MANIFEST_FILE)
+    ]
+
+
+def execute(query: str):
+    conn = connect_duckdb(_database_versions.DUCKDB_FILE)
+    try:
+        return conn.execute(query).fetchall()
+    finally:
+        conn.close()
+
+
+def test_partitions_are_transferred_when_their_content_changes(
+    database_folder, edc_server, storage
+):
+    build_database.execute(refresh_type="custom", custom_years=["2024"])
+    assert "edc_resultats" in upload(storage)
+    assert upload(storage) == []
+
+    # The source recorded in _partition_state is the same, only the data changed
+    execute("UPDATE edc_resultats_2024 SET valtraduite = -1 WHERE rowid = 0;")
+    assert upload(storage) == ["edc_resultats"]
+
+    # The local partition differs from the uploaded one: it is downloaded again
+    execute("UPDATE edc_resultats_2024 SET valtraduite = -2 WHERE rowid = 0;")
+    _delta_sync.download_database_delta("dev")
+
+    assert execute("SELECT COUNT(*) FROM edc_resultats WHERE valtraduite = -2;") == [
+        (0,)
+    ]
+    assert execute("SELECT COUNT(*) FROM edc_resultats WHERE valtraduite = -1;") == [
+        (1,)
+    ]
+    assert upload(storage) == []
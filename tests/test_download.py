@@ -0,0 +1,217 @@
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from pipelines.tasks._common import HEADERS_SUFFIX, download_file_from_https
+from pipelines.utils import connections
+
+CONTENT = os.urandom(5 * 1024 * 1024 + 123)
+
+
+class FileServer(ThreadingHTTPServer):
+    """
+    Serves a single file at /file, with an ETag and byte ranges.
+    The behaviour of the server is set by the tests with its attributes.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FileRequestHandler)
+        self.content = CONTENT
+        # Whether the server answers the Range requests with 206
+        self.accept_ranges = True
+        # Number of bytes after which the next GET drops the connection
+        self.drop_after = None
+        # Status of the error answered to every request, if any
+        self.error_status = None
+        self.requests = []
+
+    @property
+    def etag(self):
+        return '"' + hashlib.md5(self.content).hexdigest() + '"'
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}/file"
+
+
+class FileRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.server.requests.append(("HEAD", dict(self.headers)))
+        self.send_file_headers(
+            self.server.error_status or 200, len(self.server.content)
+        )
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(("GET", dict(self.headers)))
+        if server.error_status:
+            self.send_file_headers(server.error_status, 0)
+            return
+        if self.headers.get("If-None-Match") == server.etag:
+            self.send_file_headers(304, 0)
+            return
+
+        start, end = 0, len(server.content) - 1
+        byte_range = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if server.accept_ranges and byte_range and if_range in (None, server.etag):
+            first, last = byte_range.removeprefix("bytes=").split("-")
+            start, end = int(first), int(last) if last else end
+        body = server.content[start : end + 1]
+        self.send_file_headers(
+            206 if start or end < len(server.content) - 1 else 200, len(body)
+        )
+
+        if server.drop_after is not None:
+            drop_after, server.drop_after = server.drop_after, None
+            self.wfile.write(body[:drop_after])
+            self.wfile.flush()
+            self.close_connection = True
+            self.connection.shutdown(2)
+            return
+        self.wfile.write(body)
+
+    def send_file_headers(self, status, length):
+        self.send_response(status)
+        self.send_header("ETag", self.server.etag)
+        if self.server.accept_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(connections, "DOWNLOAD_BACKOFF", 0)
+    server = FileServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get_requests(server, method="GET"):
+    return [headers for request, headers in server.requests if request == method]
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_download_resumes_after_a_cut(server, tmp_path):
+    server.drop_after = 1024 * 1024
+    filepath = tmp_path / "file.zip"
+
+    download_file_from_https(server.url, filepath)
+
+    assert read(filepath) == CONTENT
+    first, second = get_requests(server)
+    assert "Range" not in first
+    resumed_from = int(second["Range"].removeprefix("bytes=").rstrip("-"))
+    assert 0 < resumed_from <= 1024 * 1024
+    assert second["If-Range"] == server.etag
+    assert not os.path.exists(str(filepath) + ".part")
+
+
+def test_download_starts_over_when_the_range_is_ignored(server, tmp_path):
+    server.drop_after = 1024 * 1024
+    server.accept_ranges = False
+    filepath = tmp_path / "file.zip"
+
+    download_file_from_https(server.url, filepath)
+
+    # The server answered the Range request with the whole file (200)
+    assert "Range" in get_requests(server)[1]
+    assert read(filepath) == CONTENT
+
+
+def test_download_merges_the_segments(server, tmp_path):
+    filepath = tmp_path / "file.zip"
+
+    download_file_from_https(server.url, filepath, segments=4)
+
+    assert read(filepath) == CONTENT
+    ranges = sorted(
+        tuple(int(bound) for bound in headers["Range"][6:].split("-"))
+        for headers in get_requests(server)
+    )
+    assert len(ranges) == 4
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(CONTENT) - 1
+    assert all(ranges[i][1] + 1 == ranges[i + 1][0] for i in range(3))
+    assert not os.path.exists(str(filepath) + ".part.segments.json")
+
+
+def test_download_resumes_a_cut_segment(server, tmp_path):
+    server.drop_after = 512 * 1024
+    filepath = tmp_path / "file.zip"
+
+    download_file_from_https(server.url, filepath, segments=2)
+
+    assert read(filepath) == CONTENT
+    assert len(get_requests(server)) == 3
+
+
+def test_download_is_skipped_when_not_modified(server, tmp_path):
+    filepath = tmp_path / "file.zip"
+    download_file_from_https(server.url, filepath)
+    modified_at = os.path.getmtime(filepath)
+    server.requests.clear()
+
+    download_file_from_https(server.url, filepath)
+
+    (request,) = get_requests(server)
+    assert request["If-None-Match"] == server.etag
+    assert read(filepath) == CONTENT
+    # The file is not written again, only marked as recently used
+    assert os.path.getmtime(filepath) >= modified_at
+
+
+def test_download_starts_over_when_the_etag_changed(server, tmp_path):
+    filepath = tmp_path / "file.zip"
+    download_file_from_https(server.url, filepath)
+    previous_etag = server.etag
+    server.content = os.urandom(2 * 1024 * 1024)
+    server.requests.clear()
+
+    download_file_from_https(server.url, filepath)
+
+    (request,) = get_requests(server)
+    assert request["If-None-Match"] == previous_etag
+    assert "Range" not in request
+    assert read(filepath) == server.content
+    with open(str(filepath) + HEADERS_SUFFIX) as f:
+        assert json.load(f)["etag"] == server.etag
+
+
+@pytest.mark.parametrize("segments", [1, 4])
+def test_download_retries_the_transient_errors_once_per_attempt(
+    server, tmp_path, monkeypatch, segments
+):
+    monkeypatch.setattr(connections, "DOWNLOAD_MAX_RETRIES", 2)
+    server.error_status = 503
+
+    with pytest.raises(requests.HTTPError):
+        download_file_from_https(server.url, tmp_path / "file.zip", segments=segments)
+
+    assert len(server.requests) == 3
+
+
+def test_download_doesnt_retry_the_other_errors(server, tmp_path):
+    server.error_status = 404
+
+    with pytest.raises(requests.HTTPError):
+        download_file_from_https(server.url, tmp_path / "file.zip")
+
+    assert len(server.requests) == 1
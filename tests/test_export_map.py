@@ -0,0 +1,16 @@
+import duckdb
+
+from pipelines.tasks._common import quote_identifier
+
+
+def test_quoted_column_names_cant_inject_sql():
+    conn = duckdb.connect()
+    column = 'code" AS VARCHAR), 1; DROP TABLE communes; --'
+    conn.execute(
+        f"CREATE TABLE communes AS SELECT '01001' AS {quote_identifier(column)};"
+    )
+
+    conn.execute(f"SELECT CAST({quote_identifier(column)} AS VARCHAR) FROM communes;")
+
+    assert conn.fetchall() == [("01001",)]
+    assert conn.execute("SELECT COUNT(*) FROM communes;").fetchone() == (1,)
@@ -0,0 +1,23 @@
+import json
+
+from pipelines.utils import instrumentation
+from pipelines.utils.instrumentation import span
+
+
+def test_peak_rss_delta_is_the_memory_added_by_the_span(tmp_path, monkeypatch):
+    spans_file = tmp_path / "spans.jsonl"
+    monkeypatch.setattr(instrumentation, "SPANS_FILE", str(spans_file))
+    # The peak memory of the process when each span starts and ends
+    peak_rss = iter([100, 300, 300, 300])
+    monkeypatch.setattr(instrumentation, "get_peak_rss", lambda: next(peak_rss))
+
+    with span("allocate"):
+        pass
+    with span("small"):
+        pass
+
+    with open(spans_file) as f:
+        spans = {record["name"]: record for record in map(json.loads, f)}
+    assert spans["allocate"]["peak_rss_delta"] == 200
+    assert spans["small"]["peak_rss_delta"] == 0
+    assert spans["small"]["process_peak_rss"] == 300
@@ -0,0 +1,37 @@
+import duckdb
+
+from pipelines.tasks._raw import count_invalid_values, get_raw_file_query
+
+COLUMN_TYPES = {
+    "referenceprel": "VARCHAR",
+    "dateprel": "DATE",
+    "valtraduite": "DECIMAL(18, 3)",
+}
+
+
+def test_malformed_values_are_loaded_as_null_and_counted(tmp_path):
+    raw_file = str(tmp_path / "edc_resultats.parquet")
+    conn = duckdb.connect()
+    conn.execute(
+        f"""
+        COPY (
+            SELECT * FROM (VALUES
+                ('P1', '2024-01-31', '0.5'),
+                ('P2', '31/01/2024', '<0,5'),
+                ('P3', NULL, NULL)
+            ) AS t(referenceprel, dateprel, valtraduite)
+        ) TO '{raw_file}' (FORMAT PARQUET);
+        """
+    )
+
+    rows = conn.execute(
+        f"{get_raw_file_query(COLUMN_TYPES)} ORDER BY referenceprel", (raw_file,)
+    ).fetchall()
+    invalid_values = count_invalid_values(conn, COLUMN_TYPES, raw_file)
+
+    assert [(row[0], str(row[1]), str(row[2])) for row in rows] == [
+        ("P1", "2024-01-31", "0.500"),
+        ("P2", "None", "None"),
+        ("P3", "None", "None"),
+    ]
+    assert invalid_values == {"dateprel": 1, "valtraduite": 1}
@@ -0,0 +1,75 @@
+import os
+import subprocess
+import sys
+import types
+
+import pytest
+from click.testing import CliRunner
+
+from pipelines import run
+
+
+@pytest.fixture
+def executed(monkeypatch):
+    """Replace the task modules by stubs recording the arguments of execute()"""
+    calls = []
+
+    def import_module(name):
+        return types.SimpleNamespace(
+            execute=lambda **options: calls.append((name, options))
+        )
+
+    monkeypatch.setattr(run.importlib, "import_module", import_module)
+    monkeypatch.delenv("ENV", raising=False)
+    return calls
+
+
+def invoke(*args):
+    result = CliRunner().invoke(run.run, args, catch_exceptions=False)
+    assert result.exit_code == 0, result.output
+
+
+def test_every_task_module_has_a_command():
+    tasks = {
+        filename[:-3]
+        for filename in os.listdir(run.TASKS_DIR)
+        if filename.endswith(".py") and not filename.startswith("_")
+    }
+    assert tasks == set(run.TASKS)
+
+
+def test_options_are_passed_to_execute(executed):
+    invoke("build_database", "--refresh-type", "custom", "--custom-years", "2023, 2024")
+    invoke("transform", "--partitions", "2023,2024")
+    invoke("export_map", "--geometries", "communes.shp", "--year", "2024")
+    invoke("pipeline", "--env", "prod", "--export-parquet")
+
+    (build, transform, export_map, pipeline) = executed
+    assert build == (
+        "pipelines.tasks.build_database",
+        {
+            "refresh_type": "custom",
+            "custom_years": ["2023", "2024"],
+            "drop_tables": False,
+            "check_update": False,
+            "workers": 1,
+            "streaming": False,
+            "optimize": False,
+            "diff": False,
+        },
+    )
+    assert transform[1] == {"full_refresh": False, "partitions": [2023, 2024]}
+    assert pipeline[1]["env"] == "prod" and pipeline[1]["export"]
+    assert export_map[1]["env"] == "dev"
+    assert export_map[1]["geometries_file"] == "communes.shp"
+
+
+def test_list_doesnt_import_the_tasks():
+    code = (
+        "import sys\n"
+        "from pipelines import run\n"
+        "run.cli(['list'], standalone_mode=False)\n"
+        "assert not [m for m in sys.modules if m.startswith('pipelines.tasks')]\n"
+        "assert 'duckdb' not in sys.modules\n"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True, capture_output=True)
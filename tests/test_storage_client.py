@@ -0,0 +1,111 @@
+import hashlib
+import shutil
+
+import pytest
+from botocore.exceptions import ClientError
+
+from pipelines.utils import storage_client
+from pipelines.utils.storage_client import ObjectStorageClient
+
+
+class StubS3Client:
+    """Stand-in for the boto3 S3 client, keeping the objects in memory"""
+
+    def __init__(self):
+        self.objects = {}
+        self.calls = []
+
+    def head_object(self, Bucket, Key):
+        self.calls.append(("head_object", Key))
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        content, metadata = self.objects[Key]
+        return {"ETag": f'"{hashlib.md5(content).hexdigest()}"', "Metadata": metadata}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Config=None):
+        self.calls.append(("upload_file", Key, Config))
+        with open(Filename, "rb") as f:
+            self.objects[Key] = (f.read(), ExtraArgs.get("Metadata", {}))
+
+    def download_file(self, Bucket, Key, Filename, Config=None):
+        self.calls.append(("download_file", Key, Config))
+        with open(Filename, "wb") as f:
+            f.write(self.objects[Key][0])
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    stub = StubS3Client()
+    monkeypatch.setattr(ObjectStorageClient, "_clients", {"s3": stub, "s3v4": stub})
+    return stub
+
+
+@pytest.fixture
+def local_file(tmp_path):
+    path = tmp_path / "data.duckdb"
+    path.write_bytes(b"database" * 1000)
+    return str(path)
+
+
+def get_calls(s3, name):
+    return [call for call in s3.calls if call[0] == name]
+
+
+def test_upload_uses_the_transfer_config_and_records_the_sha256(s3, local_file):
+    client = ObjectStorageClient()
+
+    assert client.upload_object(local_file, "dev/database/data.duckdb")
+
+    ((_, _, config),) = get_calls(s3, "upload_file")
+    assert config is client.transfer_config
+    assert config.multipart_chunksize == storage_client.TRANSFER_CHUNK_SIZE
+    assert config.max_concurrency == storage_client.TRANSFER_MAX_CONCURRENCY
+    _, metadata = s3.objects["dev/database/data.duckdb"]
+    assert metadata["sha256"] == storage_client.compute_sha256(local_file)
+
+
+def test_upload_is_skipped_when_the_sha256_matches(s3, local_file):
+    client = ObjectStorageClient()
+    client.upload_object(local_file, "dev/database/data.duckdb")
+
+    assert not client.upload_object(
+        local_file, "dev/database/data.duckdb", skip_unchanged=True
+    )
+    assert len(get_calls(s3, "upload_file")) == 1
+
+    with open(local_file, "ab") as f:
+        f.write(b"changed")
+    assert client.upload_object(
+        local_file, "dev/database/data.duckdb", skip_unchanged=True
+    )
+    assert len(get_calls(s3, "upload_file")) == 2
+
+
+def test_download_is_skipped_when_the_local_file_is_unchanged(s3, local_file, tmp_path):
+    client = ObjectStorageClient()
+    client.upload_object(local_file, "dev/database/data.duckdb")
+    downloaded = str(tmp_path / "downloaded.duckdb")
+
+    assert client.download_object(
+        "dev/database/data.duckdb", downloaded, skip_unchanged=True
+    )
+    assert not client.download_object(
+        "dev/database/data.duckdb", downloaded, skip_unchanged=True
+    )
+    ((_, _, config),) = get_calls(s3, "download_file")
+    assert config is client.transfer_config
+
+
+def test_download_compares_the_md5_of_the_objects_without_sha256(
+    s3, local_file, tmp_path
+):
+    with open(local_file, "rb") as f:
+        s3.objects["dev/database/data.duckdb"] = (f.read(), {})
+    client = ObjectStorageClient()
+    downloaded = str(tmp_path / "downloaded.duckdb")
+    shutil.copyfile(local_file, downloaded)
+
+    assert not client.download_object(
+        "dev/database/data.duckdb", downloaded, skip_unchanged=True
+    )
+    assert not get_calls(s3, "download_file")
@@ -0,0 +1,65 @@
+import os
+import subprocess
+
+import duckdb
+import pytest
+
+from pipelines.tasks import _database_versions, transform
+from pipelines.tasks._context import PipelineContext
+from pipelines.tasks._database_versions import (
+    get_current_database_version,
+    get_database_versions,
+    new_database_version,
+)
+
+
+@pytest.fixture
+def current_version(database_folder):
+    """A first version of the database, holding a table"""
+    with PipelineContext() as context:
+        with new_database_version(context):
+            context.conn.execute("CREATE TABLE edc_resultats AS SELECT 1 AS id")
+    return get_current_database_version()
+
+
+def write_model(args, database_file):
+    """Stand-in for dbt, writing a model into the database it is given"""
+    if args[0] == "build":
+        with duckdb.connect(database_file) as conn:
+            conn.execute("CREATE TABLE model AS SELECT * FROM edc_resultats")
+
+
+def test_transform_writes_a_new_version(current_version, monkeypatch):
+    monkeypatch.setattr(transform, "run_dbt", write_model)
+
+    transform.transform(partitions=[2024])
+
+    assert get_current_database_version() != current_version
+    with duckdb.connect(get_current_database_version(), read_only=True) as conn:
+        assert conn.sql("SELECT * FROM model").fetchall() == [(1,)]
+        assert conn.sql("SELECT status FROM _transform_runs").fetchall() == [
+            ("success",)
+        ]
+
+
+def test_failed_dbt_run_leaves_the_current_version_untouched(
+    current_version, monkeypatch
+):
+    def fail(args, database_file):
+        write_model(args, database_file)
+        raise subprocess.CalledProcessError(1, ["dbt", *args])
+
+    monkeypatch.setattr(transform, "run_dbt", fail)
+    versions = get_database_versions()
+    modified_at = os.path.getmtime(current_version)
+
+    with pytest.raises(subprocess.CalledProcessError):
+        transform.transform(partitions=[2024])
+
+    assert get_current_database_version() == current_version
+    assert get_database_versions() == versions
+    assert os.path.getmtime(current_version) == modified_at
+    assert not os.path.exists(_database_versions.DUCKDB_FILE + ".wal")
+    with duckdb.connect(current_version, read_only=True) as conn:
+        tables = {row[0] for row in conn.sql("SHOW TABLES").fetchall()}
+    assert tables == {"edc_resultats"}